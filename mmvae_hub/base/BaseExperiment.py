@@ -2,7 +2,6 @@ import os
 import random
 import typing
 from abc import abstractmethod, ABC
-from itertools import chain, combinations
 from typing import Mapping, Iterable
 
 import numpy as np
@@ -21,6 +20,8 @@ from mmvae_hub.networks.iwVaes import iwMoE, iwMoPoE, iwPoE
 from mmvae_hub.sylvester_flows.models.VAE import PlanarVAE, VAE
 from mmvae_hub.utils import utils
 from mmvae_hub.utils.MongoDB import MongoDatabase
+from mmvae_hub.utils.loader_manager import LoaderManager
+from mmvae_hub.utils.subset_registry import SubsetRegistry
 
 
 class BaseExperiment(ABC):
@@ -32,8 +33,10 @@ class BaseExperiment(ABC):
         self.modalities = None
         self.num_modalities = None
         self.subsets = None
+        self.subset_registry = None
         self.dataset_train = None
         self.dataset_test = None
+        self.loader_manager = LoaderManager(self)
 
         self.mm_vae = None
         self.optimizer = None
@@ -203,15 +206,10 @@ class BaseExperiment(ABC):
         {'a': [None], 'b': [None], 'c': [None], 'a_b': [None, None], 'a_c': [None, None], 'b_c': [None, None],
         'a_b_c': [None, None, None]}
         """
-        xs = list(self.modalities)
-        # note we return an iterator rather than a list
-        subsets_list = chain.from_iterable(combinations(xs, n) for n in range(len(xs) + 1))
-        subsets = {}
-        for k, mod_names in enumerate(subsets_list):
-            mods = [self.modalities[mod_name] for mod_name in sorted(mod_names)]
-            key = '_'.join(sorted(mod_names))
-            subsets[key] = mods
-        return {k: v for k, v in subsets.items() if k != ''}
+        self.subset_registry = SubsetRegistry(self.modalities, device=self.flags.device)
+        return {self.subset_registry.key[s_id]: [self.modalities[mod_name] for mod_name in
+                                                 self.subset_registry.members[s_id]]
+                for s_id in self.subset_registry.ids}
 
     def set_paths_fid(self):
         dir_real = os.path.join(self.flags.dir_gen_eval_fid, 'real')
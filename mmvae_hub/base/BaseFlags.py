@@ -44,6 +44,28 @@ parser.add_argument('--steps_per_training_epoch', type=int, default=None,
 # DATA DEPENDENT
 parser.add_argument('--class_dim', type=int, default=20, help="dimension of common factor latent space")
 parser.add_argument('--dataloader_workers', type=int, default=8, help="number of workers used for the Dataloader")
+parser.add_argument('--prefetch_factor', type=int, default=2,
+                    help="Number of batches loaded in advance by each worker of the Dataloader.")
+parser.add_argument('--pin_memory', type=str2bool, default=True,
+                    help="If True, the Dataloader puts the batches in pinned memory for a faster transfer to the GPU.")
+parser.add_argument('--text_indices', type=str2bool, default=False,
+                    help="If True, the character level texts (mnistsvhntext, celeba) are loaded as character indices "
+                         "instead of one-hot encodings. The text encoders then start with an embedding lookup and "
+                         "the reconstruction likelihood is a categorical distribution over the indices.")
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                    help="Precision of the forward pass and the loss computation. With bf16 or fp16, these are run "
+                         "under autocast, while numerically sensitive parts (product of experts, log-mean-exp and "
+                         "the affine flows) are kept in fp32. fp16 uses loss scaling and needs cuda.")
+parser.add_argument('--train_log_freq', type=int, default=0,
+                    help="The training metrics are accumulated on the device and only transferred to the host at "
+                         "the end of the epoch. If > 0, the running average of the training loss is additionally "
+                         "logged every train_log_freq steps.")
+parser.add_argument('--grad_check', type=str, default='sampled', choices=['off', 'sampled', 'full'],
+                    help="Check for non-finite gradients after the backward pass. 'off' disables the check, 'sampled' "
+                         "checks all gradients with one fused reduction every grad_check_freq steps and 'full' "
+                         "checks at every step and also records parameters without gradient.")
+parser.add_argument('--grad_check_freq', type=int, default=100,
+                    help="Number of training steps between two gradient checks if grad_check is 'sampled'.")
 
 # SAVE and LOAD
 parser.add_argument('--mm_vae_save', type=str, default='mm_vae', help="model save for vae_bimodal")
@@ -66,6 +88,17 @@ parser.add_argument('--dir_fid', type=str, default=None,
 # fid_score
 parser.add_argument('--inception_state_dict', type=str, default='../inception_state_dict.pth',
                     help="path to inception v3 state dict")
+parser.add_argument('--dir_inception_cache', type=str, default='~/.cache/mmvae_hub/inception',
+                    help="directory where the Inception statistics of the real images are cached, shared between "
+                         "runs. If empty, they are computed in every evaluation.")
+parser.add_argument('--inception_workers', type=int, default=4,
+                    help="number of processes that decode the saved images for the Inception network")
+parser.add_argument('--prd_workers', type=int, default=None,
+                    help="number of processes over which the clustering runs of the PRD are distributed. If not "
+                         "given, the number of cpus is used. If 0, the runs are computed in the main process.")
+parser.add_argument('--prd_num_samples', type=int, default=0,
+                    help="If larger than 0, every run of the PRD uses a random subsample of this many features of "
+                         "the real and the generated images.")
 
 # EVALUATION
 parser.add_argument('--use_clf', default=False, action="store_true",
@@ -78,7 +111,11 @@ parser.add_argument('--calc_prd', default=False, action="store_true",
                     help="flag to indicate calculation of prec-rec for gen model")
 parser.add_argument('--save_figure', default=False, action="store_true",
                     help="flag to indicate if figures should be saved to disk (in addition to tensorboard logs). "
-                         "Is set to true if calc_prd is true.")
+                         "Is set to true if calc_prd is true and fid_in_memory is false.")
+parser.add_argument('--fid_in_memory', type=str2bool, default=True,
+                    help="If True, the generated and real images are passed directly to the Inception network for "
+                         "the PRD, without being saved to disk unless save_figure is set. Otherwise the images that "
+                         "are saved during the test generation are read from disk.")
 parser.add_argument('--eval_freq', type=int, default=10,
                     help="frequency of evaluation of latent representation of generative performance (in number of epochs)")
 parser.add_argument('--eval_freq_fid', type=int, default=10,
@@ -136,3 +173,17 @@ parser.add_argument('--nbr_coupling_block_layers', type=int, default=2,
 # importance sampling
 parser.add_argument('--K', type=int, default=10,
                     help="Number of flow layers that are used to implement the GfM function.")
+parser.add_argument('--iw_chunk_size', type=int, default=0,
+                    help="If > 0, the importance weighted models (iwpoe, iwmoe, iwmopoe, iwmogfm) decode the K "
+                         "importance samples in chunks of this size during the loss computation, with the same "
+                         "resulting loss. Without gradients, this bounds the memory of the decoder outputs. During "
+                         "training, it needs to be combined with decoder_checkpointing.")
+parser.add_argument('--decoder_checkpointing', type=str2bool, default=False,
+                    help="If True and iw_chunk_size > 0, the decoder activations of each chunk are recomputed in the "
+                         "backward pass instead of being stored during training. Note that decoders with batch "
+                         "normalization then update their running statistics twice.")
+parser.add_argument('--stacked_decoding', type=str2bool, default=False,
+                    help="If True, the importance weighted models stack the samples of all subsets and run every "
+                         "decoder once per step instead of once per subset. Only use it for decoders without batch "
+                         "dependent layers: decoders with batch normalization (e.g. CelebA) would compute the batch "
+                         "statistics over all subsets, which changes the training.")
@@ -4,7 +4,6 @@ import time
 from abc import abstractmethod
 
 import optuna
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
@@ -20,9 +19,11 @@ from mmvae_hub.experiment_vis.utils import run_notebook_convert
 from mmvae_hub.hyperopt.hyperopt_metrics import get_hyperopt_score
 from mmvae_hub.networks.FlowVaes import FlowVAE
 from mmvae_hub.utils.BaseTBLogger import BaseTBLogger
+from mmvae_hub.utils.grad_sentinel import GradAnomalySentinel
 from mmvae_hub.utils.metrics.average_meters import *
 from mmvae_hub.utils.plotting.plotting import generate_plots
-from mmvae_hub.utils.utils import save_and_log_flags, at_most_n, get_items_from_dict, dict2json
+from mmvae_hub.utils.precision import get_autocast
+from mmvae_hub.utils.utils import save_and_log_flags, at_most_n, dict2json
 
 
 class BaseTrainer:
@@ -31,6 +32,9 @@ class BaseTrainer:
         self.flags = exp.flags
         self.tb_logger = self._setup_tblogger()
         self.callback: BaseCallback = self._set_callback()
+        self.grad_sentinel = self._setup_grad_sentinel()
+        # loss scaling is only needed for fp16, the exponent range of bf16 is the same as for fp32.
+        self.grad_scaler = torch.amp.GradScaler('cuda', enabled=self.flags.precision == 'fp16')
 
         self.begin_time = time.time()
 
@@ -45,6 +49,26 @@ class BaseTrainer:
     def _set_callback(self) -> BaseCallback:
         pass
 
+    def _setup_grad_sentinel(self) -> GradAnomalySentinel:
+        """
+        Watch the gradients of all parameters that are optimized. With fp16, the GradScaler already skips the steps
+        with non-finite gradients and lowers the loss scale, so these expected overflows are not checked.
+        """
+        named_params = {}
+        for mod_str, mod in self.exp.modalities.items():
+            for net_name in ['encoder', 'decoder']:
+                for name, param in getattr(mod, net_name).named_parameters():
+                    named_params.setdefault(id(param), (f'{mod_str}.{net_name}.{name}', param))
+        # the modality networks are submodules of mm_vae, only its remaining parameters are added.
+        for name, param in self.exp.mm_vae.named_parameters():
+            named_params.setdefault(id(param), (f'mm_vae.{name}', param))
+
+        mode = self.flags.grad_check
+        if self.flags.precision == 'fp16' and mode != 'off':
+            log.info('Non-finite gradients are handled by the GradScaler with fp16, the gradient check is disabled.')
+            mode = 'off'
+        return GradAnomalySentinel(named_params.values(), mode=mode, check_freq=self.flags.grad_check_freq)
+
     def run_epochs(self):
         test_results = None
         end = time.time()
@@ -56,7 +80,7 @@ class BaseTrainer:
             self.tb_logger.step = epoch
 
             # training and testing
-            train_results: BaseBatchResults = self.train()
+            train_results: BaseTrainResults = self.train()
             last_epoch: bool = (epoch + 1) == self.flags.end_epoch
             if (epoch + 1) % self.flags.eval_freq == 0 or last_epoch:
                 test_results = self.test(epoch, last_epoch=last_epoch)
@@ -77,57 +101,41 @@ class BaseTrainer:
         self.finalize(test_results, epoch, average_epoch_time=self.callback.epoch_time.get_average())
         return test_results
 
-    def train(self):
+    def train(self) -> BaseTrainResults:
         self.exp.set_train_mode()
         model = self.exp.mm_vae
 
         d_loader, training_steps, average_meters = self.setup_phase('train')
 
+        start_time = time.perf_counter()
+        num_steps = 0
         for iteration, (batch_d, _) in enumerate(at_most_n(d_loader, training_steps)):
             batch_d = model.batch_to_device(batch_d)
 
-            # forward pass
-            forward_results: BaseForwardResults = model(batch_d)
-            # calculate the loss
-            total_loss, joint_divergence, log_probs, klds = model.calculate_loss(forward_results, batch_d)
+            with get_autocast(self.flags):
+                # forward pass
+                forward_results: BaseForwardResults = model(batch_d)
+                # calculate the loss
+                total_loss, joint_divergence, log_probs, klds = model.calculate_loss(forward_results, batch_d)
             # backprop
             self.exp.optimizer.zero_grad()
-            total_loss.backward()
-            if iteration >= 2:
-                for _, mod in model.modalities.items():
-                    for name, param in mod.encoder.named_parameters():
-                        if param.requires_grad:
-                            try:
-                                if torch.any(torch.isnan(param.grad.mean())):
-                                    print(name, param.grad.mean())
-
-                            except AttributeError:
-                                print(name, ': NONE gradient')
-            # temp
-            for _, mod in model.modalities.items():
-                # torch.nn.utils.clip_grad_norm_(mod.encoder.parameters(), 5)
-                # with torch.no_grad():
-                #     for p in mod.encoder.parameters():
-                #         torch.nan_to_num_(p, nan=0,posinf=0, neginf=0)
-                # print(max(p.grad.max() for p in mod.encoder.parameters() if not p.grad is None))
-                if sum(p.grad.max().isnan() for p in mod.encoder.parameters() if not p.grad is None):
-                    sgfdhf = 0
-
-                assert not sum(
-                    p.grad.max().isnan()
-                    for p in mod.encoder.parameters()
-                    if p.grad is not None
-                )
-
-            self.exp.optimizer.step()
+            self.grad_scaler.scale(total_loss).backward()
+            self.grad_scaler.unscale_(self.exp.optimizer)
+            offending = self.grad_sentinel.check(iteration)
+            if offending:
+                log.warning(f'step {iteration + 1}: skipping the optimizer step, non-finite gradients in {offending}')
+            else:
+                self.grad_scaler.step(self.exp.optimizer)
+            self.grad_scaler.update()
+            num_steps += 1
 
             results = {**forward_results.__dict__, 'joint_divergence': joint_divergence}
 
             batch_results = {
-                'total_loss': total_loss.item(),
-                'klds': get_items_from_dict(klds),
-                'log_probs': get_items_from_dict(log_probs),
-                'joint_divergence': results['joint_divergence'].item(),
+                'total_loss': total_loss,
+                'klds': klds,
+                'log_probs': log_probs,
+                'joint_divergence': results['joint_divergence'],
                 # 'latents': forward_results.enc_mods,
                 # 'joint_latents': forward_results.joint_latents
             }
@@ -135,9 +143,20 @@ class BaseTrainer:
             for key, value in batch_results.items():
                 average_meters[key].update(value)
 
+            if self.flags.train_log_freq and (iteration + 1) % self.flags.train_log_freq == 0:
+                log.info(f'step {iteration + 1}: average total loss = {average_meters["total_loss"].get_average()}')
+
         train_results = {k: v.get_average() for k, v in average_meters.items()}
+        # the averages are synchronized with the device, such that the step time includes all queued computations.
+        step_time = (time.perf_counter() - start_time) / max(num_steps, 1)
+        log.info(f'mean training step time: {step_time:.4f}s ({self.flags.precision})')
         self.tb_logger.write_training_logs(**{k: v for k, v in train_results.items() if k != 'joint_latents'})
-        return BaseBatchResults(**train_results)
+        self.tb_logger.write_step_time(step_time)
+
+        grad_anomalies = self.grad_sentinel.get_anomalies()
+        if grad_anomalies:
+            log.warning(f'Parameters with anomalous gradients: {grad_anomalies}')
+        return BaseTrainResults(**train_results, grad_anomalies=grad_anomalies or None, step_time=step_time)
 
     def test(self, epoch, last_epoch: bool) -> BaseTestResults:
         with torch.no_grad():
@@ -148,17 +167,18 @@ class BaseTrainer:
 
             for iteration, (batch_d, _) in enumerate(at_most_n(d_loader, training_steps)):
                 batch_d = model.batch_to_device(batch_d)
-                forward_results: BaseForwardResults = model(batch_d)
+                with get_autocast(self.flags):
+                    forward_results: BaseForwardResults = model(batch_d)
 
-                # calculate the loss
-                total_loss, joint_divergence, log_probs, klds = model.calculate_loss(forward_results, batch_d)
+                    # calculate the loss
+                    total_loss, joint_divergence, log_probs, klds = model.calculate_loss(forward_results, batch_d)
                 results = {**forward_results.__dict__, 'joint_divergence': joint_divergence}
 
                 batch_results = {
-                    'total_loss': total_loss.item(),
-                    'klds': get_items_from_dict(klds),
-                    'log_probs': get_items_from_dict(log_probs),
-                    'joint_divergence': results['joint_divergence'].item(),
+                    'total_loss': total_loss,
+                    'klds': klds,
+                    'log_probs': log_probs,
+                    'joint_divergence': results['joint_divergence'],
                     # 'latents': forward_results.enc_mods,
                     # 'joint_latents': forward_results.joint_latents
                 }
@@ -218,17 +238,15 @@ class BaseTrainer:
 
     def setup_phase(self, phase: str):
         """Setup for train or test phase."""
-        dataset = getattr(self.exp, f'dataset_{phase}')
-        d_loader = DataLoader(dataset, batch_size=self.flags.batch_size, shuffle=True,
-                              num_workers=self.flags.dataloader_workers, drop_last=True)
+        d_loader = self.exp.loader_manager.get_loader(phase)
 
         training_steps = self.flags.steps_per_training_epoch
 
         average_meters = {
-            'total_loss': AverageMeter('total_test_loss'),
-            'klds': AverageMeterDict('klds'),
-            'log_probs': AverageMeterDict('log_probs'),
-            'joint_divergence': AverageMeter('joint_divergence'),
+            'total_loss': TensorAverageMeter('total_test_loss'),
+            'klds': TensorAverageMeterDict('klds'),
+            'log_probs': TensorAverageMeterDict('log_probs'),
+            'joint_divergence': TensorAverageMeter('joint_divergence'),
             # 'latents': AverageMeterLatents('latents', self.flags.factorized_representation),
             # 'joint_latents': AverageMeterJointLatents(model=self.exp.mm_vae, name='joint_latents',
             #                                           factorized_representation=self.flags.factorized_representation)
@@ -237,6 +255,7 @@ class BaseTrainer:
 
     def finalize(self, test_results: BaseTestResults, epoch: int, average_epoch_time):
         log.info('Finalizing.')
+        self.exp.loader_manager.close()
         # write results as json to experiment folder
         run_metadata = {'end_epoch': epoch, 'experiment_duration': time.time() - self.begin_time,
                         'mean_epoch_time': self.callback.epoch_time.get_average()}
@@ -1,16 +1,23 @@
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Dict, Optional
 
 import PIL.Image as Image
+import numpy as np
 import pandas as pd
 import torch
+import torch.nn.functional as F
 from modun.download_utils import download_zip_from_url
 from modun.file_io import json2dict
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
 
 from mmvae_hub import log
 from mmvae_hub.utils.setup.flags_utils import get_config_path
-from mmvae_hub.utils.text import one_hot_encode
+from mmvae_hub.utils.text import one_hot_encode, get_text_codec
 
 
 class CelebaDataset(Dataset):
@@ -55,7 +62,10 @@ class CelebaDataset(Dataset):
 
         if self.transform is not None:
             img = self.transform(img)
-        text_str = one_hot_encode(self.args.len_sequence, self.alphabet, self.y[index])
+        if self.args.text_indices:
+            text_str = get_text_codec(self.alphabet).encode([self.y[index]], self.args.len_sequence)[0].to(torch.int8)
+        else:
+            text_str = one_hot_encode(self.args.len_sequence, self.alphabet, self.y[index])
         label = torch.from_numpy((self.labels[index, 1:] > 0).astype(int)).float()
         # img = torch.rand((self.args.image_channels, 64, 64))
         # text_str = torch.ones((8, 71))
@@ -72,6 +82,145 @@ class CelebaDataset(Dataset):
         return self.y[index]
 
 
+def get_celeba_img_transform(crop_size_img: int, img_size: int) -> transforms.Compose:
+    """Center crop of size crop_size_img, resized to img_size. Returns a PIL image."""
+    offset_height = (218 - crop_size_img) // 2
+    offset_width = (178 - crop_size_img) // 2
+    crop = lambda x: x[:, offset_height:offset_height + crop_size_img, offset_width:offset_width + crop_size_img]
+    return transforms.Compose([transforms.ToTensor(),
+                               transforms.Lambda(crop),
+                               transforms.ToPILImage(),
+                               transforms.Resize(size=(img_size, img_size), interpolation=Image.BICUBIC)])
+
+
+def get_celeba_cache_paths(args, partition: int) -> Dict[str, Path]:
+    """
+    Paths to the preprocessed images, labels and texts of a partition. The images are keyed by the crop and image
+    size, the texts by the text file they are taken from and the sequence length.
+    """
+    dir_cache = Path(args.dir_data) / 'cache'
+    text_key = f'{args.len_sequence}_{args.random_text_ordering}_{args.random_text_startindex}'
+    return {'images': dir_cache / f'images_{partition}_{args.crop_size_img}_{args.img_size}.npy',
+            'labels': dir_cache / f'labels_{partition}.npy',
+            'text': dir_cache / f'text_{partition}_{text_key}.npy'}
+
+
+def _create_celeba_image_chunk(img_dir: str, img_names: np.ndarray, images_path: Path, start: int,
+                               crop_size_img: int, img_size: int) -> None:
+    """Preprocess the images img_names and write them to the images at [start:start + len(img_names)]."""
+    transform = get_celeba_img_transform(crop_size_img, img_size)
+    images = np.load(images_path, mmap_mode='r+')
+    for idx, img_name in enumerate(img_names, start=start):
+        with Image.open(os.path.join(img_dir, img_name)) as img:
+            images[idx] = np.asarray(transform(img)).transpose(2, 0, 1)
+    images.flush()
+
+
+def _save_atomic(path: Path, arr: np.ndarray) -> None:
+    """Save arr to a temporary file in the directory of path and rename it, such that path is never partly written."""
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix='.tmp', delete=False) as f:
+        np.save(f, arr)
+    os.replace(f.name, path)
+
+
+def create_celeba_cache(args, alphabet: str, partition: int, num_workers: Optional[int] = None,
+                        chunk_size: int = 1000) -> None:
+    """
+    Preprocess a partition of CelebA for the CachedCelebaDataset. The missing parts of the cache are created:
+    - the cropped and resized images as uint8 array of shape (num_samples, 3, img_size, img_size), which is written
+      by a pool of num_workers processes,
+    - the labels as float32 array of shape (num_samples, num_labels),
+    - the texts as int8 array of character indices, with shape (num_samples, len_sequence).
+    """
+    paths = get_celeba_cache_paths(args, partition)
+    paths['images'].parent.mkdir(exist_ok=True)
+    dataset = CelebaDataset(args, alphabet, partition=partition)
+
+    if not paths['labels'].exists():
+        _save_atomic(paths['labels'], (dataset.labels[:, 1:] > 0).astype(np.float32))
+    if not paths['text'].exists():
+        _save_atomic(paths['text'],
+                     get_text_codec(alphabet).encode(dataset.y, args.len_sequence).to(torch.int8).numpy())
+    if paths['images'].exists():
+        return
+
+    log.info(f'Preprocessing {len(dataset)} images of CelebA partition {partition} to {paths["images"]}.')
+    # write to a unique temporary file first, such that interrupted or concurrent runs do not leave a broken cache.
+    with tempfile.NamedTemporaryFile(dir=paths['images'].parent, prefix=paths['images'].name, suffix='.tmp',
+                                     delete=False) as f:
+        tmp_path = Path(f.name)
+    try:
+        np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                  shape=(len(dataset), 3, args.img_size, args.img_size)).flush()
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_create_celeba_image_chunk, dataset.img_dir,
+                                       dataset.img_names[start:start + chunk_size], tmp_path, start,
+                                       args.crop_size_img, args.img_size)
+                       for start in range(0, len(dataset), chunk_size)]
+            for future in futures:
+                future.result()
+        os.replace(tmp_path, paths['images'])
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+class CachedCelebaDataset(Dataset):
+    """
+    CelebA dataset that is served from the cache of create_celeba_cache, which is created on first use.
+
+    A sample is a set of array slices: the uint8 image and the int8 character indices of the text. The conversion of
+    the images to floats in [0, 1] and the one-hot encoding of the texts is done for the whole batch in collate_fn,
+    which gives the same batches as CelebaDataset with the transform of the experiment.
+    """
+
+    def __init__(self, args, alphabet, partition=0):
+        self.args = args
+        self.alphabet = alphabet
+        self.text_indices = args.text_indices
+        paths = get_celeba_cache_paths(args, partition)
+        if not all(path.exists() for path in paths.values()):
+            create_celeba_cache(args, alphabet, partition, num_workers=args.dataloader_workers or None)
+
+        self.labels = np.load(paths['labels'])
+        self.texts = np.load(paths['text'])
+        self.images_path = paths['images']
+        # the memory map is opened lazily in each dataloader worker.
+        self._images = None
+        assert len(self.images) == len(self.labels) == len(self.texts)
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        # do not pickle the memory map with the dataset.
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __getitem__(self, index):
+        sample = {'img': torch.from_numpy(np.array(self.images[index])), 'text': torch.from_numpy(self.texts[index])}
+        return sample, torch.from_numpy(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def batch_transform(self, batch: dict) -> dict:
+        """
+        Convert the images to floats in [0, 1] and, unless the texts are used as character indices, one-hot encode
+        the texts. Works for a batch or a single sample.
+        """
+        text = batch['text'] if self.text_indices else F.one_hot(batch['text'].long(), len(self.alphabet)).float()
+        return {'img': batch['img'].float().div_(255), 'text': text}
+
+    def collate_fn(self, samples):
+        batch, target = default_collate(samples)
+        return self.batch_transform(batch), target
+
+
 if __name__ == '__main__':
 
     config = json2dict(get_config_path(dataset='celeba'))
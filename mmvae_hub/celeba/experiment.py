@@ -2,14 +2,13 @@ import json
 import random
 from pathlib import Path
 
-import PIL.Image as Image
 import numpy as np
 from sklearn.metrics import average_precision_score
 from torchvision import transforms
 
 from mmvae_hub.celeba.modalities.celebaImg import CelebaImg
 from mmvae_hub.base.BaseExperiment import BaseExperiment
-from mmvae_hub.celeba.CelebADataset import CelebaDataset
+from mmvae_hub.celeba.CelebADataset import CelebaDataset, CachedCelebaDataset, get_celeba_img_transform
 from mmvae_hub.celeba.metrics import CelebAMetrics
 from mmvae_hub.celeba.modalities.celebaText import CelebaText
 
@@ -66,19 +65,15 @@ class CelebaExperiment(BaseExperiment):
         return {mod1.name: mod1, mod2.name: mod2}
 
     def get_transform_celeba(self):
-        offset_height = (218 - self.flags.crop_size_img) // 2
-        offset_width = (178 - self.flags.crop_size_img) // 2
-        crop = lambda x: x[:, offset_height:offset_height + self.flags.crop_size_img,
-                         offset_width:offset_width + self.flags.crop_size_img]
-        return transforms.Compose([transforms.ToTensor(),
-                                   transforms.Lambda(crop),
-                                   transforms.ToPILImage(),
-                                   transforms.Resize(size=(self.flags.img_size,
-                                                           self.flags.img_size),
-                                                     interpolation=Image.BICUBIC),
+        return transforms.Compose([get_celeba_img_transform(self.flags.crop_size_img, self.flags.img_size),
                                    transforms.ToTensor()])
 
     def set_dataset(self):
+        if self.flags.cached_data:
+            self.dataset_train = CachedCelebaDataset(self.flags, self.alphabet, partition=0)
+            self.dataset_test = CachedCelebaDataset(self.flags, self.alphabet, partition=1)
+            return
+
         transform = self.get_transform_celeba()
         d_train = CelebaDataset(self.flags, self.alphabet, partition=0, transform=transform)
         d_eval = CelebaDataset(self.flags, self.alphabet, partition=1, transform=transform)
@@ -111,8 +106,9 @@ class CelebaExperiment(BaseExperiment):
         n_test = self.dataset_test.__len__()
         samples = []
         for _ in range(10):
-            ix = np.random.randint(0, len(self.dataset_test.img_names))
-            sample, target = self.dataset_test.__getitem__(random.randint(0, n_test))
+            sample, target = self.dataset_test.__getitem__(random.randint(0, n_test - 1))
+            if self.flags.cached_data:
+                sample = self.dataset_test.batch_transform(sample)
             for k, key in enumerate(sample):
                 sample[key] = sample[key].to(self.flags.device)
             samples.append(sample)
@@ -1,6 +1,6 @@
 from pathlib import Path
 
-from mmvae_hub.utils.setup.flags_utils import BaseFlagsSetup
+from mmvae_hub.utils.setup.flags_utils import BaseFlagsSetup, str2bool
 
 from mmvae_hub.base.BaseFlags import parser as parser
 
@@ -18,6 +18,10 @@ parser.add_argument('--random_text_ordering', type=bool, default=False,
                     help="flag to indicate if attributes are shuffled randomly")
 parser.add_argument('--random_text_startindex', type=bool, default=True,
                     help="flag to indicate if start index is random")
+parser.add_argument('--cached_data', type=str2bool, default=True,
+                    help="If True, the images are cropped and resized and the texts are encoded once per partition, "
+                         "and the samples are read from that cache. Otherwise every image is decoded and transformed "
+                         "at every access.")
 
 parser.add_argument('--DIM_text', type=int, default=128, help="filter dimensions of residual layers")
 parser.add_argument('--DIM_img', type=int, default=128, help="filter dimensions of residual layers")
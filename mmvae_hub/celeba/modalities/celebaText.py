@@ -16,6 +16,7 @@ from torchvision import transforms
 from mmvae_hub.celeba.networks.ConvNetworkTextClfCelebA import ClfText
 from mmvae_hub.celeba.networks.ConvNetworksTextCelebA import EncoderText, DecoderText
 from mmvae_hub.modalities import BaseModality
+from mmvae_hub.networks.utils.utils import IndexCategorical
 from mmvae_hub.utils.plotting.save_samples import write_samples_text_to_file
 from mmvae_hub.utils.text import tensor_to_text
 
@@ -26,7 +27,7 @@ class CelebaText(BaseModality):
         super().__init__(flags, name)
         self.flags = flags
         self.name = name
-        self.px_z = OneHotCategorical
+        self.px_z = IndexCategorical if flags.text_indices else OneHotCategorical
 
         self.alphabet = alphabet
 
@@ -1,6 +1,7 @@
 import torch.nn as nn
 
 from mmvae_hub.celeba.networks.FeatureExtractorText import make_res_block_encoder_feature_extractor
+from mmvae_hub.networks.text.embedding import embed_text
 
 
 class ClfText(nn.Module):
@@ -26,8 +27,7 @@ class ClfText(nn.Module):
         self.sigmoid = nn.Sigmoid();
 
     def forward(self, x_text):
-        x_text = x_text.transpose(-2, -1);
-        out = self.conv1(x_text)
+        out = embed_text(self.conv1, x_text)
         out = self.resblock_1(out);
         out = self.resblock_2(out);
         out = self.resblock_3(out);
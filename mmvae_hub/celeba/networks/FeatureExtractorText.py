@@ -1,6 +1,7 @@
 import torch.nn as nn
 
 from mmvae_hub.celeba.networks.ResidualBlocks import ResidualBlock1dConv
+from mmvae_hub.networks.text.embedding import embed_text
 
 
 def make_res_block_encoder_feature_extractor(in_channels, out_channels, kernelsize, stride, padding, dilation, a_val=2.0, b_val=0.3):
@@ -39,8 +40,7 @@ class FeatureExtractorText(nn.Module):
                                                                    kernelsize=4, stride=2, padding=0, dilation=1);
 
     def forward(self, x):
-        x = x.transpose(-2,-1);
-        out = self.conv1(x)
+        out = embed_text(self.conv1, x)
         out = self.resblock_1(out);
         out = self.resblock_2(out);
         out = self.resblock_3(out);
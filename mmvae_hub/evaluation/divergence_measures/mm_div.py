@@ -138,7 +138,8 @@ class BMoGfMMMDiv(BaseMMDiv):
         enc_mods_divergences = {mod_str: self.calc_kl_divergence(distr0=enc_mod.latents_class) for mod_str, enc_mod in
                                 enc_mods.items()}
 
-        klds = self.calc_subset_divergences(subsets=forward_results.joint_latents.subsets,
+        klds = self.calc_subset_divergences(subsets={s_key: subsets[s_key] for s_key in
+                                                     forward_results.joint_latents.subsets},
                                             enc_mods_divergences=enc_mods_divergences)
 
         # normalize klds with number of modalities in subset and batch_size
@@ -153,11 +154,9 @@ class BMoGfMMMDiv(BaseMMDiv):
 
         return klds, joint_div
 
-    def calc_subset_divergences(self, subsets: dict, enc_mods_divergences: dict):
-        subset_mods = {subset_str: [mod for mod in subset_str.split('_')] for subset_str in subsets}
-
-        return {subset_str: max(enc_mods_divergences[mod_str] for mod_str in mod_strs) for subset_str, mod_strs in
-                subset_mods.items()}
+    def calc_subset_divergences(self, subsets: Mapping[str, Iterable[BaseModality]], enc_mods_divergences: dict):
+        return {subset_str: max(enc_mods_divergences[mod.name] for mod in mods) for subset_str, mods in
+                subsets.items()}
 
 
 class GfMMMDiv(BaseMMDiv):
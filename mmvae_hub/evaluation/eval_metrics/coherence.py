@@ -4,10 +4,8 @@ from typing import Mapping
 import numpy as np
 import torch
 from torch import Tensor
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from mmvae_hub import log
 from mmvae_hub.utils.plotting.save_samples import save_generated_samples_singlegroup
 from mmvae_hub.utils.utils import init_twolevel_nested_dict, dict_to_device
 
@@ -22,15 +20,13 @@ def classify_cond_gen_samples(exp, labels: Tensor, cond_samples: typing.Mapping[
     'text': tensor}
 
     """
-    clf_predictions = {mod: {} for mod in exp.modalities}
-    for mod in exp.modalities:
-        if mod in cond_samples:
-            mod_cond_gen: Tensor = cond_samples[mod]
-            mod_clf = exp.modalities[mod].clf
+    clf_predictions = {}
+    # only the generated modalities that have a classifier are classified.
+    for mod, mod_cond_gen in cond_samples.items():
+        mod_clf = exp.modalities[mod].clf
+        if mod_clf is not None:
             # classify generated sample to evaluate coherence
             clf_predictions[mod] = mod_clf(mod_cond_gen).cpu()
-        else:
-            log.info(str(mod) + 'not existing in cond_gen_samples')
     return clf_predictions
 
 
@@ -39,7 +35,7 @@ def calculate_coherence(exp, samples) -> dict:
     Classifies generated modalities. The generated samples are coherent if all modalities
     are classified as belonging to the same class.
     """
-    mods = exp.modalities
+    mods = {mod_str: mod for mod_str, mod in exp.modalities.items() if mod.clf is not None}
     # TODO: make work for num samples NOT EQUAL to batch_size
     c_labels = {}
     for j, l_key in enumerate(exp.labels):
@@ -131,15 +127,18 @@ def init_gen_perf(labels, subsets, mods) -> typing.Mapping[str, dict]:
 def calc_coherence_random_gen(exp, mm_vae, iteration: int, rand_coherences: Mapping[str, typing.List], batch_d: dict) -> \
         Mapping[str, typing.List]:
     args = exp.flags
+    save_samples = (exp.flags.batch_size * iteration) < exp.flags.num_samples_fid and args.save_figure
+    # only the modalities with a classifier are generated, unless the samples are saved.
+    out_mods = None if save_samples else [mod_str for mod_str, mod in exp.modalities.items() if mod.clf is not None]
     # generating random samples
-    rand_gen = mm_vae.module.generate() if args.distributed else mm_vae.generate()
+    rand_gen = mm_vae.module.generate(out_mods=out_mods) if args.distributed else mm_vae.generate(out_mods=out_mods)
     rand_gen = dict_to_device(rand_gen, args.device)
     # classifying generated examples
     coherence_random = calculate_coherence(exp, rand_gen)
     for j, l_key in enumerate(exp.labels):
         rand_coherences[l_key].append(coherence_random[l_key])
 
-    if (exp.flags.batch_size * iteration) < exp.flags.num_samples_fid and args.save_figure:
+    if save_samples:
         # saving generated samples to dir_fid
         save_generated_samples(exp, rand_gen, iteration, batch_d)
 
@@ -175,14 +174,14 @@ def test_generation(exp, dataset=None):
     """
     args = exp.flags
 
-    mods = exp.modalities
+    # only the modalities with a classifier are generated and evaluated.
+    mods = {mod_str: mod for mod_str, mod in exp.modalities.items() if mod.clf is not None}
     mm_vae = exp.mm_vae
     subsets = [*exp.subsets, 'joint']
 
-    d_loader = DataLoader(exp.dataset_test if not dataset else dataset,
-                          batch_size=args.batch_size,
-                          shuffle=True,
-                          num_workers=exp.flags.dataloader_workers, drop_last=True)
+    # a custom dataset is only iterated once, it gets a loader without persistent workers.
+    d_loader = exp.loader_manager.make_loader(dataset, persistent=False) if dataset \
+        else exp.loader_manager.get_loader('test')
 
     batch_labels, rand_coherences, cond_gen_classified = classify_generated_samples(args, d_loader, exp,
                                                                                     mm_vae,
@@ -218,14 +217,18 @@ def classify_generated_samples(args, d_loader, exp, mm_vae, mods, subsets):
         # classifies them and stores the classifier predictions
         _, joint_latent = mm_vae.module.inference(batch_d) if args.distributed else mm_vae.inference(batch_d)
 
-        cg = mm_vae.module.cond_generation(joint_latent) if args.distributed else mm_vae.cond_generation(joint_latent)
+        # all modalities are generated if the samples are saved.
+        save_samples = (exp.flags.batch_size * iteration) < exp.flags.num_samples_fid and exp.flags.save_figure
+        out_mods = None if save_samples else list(mods)
+        cg = mm_vae.module.cond_generation(joint_latent, out_mods=out_mods) if args.distributed \
+            else mm_vae.cond_generation(joint_latent, out_mods=out_mods)
         cg: typing.Mapping[str, typing.Mapping[mods, Tensor]]
         # classify the cond. generated samples
         for subset, cond_val in cg.items():
             clf_cg: Mapping[mods, Tensor] = classify_cond_gen_samples(exp, batch_l, cond_val)
             for mod in mods:
                 cond_gen_classified[subset][mod] = torch.cat((cond_gen_classified[subset][mod], clf_cg[mod]), 0)
-            if (exp.flags.batch_size * iteration) < exp.flags.num_samples_fid and exp.flags.save_figure:
+            if save_samples:
                 save_generated_samples_singlegroup(exp, iteration, subset, cond_val)
 
     return batch_labels, rand_coherences, cond_gen_classified
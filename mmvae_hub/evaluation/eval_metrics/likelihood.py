@@ -2,7 +2,6 @@ import math
 
 import numpy as np
 import torch.nn.functional
-from torch.utils.data import DataLoader
 
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
 from mmvae_hub.utils.metrics.likelihood import log_marginal_estimate, log_joint_estimate
@@ -90,10 +89,7 @@ def estimate_likelihoods(exp):
     model = exp.mm_vae
     mods = exp.modalities
     bs_normal = exp.flags.batch_size
-    d_loader = DataLoader(exp.dataset_test,
-                          batch_size=exp.flags.batch_size,
-                          shuffle=True,
-                          num_workers=exp.flags.dataloader_workers, drop_last=True)
+    d_loader = exp.loader_manager.get_loader('test')
 
     subsets = exp.subsets
     if '' in subsets:
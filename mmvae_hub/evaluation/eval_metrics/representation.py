@@ -2,7 +2,6 @@ from typing import List
 
 import numpy as np
 from sklearn.linear_model import LogisticRegression
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from mmvae_hub import log
@@ -20,8 +19,7 @@ def train_clf_lr_all_subsets(exp):
     mm_vae.eval()
     subsets = exp.subsets
 
-    train_loader = DataLoader(exp.dataset_train, batch_size=args.batch_size, shuffle=True,
-                              num_workers=args.dataloader_workers, drop_last=True)
+    train_loader = exp.loader_manager.get_loader('train')
 
     training_steps = exp.flags.steps_per_training_epoch
 
@@ -109,8 +107,7 @@ def test_clf_lr_all_subsets(clf_lr: Mapping[str, Mapping[str, LogisticRegression
     mm_vae = exp.mm_vae
     mm_vae.eval()
 
-    d_loader = DataLoader(exp.dataset_test, batch_size=exp.flags.batch_size, shuffle=False,
-                          num_workers=exp.flags.dataloader_workers, drop_last=True)
+    d_loader = exp.loader_manager.get_loader('test', shuffle=False)
 
     training_steps = exp.flags.steps_per_training_epoch or len(d_loader)
     log.info(f'Creating {training_steps} batches of latent representations for classifier testing '
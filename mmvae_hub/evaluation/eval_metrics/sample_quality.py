@@ -1,37 +1,124 @@
 import glob
+import math
 import os
+import typing
+
+from pathlib import Path
 
 import numpy as np
-from mmvae_hub.evaluation.fid.fid_score import calculate_frechet_distance
+import torch
+
+from mmvae_hub import log
 from mmvae_hub.evaluation.fid.fid_score import get_activations
+from mmvae_hub.evaluation.fid.frechet_distance import calculate_frechet_distances
 from mmvae_hub.evaluation.fid.inception import InceptionV3
-
+from mmvae_hub.evaluation.fid.inception_features import FeatureStats, load_inception_model, get_inception_features, \
+    get_real_stats_path, get_activations_from_files
 from mmvae_hub.evaluation.prd_score import prd_score as prd
+from mmvae_hub.evaluation.prd_score import prd_runs
+from mmvae_hub.utils.Dataclasses.Dataclasses import ReparamLatent
+from mmvae_hub.utils.plotting.save_samples import save_generated_samples_singlegroup
+from mmvae_hub.utils.utils import dict_to_device
 
 
 def calc_inception_features(exp, dims=2048, batch_size=128):
-    block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[dims]
-
-    model = InceptionV3([block_idx],
-                        path_state_dict=exp.flags.inception_state_dict)
-    model = model.to(exp.flags.device)
+    """
+    Compute the Inception features of the saved images of every group in exp.paths_fid and save them to
+    dir_gen_eval_fid. The images of all groups of a modality are processed in one sweep.
+    """
+    model = load_inception_model(exp.flags, dims)
 
     paths = exp.paths_fid
     for m, m_key in enumerate(exp.modalities.keys()):
         mod = exp.modalities[m_key]
         if mod.gen_quality_eval:
+            files = {}
             for k, key in enumerate(paths.keys()):
                 if key != '':
                     dir_gen = paths[key]
                     if not os.path.exists(dir_gen):
                         raise RuntimeError('Invalid path: %s' % dir_gen)
-                    files_gen = glob.glob(os.path.join(dir_gen, mod.name, '*' +
-                                                       mod.file_suffix))
-                    fn = os.path.join(exp.flags.dir_gen_eval_fid,
-                                      key + '_' + mod.name + '_activations.npy')
-                    act_gen = get_activations(files_gen, exp.flags, model, batch_size, dims,
-                                              True, verbose=False)
-                    np.save(fn, act_gen)
+                    files[key] = sorted(glob.glob(os.path.join(dir_gen, mod.name, '*' + mod.file_suffix)))
+            acts = get_activations_from_files(model, files, exp.flags.device, batch_size, dims,
+                                              num_workers=exp.flags.inception_workers)
+            for key, act_gen in acts.items():
+                fn = os.path.join(exp.flags.dir_gen_eval_fid, key + '_' + mod.name + '_activations.npy')
+                np.save(fn, act_gen)
+
+
+@torch.no_grad()
+def calc_inception_features_in_memory(exp, dims=2048, keep_features=True) \
+        -> typing.Mapping[str, typing.Mapping[str, FeatureStats]]:
+    """
+    Generate samples for the first num_samples_fid test samples and stream them, together with the real test images,
+    directly into the Inception network. Returns the feature statistics of every modality with gen_quality_eval for
+    the real images ('real'), the random generation ('random') and the generation conditioned on every subset.
+    The samples are additionally saved as images if flags.save_figure is set.
+
+    The test set is iterated in a fixed order, such that the statistics of the real images are the same in every
+    evaluation. They are cached in flags.dir_inception_cache and shared between runs.
+    """
+    args = exp.flags
+    model = load_inception_model(args, dims)
+    mm_vae = exp.mm_vae.module if args.distributed else exp.mm_vae
+    gen_mods = [mod.name for mod in exp.modalities.values() if mod.gen_quality_eval]
+    stats = {mod: {} for mod in gen_mods}
+    d_loader = exp.loader_manager.get_loader('test', shuffle=False)
+    # paths to which the statistics of the real images are saved, if they are not found in the cache.
+    real_stats_paths = {}
+    real_cached = False
+
+    def update(group_name: str, samples: typing.Mapping[str, torch.Tensor]):
+        for mod in gen_mods:
+            if group_name not in stats[mod]:
+                # the moments are only accumulated if the features, from which they can be computed, are not kept.
+                stats[mod][group_name] = FeatureStats(dims, keep_features=keep_features, keep_moments=not keep_features)
+            stats[mod][group_name].update(get_inception_features(model, samples[mod], args.device))
+
+    for iteration, (batch_d, _) in enumerate(d_loader):
+        if args.batch_size * iteration >= args.num_samples_fid:
+            break
+        batch_d = dict_to_device(batch_d, args.device)
+        if iteration == 0 and args.dir_inception_cache:
+            real_stats_paths = get_real_stats_paths(exp, d_loader, batch_d, gen_mods, dims)
+            real_cached = all(path.exists() for path in real_stats_paths.values())
+            if real_cached:
+                real_stats = {mod: FeatureStats.load(path) for mod, path in real_stats_paths.items()}
+                # statistics that were cached without the features can not be used for the PRD.
+                real_cached = not keep_features or all(mod_stats.keep_features for mod_stats in real_stats.values())
+            if real_cached:
+                for mod in gen_mods:
+                    stats[mod]['real'] = real_stats[mod]
+                real_stats_paths = {}
+
+        rand_latents = ReparamLatent(content=mm_vae.get_rand_samples_from_joint(args.batch_size), style=None)
+        groups = {'real': batch_d, 'random': mm_vae.generate_from_latents(rand_latents, out_mods=gen_mods)}
+        _, joint_latent = mm_vae.inference(batch_d)
+        groups.update(mm_vae.cond_generation(joint_latent, out_mods=gen_mods))
+
+        for group_name, samples in groups.items():
+            if group_name != 'real' or not real_cached:
+                update(group_name, samples)
+            if args.save_figure:
+                save_generated_samples_singlegroup(exp, iteration, group_name,
+                                                   {mod: samples[mod] for mod in gen_mods})
+
+    for mod, path in real_stats_paths.items():
+        stats[mod]['real'].save(path)
+    return stats
+
+
+def get_real_stats_paths(exp, d_loader, first_batch: dict, gen_mods: typing.Iterable[str], dims: int) \
+        -> typing.Mapping[str, Path]:
+    """Paths of the cached Inception statistics of the real test images of every modality in gen_mods."""
+    args = exp.flags
+    num_batches = min(math.ceil(args.num_samples_fid / args.batch_size), len(d_loader))
+    inception_state_dict = Path(args.inception_state_dict)
+    fingerprint = {'dataset': type(d_loader.dataset).__name__, 'len_dataset': len(d_loader.dataset),
+                   'num_samples': num_batches * args.batch_size, 'dims': dims,
+                   'inception_state_dict': (inception_state_dict.name, inception_state_dict.stat().st_size)}
+    return {mod: get_real_stats_path(args.dir_inception_cache, {**fingerprint, 'modality': mod}, first_batch[mod])
+            for mod in gen_mods}
 
 
 def load_inception_activations(exp):
@@ -133,19 +220,16 @@ def calculate_inception_features_for_gen_evaluation(flags, paths, modality=None,
 
 
 def calculate_fid(feats_real, feats_gen):
-    mu_real = np.mean(feats_real, axis=0)
-    sigma_real = np.cov(feats_real, rowvar=False)
-    mu_gen = np.mean(feats_gen, axis=0)
-    sigma_gen = np.cov(feats_gen, rowvar=False)
-    return calculate_frechet_distance(mu_real, sigma_real, mu_gen, sigma_gen)
+    return calculate_fid_dict(feats_real, {'gen': feats_gen})['gen']
 
 
 def calculate_fid_dict(feats_real, dict_feats_gen):
-    dict_fid = {}
-    for k, key in enumerate(dict_feats_gen.keys()):
-        feats_gen = dict_feats_gen[key]
-        dict_fid[key] = calculate_fid(feats_real, feats_gen)
-    return dict_fid
+    """FID of the features of every key in dict_feats_gen, sharing the decomposition of the real statistics."""
+    mu_real = np.mean(feats_real, axis=0)
+    sigma_real = np.cov(feats_real, rowvar=False)
+    stats_gen = {key: (np.mean(feats_gen, axis=0), np.cov(feats_gen, rowvar=False))
+                 for key, feats_gen in dict_feats_gen.items()}
+    return calculate_frechet_distances(mu_real, sigma_real, stats_gen)
 
 
 def calculate_prd(feats_real, feats_gen):
@@ -153,12 +237,18 @@ def calculate_prd(feats_real, feats_gen):
     return np.mean(prd_val)
 
 
-def calculate_prd_dict(feats_real, dict_feats_gen):
-    dict_fid = {}
-    for k, key in enumerate(dict_feats_gen.keys()):
-        feats_gen = dict_feats_gen[key]
-        dict_fid[key] = calculate_prd(feats_real, feats_gen)
-    return dict_fid
+def calculate_prd_dict(feats_real, dict_feats_gen, num_samples=None, num_workers=None):
+    """
+    PRD score of the features of every key in dict_feats_gen, like calculate_prd. The runs of all keys are computed
+    in num_workers processes, on subsamples of num_samples features if given.
+    """
+    prd_data = prd_runs.compute_prd_dict_from_embedding(feats_real, dict_feats_gen, num_samples=num_samples,
+                                                        num_workers=num_workers)
+    dict_prd = {}
+    for key, (_, _, scores) in prd_data.items():
+        log.info(f'PRD {key}: {scores.mean():.4f} (std over {len(scores)} runs: {scores.std():.4f})')
+        dict_prd[key] = np.mean(scores)
+    return dict_prd
 
 
 def get_clf_activations(flags, data, model):
@@ -169,23 +259,20 @@ def get_clf_activations(flags, data, model):
 
 
 def calc_prd_score(exp):
-    calc_inception_features(exp)
-    acts = load_inception_activations(exp)
+    if exp.flags.fid_in_memory:
+        acts = {mod: {key: feature_stats.features for key, feature_stats in mod_stats.items()}
+                for mod, mod_stats in calc_inception_features_in_memory(exp).items()}
+    else:
+        calc_inception_features(exp)
+        acts = load_inception_activations(exp)
     ap_prds = {}
     for m, m_key in enumerate(exp.modalities.keys()):
         mod = exp.modalities[m_key]
         if mod.gen_quality_eval:
-            for k, key in enumerate(exp.subsets):
-                if key == '':
-                    continue
-                ap_prd = calculate_prd(acts[mod.name]['real'],
-                                       acts[mod.name][key])
-                ap_prds[key + '_' + mod.name] = ap_prd
-
-    for m, m_key in enumerate(exp.modalities.keys()):
-        mod = exp.modalities[m_key]
-        if mod.gen_quality_eval:
-            ap_prd = calculate_prd(acts[mod.name]['real'],
-                                   acts[mod.name]['random'])
-            ap_prds['random_' + mod.name] = ap_prd
+            # all groups are evaluated against the real features at once.
+            keys = [key for key in exp.subsets if key != ''] + ['random']
+            mod_prds = calculate_prd_dict(acts[mod.name]['real'], {key: acts[mod.name][key] for key in keys},
+                                          num_samples=exp.flags.prd_num_samples or None,
+                                          num_workers=exp.flags.prd_workers)
+            ap_prds.update({key + '_' + mod.name: ap_prd for key, ap_prd in mod_prds.items()})
     return ap_prds
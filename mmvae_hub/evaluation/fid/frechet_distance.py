@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from typing import Mapping, Optional, Dict
+
+import numpy as np
+import torch
+
+
+def sqrtm_psd(sigma: torch.Tensor) -> torch.Tensor:
+    """Square root of a symmetric positive semi-definite matrix from its eigendecomposition."""
+    eigvals, eigvecs = torch.linalg.eigh(sigma)
+    return (eigvecs * eigvals.clamp(min=0).sqrt()) @ eigvecs.T
+
+
+class FrechetDistance:
+    """
+    Frechet distance of Gaussians to a fixed reference Gaussian, e.g. of the features of generated images to the
+    features of the real images:
+            d^2 = ||mu_1 - mu_2||^2 + Tr(C_1 + C_2 - 2*sqrt(C_1*C_2)).
+
+    The square root of the reference covariance C_1 is computed once. Since C_1*C_2 is similar to the symmetric
+    matrix sqrt(C_1)*C_2*sqrt(C_1), the trace of sqrt(C_1*C_2) is the sum of the square roots of the eigenvalues of
+    the latter, which only needs a symmetric eigenvalue decomposition instead of scipy.linalg.sqrtm.
+    The computation runs in float64 with torch and agrees with calculate_frechet_distance to a relative tolerance of
+    about 1e-6 for the covariances of Inception features.
+    """
+
+    def __init__(self, mu: np.ndarray, sigma: np.ndarray, device: str = 'cpu'):
+        self.device = device
+        self.mu = torch.as_tensor(np.atleast_1d(mu), dtype=torch.float64, device=device)
+        sigma = torch.as_tensor(np.atleast_2d(sigma), dtype=torch.float64, device=device)
+        self.trace_sigma = sigma.trace()
+        self.sqrt_sigma = sqrtm_psd(sigma)
+
+    def __call__(self, mu: np.ndarray, sigma: np.ndarray) -> float:
+        mu = torch.as_tensor(np.atleast_1d(mu), dtype=torch.float64, device=self.device)
+        sigma = torch.as_tensor(np.atleast_2d(sigma), dtype=torch.float64, device=self.device)
+        assert mu.shape == self.mu.shape, 'Training and test mean vectors have different lengths'
+        assert sigma.shape == self.sqrt_sigma.shape, 'Training and test covariances have different dimensions'
+
+        diff = self.mu - mu
+        eigvals = torch.linalg.eigvalsh(self.sqrt_sigma @ sigma @ self.sqrt_sigma)
+        tr_covmean = eigvals.clamp(min=0).sqrt().sum()
+        return (diff.dot(diff) + self.trace_sigma + sigma.trace() - 2 * tr_covmean).item()
+
+
+def calculate_frechet_distances(mu_real: np.ndarray, sigma_real: np.ndarray,
+                                stats_gen: Mapping[str, tuple], num_threads: Optional[int] = None) -> Dict[str, float]:
+    """
+    Frechet distance of the real statistics to the statistics (mu, sigma) of every key in stats_gen. The
+    decomposition of the real covariance is shared between all keys. If num_threads is given, torch uses that many
+    threads for the computation.
+    """
+    prev_num_threads = torch.get_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    try:
+        frechet_distance = FrechetDistance(mu_real, sigma_real)
+        return {key: frechet_distance(mu, sigma) for key, (mu, sigma) in stats_gen.items()}
+    finally:
+        torch.set_num_threads(prev_num_threads)
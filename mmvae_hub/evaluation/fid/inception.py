@@ -144,7 +144,7 @@ class InceptionV3(nn.Module):
         outp = []
         x = inp
 
-        if self.resize_input:
+        if self.resize_input and x.shape[-2:] != (299, 299):
             x = F.interpolate(x,
                               size=(299, 299),
                               mode='bilinear',
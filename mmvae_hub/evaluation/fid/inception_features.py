@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Mapping, Sequence, Dict
+
+import PIL.Image as Image
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from torch.nn.functional import adaptive_avg_pool2d
+from torch.utils.data import Dataset, DataLoader
+
+from mmvae_hub import log
+
+from mmvae_hub.evaluation.fid.inception import InceptionV3
+
+
+class FeatureStats:
+    """
+    Features of a group of images, accumulated batch by batch.
+    If keep_features is True, the features themselves are kept, e.g. for the PRD. If keep_moments is True, the sum and
+    the sum of outer products of the features are accumulated in float64, from which the mean and covariance are
+    computed without keeping the features. Otherwise, the mean and covariance are computed from the kept features.
+    """
+
+    def __init__(self, dims: int = 2048, keep_features: bool = True, keep_moments: bool = False):
+        assert keep_features or keep_moments, 'Either the features or their moments need to be kept.'
+        self.dims = dims
+        self.keep_features = keep_features
+        self.keep_moments = keep_moments
+        self.num_samples = 0
+        self.sum = np.zeros(dims, dtype=np.float64) if keep_moments else None
+        self.sum_outer = np.zeros((dims, dims), dtype=np.float64) if keep_moments else None
+        self._features = []
+
+    def update(self, feats: Tensor):
+        """Add a batch of features with shape (num_samples, dims)."""
+        feats = feats.detach().cpu()
+        self.num_samples += feats.shape[0]
+        if self.keep_features:
+            self._features.append(feats.numpy())
+        if self.keep_moments:
+            feats = feats.to(torch.float64)
+            self.sum += feats.sum(0).numpy()
+            self.sum_outer += (feats.T @ feats).numpy()
+
+    @property
+    def mean(self) -> np.ndarray:
+        if not self.keep_moments:
+            return np.mean(self.features, axis=0, dtype=np.float64)
+        return self.sum / self.num_samples
+
+    @property
+    def cov(self) -> np.ndarray:
+        """Unbiased covariance of the features, like np.cov(features, rowvar=False)."""
+        if not self.keep_moments:
+            return np.cov(self.features, rowvar=False)
+        mean = self.mean
+        return (self.sum_outer - self.num_samples * np.outer(mean, mean)) / (self.num_samples - 1)
+
+    @property
+    def features(self) -> np.ndarray:
+        assert self.keep_features, 'The features are only kept if keep_features is True.'
+        return np.concatenate(self._features) if self._features else np.empty((0, self.dims))
+
+    def save(self, path: Path):
+        """
+        Save the statistics to path. The file is written to a temporary file in the same directory and renamed, such
+        that processes that write the same file concurrently never leave or read a partially written file.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        empty = np.empty(0)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix='.tmp', delete=False) as f:
+            np.savez(f, num_samples=self.num_samples, dims=self.dims,
+                     sum=self.sum if self.keep_moments else empty,
+                     sum_outer=self.sum_outer if self.keep_moments else empty,
+                     features=self.features if self.keep_features else np.empty((0, self.dims)))
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'FeatureStats':
+        with np.load(path) as data:
+            # files without dims were written with the moments.
+            dims = int(data['dims']) if 'dims' in data else len(data['sum'])
+            feature_stats = cls(dims=dims, keep_features=len(data['features']) > 0,
+                                keep_moments=data['sum_outer'].size > 0)
+            feature_stats.num_samples = int(data['num_samples'])
+            if feature_stats.keep_moments:
+                feature_stats.sum = data['sum']
+                feature_stats.sum_outer = data['sum_outer']
+            if feature_stats.keep_features:
+                feature_stats._features = [data['features']]
+        return feature_stats
+
+
+def get_real_stats_path(dir_cache: Path, fingerprint: dict, first_batch: Tensor) -> Path:
+    """
+    Path of the cached statistics of real images in dir_cache. The file name is a hash of the fingerprint, which
+    describes the dataset, the number of samples and the Inception network, and of the content of the first batch
+    of images as they are passed to the Inception network, such that a change in the data or its preprocessing
+    gives a new file.
+    """
+    key = hashlib.sha256(repr(sorted(fingerprint.items())).encode())
+    first_batch = to_inception_input(first_batch).mul_(255).round_().to(device='cpu', dtype=torch.uint8)
+    key.update(repr(tuple(first_batch.shape)).encode())
+    key.update(first_batch.numpy().tobytes())
+    return Path(dir_cache) / f'{key.hexdigest()}.npz'
+
+
+def load_inception_model(flags, dims: int = 2048) -> InceptionV3:
+    block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[dims]
+    model = InceptionV3([block_idx], path_state_dict=flags.inception_state_dict)
+    return model.to(flags.device).eval()
+
+
+def to_inception_input(imgs: Tensor) -> Tensor:
+    """
+    Bring a batch of images with values in [0, 1] into the form in which they were read from the saved PNGs:
+    grayscale images are repeated to three channels and the values are quantized to 8 bits like in save_image.
+    Images that are given as uint8 are only scaled to [0, 1].
+    """
+    if imgs.shape[1] == 1:
+        imgs = imgs.expand(-1, 3, -1, -1)
+    if imgs.dtype == torch.uint8:
+        return imgs.float().div_(255)
+    return imgs.float().mul(255).add_(0.5).clamp_(0, 255).floor_().div_(255)
+
+
+def resize_for_inception(imgs: Tensor) -> Tensor:
+    """Resize a batch of images to the input size of the Inception network, like InceptionV3 with resize_input."""
+    if imgs.shape[-2:] == (299, 299):
+        return imgs
+    return F.interpolate(imgs, size=(299, 299), mode='bilinear', align_corners=False)
+
+
+@torch.no_grad()
+def get_inception_features(model: InceptionV3, imgs: Tensor, device: Optional[torch.device] = None) -> Tensor:
+    """Inception features of a batch of images, with shape (num_images, dims)."""
+    imgs = imgs.to(device, non_blocking=True) if device is not None else imgs
+    pred = model(resize_for_inception(to_inception_input(imgs)))[0]
+    # If model output is not scalar, apply global spatial average pooling.
+    if pred.shape[2] != 1 or pred.shape[3] != 1:
+        pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+    return pred.flatten(1)
+
+
+class ImageFilesDataset(Dataset):
+    """Decodes image files to uint8 tensors of shape (3, height, width)."""
+
+    def __init__(self, files: Sequence[str]):
+        self.files = list(files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        with Image.open(self.files[index]) as img:
+            return torch.from_numpy(np.array(img.convert('RGB'))).permute(2, 0, 1)
+
+
+def get_activations_from_files(model: InceptionV3, files: Mapping[str, Sequence[str]], device, batch_size: int = 50,
+                               dims: int = 2048, num_workers: int = 4) -> Dict[str, np.ndarray]:
+    """
+    Inception features of the image files of every group in files, e.g. of every subset, with shape
+    (num_images, dims).
+
+    All groups are processed in one sweep, so their images must have the same size. The images are decoded by
+    num_workers loader processes while the network runs, transferred to the device as uint8 and scaled and resized
+    there batch by batch. Like in get_activations, only a multiple of batch_size images is used of every group.
+    """
+    used_files = {}
+    for key, key_files in files.items():
+        if len(key_files) % batch_size != 0:
+            log.warning(f'The number of images of {key} is not a multiple of the batch size. '
+                        f'{len(key_files) % batch_size} images are going to be ignored.')
+        used_files[key] = list(key_files)[:len(key_files) // batch_size * batch_size]
+    all_files = [fn for key_files in used_files.values() for fn in key_files]
+
+    loader = DataLoader(ImageFilesDataset(all_files), batch_size=batch_size, num_workers=num_workers,
+                        pin_memory=torch.device(device).type == 'cuda')
+    pred_arr = np.empty((len(all_files), dims))
+    start = 0
+    for imgs in loader:
+        pred_arr[start:start + len(imgs)] = get_inception_features(model, imgs, device).cpu().numpy()
+        start += len(imgs)
+
+    acts = {}
+    start = 0
+    for key, key_files in used_files.items():
+        acts[key] = pred_arr[start:start + len(key_files)]
+        start += len(key_files)
+    return acts
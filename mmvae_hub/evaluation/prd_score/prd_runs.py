@@ -0,0 +1,86 @@
+"""Runs of the PRD computation for several evaluated distributions, in parallel processes.
+
+The embeddings are written once to memory-mapped files, from which every process reads them without copying.
+Every run clusters the union of the embeddings as in prd_score.compute_prd_from_embedding, and the independent runs of
+all distributions are distributed over the processes.
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Mapping, Optional, Dict, Tuple
+
+import numpy as np
+import sklearn.cluster
+
+from mmvae_hub.evaluation.prd_score import prd_score as prd
+
+
+def _subsample(data: np.ndarray, num_samples: Optional[int], rng: np.random.RandomState) -> np.ndarray:
+    if not num_samples or num_samples >= len(data):
+        return np.asarray(data, dtype=np.float64)
+    return np.asarray(data[np.sort(rng.choice(len(data), num_samples, replace=False))], dtype=np.float64)
+
+
+def _prd_run(eval_path: Path, ref_path: Path, seed: int, num_clusters: int, num_angles: int,
+             num_samples: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """One run of the PRD computation, with the clustering and the subsamples determined by seed."""
+    rng = np.random.RandomState(seed)
+    eval_data = _subsample(np.load(eval_path, mmap_mode='r'), num_samples, rng)
+    ref_data = _subsample(np.load(ref_path, mmap_mode='r'), num_samples, rng)
+
+    kmeans = sklearn.cluster.MiniBatchKMeans(n_clusters=num_clusters, n_init=10, random_state=rng)
+    labels = kmeans.fit(np.vstack([eval_data, ref_data])).labels_
+    eval_bins = np.histogram(labels[:len(eval_data)], bins=num_clusters, range=[0, num_clusters], density=True)[0]
+    ref_bins = np.histogram(labels[len(eval_data):], bins=num_clusters, range=[0, num_clusters], density=True)[0]
+    return prd.compute_prd(eval_bins, ref_bins, num_angles)
+
+
+def compute_prd_dict_from_embedding(eval_data: np.ndarray, ref_data: Mapping[str, np.ndarray], num_clusters=20,
+                                    num_angles=1001, num_runs=10, num_samples: Optional[int] = None,
+                                    num_workers: Optional[int] = None, seed: int = 0) \
+        -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Compute the PRD data of eval_data with respect to every reference distribution in ref_data, like
+    prd_score.compute_prd_from_embedding.
+
+    num_samples: If given, every run uses a random subsample of num_samples points of both distributions.
+    num_workers: Number of processes over which the runs are distributed. If None, the number of cpus is used.
+        If 0, the runs are computed in this process.
+    seed: The runs with the same index use the same seed for all reference distributions.
+
+    Returns for every key of ref_data the precision and recall, averaged over the runs, and the PRD score of every
+    run, i.e. the mean over the precision and recall values, from which the variance over the runs can be computed.
+    """
+    for key, data in ref_data.items():
+        if not num_samples and len(eval_data) != len(data):
+            raise ValueError(f'The number of points in eval_data {len(eval_data)} is not equal to the number of '
+                             f'points in the reference data {key} {len(data)}. Use num_samples to subsample them '
+                             f'to the same number.')
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        eval_path = Path(tmpdirname) / 'eval.npy'
+        np.save(eval_path, eval_data)
+        ref_paths = {}
+        for idx, (key, data) in enumerate(ref_data.items()):
+            ref_paths[key] = Path(tmpdirname) / f'ref_{idx}.npy'
+            np.save(ref_paths[key], data)
+
+        jobs = [(key, (eval_path, ref_path, seed + run, num_clusters, num_angles, num_samples))
+                for key, ref_path in ref_paths.items() for run in range(num_runs)]
+        if num_workers == 0:
+            results = [_prd_run(*args) for _, args in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=min(num_workers or os.cpu_count(), len(jobs))) as executor:
+                results = list(executor.map(_prd_run, *zip(*(args for _, args in jobs))))
+
+    runs = {key: [] for key in ref_data}
+    for (key, _), result in zip(jobs, results):
+        runs[key].append(result)
+    prd_data = {}
+    for key, key_runs in runs.items():
+        precisions = np.array([precision for precision, _ in key_runs])
+        recalls = np.array([recall for _, recall in key_runs])
+        scores = (precisions.mean(1) + recalls.mean(1)) / 2
+        prd_data[key] = (precisions.mean(0), recalls.mean(0), scores)
+    return prd_data
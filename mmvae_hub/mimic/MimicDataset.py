@@ -3,11 +3,13 @@ import json
 import os
 import pickle
 import random
+import tempfile
 import typing
 from collections import Counter, OrderedDict
 from collections import defaultdict
 from typing import List
 
+import PIL.Image as Image
 import numpy as np
 import pandas as pd
 import torch
@@ -15,6 +17,7 @@ from nltk.tokenize import word_tokenize
 from torch import Tensor
 from torch.utils.data import Dataset
 
+from mmvae_hub import log
 from mmvae_hub.mimic.utils import get_transform_img, filter_labels
 from mmvae_hub.utils import text
 
@@ -39,23 +42,53 @@ class Mimic(Dataset):
         fn_findings = os.path.join(dir_dataset, split + '_findings.csv')
         fn_labels = os.path.join(dir_dataset, split + '_labels.csv')
 
-        self.imgs_pa = torch.load(fn_img_pa)
-        self.imgs_lat = torch.load(fn_img_lat)
-        self.report_findings = pd.read_csv(fn_findings)['findings']
+        # the resized uint8 images are only used with the default image transformations.
+        self.use_resized_images = getattr(args, 'resized_images', False) and transform_images and not clf_training
+        if self.use_resized_images:
+            self.img_paths = {view: get_resized_images(fn_img, args.img_size)
+                              for view, fn_img in [('pa', fn_img_pa), ('lat', fn_img_lat)]}
+            # the memory maps are opened lazily in each dataloader worker.
+            self._imgs = {}
+        else:
+            self._imgs = {'pa': load_images(fn_img_pa), 'lat': load_images(fn_img_lat)}
+        self.report_findings = pd.read_csv(fn_findings)['findings'].to_numpy()
         self.labels = self._get_labels(fn_labels)
+        self.label_values, self.sample_idx = get_label_arrays(self.labels, self.str_labels)
         self._verify_dataset()
 
         self.report_findings_dataset = self.get_report_findings_dataset(dir_dataset)
         if not hasattr(self.args, 'vocab_size'):
             self.args.vocab_size = self.report_findings_dataset.vocab_size
 
-        if transform_images:
+        if self.use_resized_images:
+            self.transform_img = uint8_to_float
+        elif transform_images:
             self.transform_img = get_transform_img(args, args.feature_extractor_img, clf_training)
         else:
             self.transform_img = lambda x: x
 
         self.get_vec = self.get_word_text_vec
 
+    @property
+    def imgs_pa(self):
+        return self._get_imgs('pa')
+
+    @property
+    def imgs_lat(self):
+        return self._get_imgs('lat')
+
+    def _get_imgs(self, view: str):
+        if view not in self._imgs:
+            self._imgs[view] = np.load(self.img_paths[view], mmap_mode='r')
+        return self._imgs[view]
+
+    def __getstate__(self):
+        # do not pickle the memory maps with the dataset.
+        state = self.__dict__.copy()
+        if self.use_resized_images:
+            state['_imgs'] = {}
+        return state
+
     def _get_labels(self, fn_labels):
         labels = pd.read_csv(fn_labels)[self.str_labels].fillna(0)
         # filter out labels that contain the label "-1"
@@ -65,17 +98,17 @@ class Mimic(Dataset):
 
     def __getitem__(self, label_index) -> typing.Tuple[typing.Mapping[str, Tensor], Tensor]:
         try:
-            label = torch.from_numpy((self.labels.iloc[label_index][self.str_labels].values).astype(int)).float()
-            index = self.labels.iloc[label_index].name
+            label = torch.from_numpy(self.label_values[label_index])
+            index = self.sample_idx[label_index]
 
             sample = {}
             # get modalities
             if 'F' in self.mod_strs:
-                img_pa = self.imgs_pa[index, :, :]
+                img_pa = self.imgs_pa[index]
                 img_pa = self.transform_img(img_pa)
                 sample['PA'] = img_pa
             if 'L' in self.mod_strs:
-                img_lat = self.imgs_lat[index, :, :]
+                img_lat = self.imgs_lat[index]
                 img_lat = self.transform_img(img_lat)
                 sample['Lateral'] = img_lat
             if 'T' in self.mod_strs:
@@ -119,9 +152,9 @@ class Mimic(Dataset):
         labels = self.labels.values
         assert len(np.unique(labels)) == 2, \
             f'labels should contain 2 classes, but contains labels {np.unique(labels)}. Might need to remove -1 labels'
-        assert self.imgs_pa.shape[0] == self.imgs_lat.shape[0] == len(
-            self.report_findings), f'all modalities must have the same length. len(imgs_pa): {self.imgs_pa.shape[0]},' \
-                                   f' len(imgs_lat): {self.imgs_lat.shape[0]},' \
+        assert len(self.imgs_pa) == len(self.imgs_lat) == len(
+            self.report_findings), f'all modalities must have the same length. len(imgs_pa): {len(self.imgs_pa)},' \
+                                   f' len(imgs_lat): {len(self.imgs_lat)},' \
                                    f' len(report_findings): {len(self.report_findings)}'
 
 
@@ -144,10 +177,11 @@ class MimicText(Dataset):
 
         self.labels = pd.read_csv(fn_labels)[str_labels].fillna(0)
 
-        self.report_findings = pd.read_csv(fn_findings)['findings']
+        self.report_findings = pd.read_csv(fn_findings)['findings'].to_numpy()
         # need to filter out labels that contain the label "-1"
         self.labels = filter_labels(self.labels, which_labels=self.str_labels,
                                     undersample_dataset=args.undersample_dataset, split=split)
+        self.label_values, self.sample_idx = get_label_arrays(self.labels, self.str_labels)
 
         # need dataset for report_findings that contains the encodings.
         self.report_findings_dataset = self.get_report_findings_dataset(dir_dataset)
@@ -162,8 +196,8 @@ class MimicText(Dataset):
 
     def __getitem__(self, label_index):
         try:
-            label = torch.from_numpy((self.labels.iloc[label_index][self.str_labels].values).astype(int)).float()
-            index = self.labels.iloc[label_index].name
+            label = torch.from_numpy(self.label_values[label_index])
+            index = self.sample_idx[label_index]
             # get modalities
             text_vec = self.get_vec(index)
 
@@ -198,6 +232,112 @@ class MimicText(Dataset):
         return report_findings_dataset
 
 
+class Uint8Images:
+    """
+    Images of an uint8 array of shape (num_images, 1, height, width), as written by CreateTensorDataset, that are
+    converted to float tensors of shape (height, width) on access, like the images of the float tensor datasets.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # the memory map is opened lazily in each dataloader worker.
+        self._imgs = None
+
+    @property
+    def imgs(self) -> np.ndarray:
+        if self._imgs is None:
+            self._imgs = np.load(self.path, mmap_mode='r')
+        return self._imgs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_imgs'] = None
+        return state
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, index) -> Tensor:
+        return uint8_to_float(self.imgs[index, 0])
+
+
+def find_uint8_images(fn_img: str) -> typing.Optional[str]:
+    """Path of the uint8 images of fn_img with the largest image size, or None if there are none."""
+    stem = os.path.basename(fn_img).replace('.pt', '_uint8_')
+    sizes = [int(fn[len(stem):-len('.npy')]) for fn in os.listdir(os.path.dirname(fn_img))
+             if fn.startswith(stem) and fn.endswith('.npy') and fn[len(stem):-len('.npy')].isdigit()]
+    return fn_img.replace('.pt', f'_uint8_{max(sizes)}.npy') if sizes else None
+
+
+def load_images(fn_img: str):
+    """
+    Load the images of fn_img as a sequence of float tensors of shape (height, width) with values in [0, 1].
+    If the float tensor file does not exist, as for datasets created with CreateTensorDataset, the uint8 images are
+    used instead.
+    """
+    if os.path.exists(fn_img):
+        return torch.load(fn_img)
+    uint8_path = find_uint8_images(fn_img)
+    if uint8_path is None:
+        raise FileNotFoundError(f'Neither {fn_img} nor uint8 images of it were found.')
+    return Uint8Images(uint8_path)
+
+
+def make_temporary_path(path: str) -> str:
+    """
+    Create a unique temporary file in the directory of path, to which path is written before it is moved into place
+    with os.replace, such that interrupted or concurrent runs never leave or read a partially written file.
+    """
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path), suffix='.tmp',
+                                     delete=False) as f:
+        return f.name
+
+
+def get_resized_images(fn_img: str, img_size: int) -> str:
+    """
+    Return the path to the images of fn_img resized to img_size, as uint8 array of shape (num_images, 1, img_size,
+    img_size). The array is created on first use, from the images that load_images finds.
+
+    The images are converted like with the transformations of get_transform_img: they are quantized to uint8 as with
+    ToPILImage and resized with bicubic interpolation, such that uint8_to_float gives the same tensors.
+    """
+    out_path = fn_img.replace('.pt', f'_uint8_{img_size}.npy')
+    if os.path.exists(out_path):
+        return out_path
+
+    log.info(f'Creating the resized images {out_path}. This may take a while.')
+    imgs = load_images(fn_img)
+    # write to a unique temporary file first, such that interrupted or concurrent conversions do not leave a broken
+    # file.
+    tmp_path = make_temporary_path(out_path)
+    try:
+        resized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                            shape=(len(imgs), 1, img_size, img_size))
+        for idx in range(len(imgs)):
+            img = Image.fromarray(imgs[idx].mul(255).byte().numpy(), mode='L')
+            resized[idx, 0] = np.asarray(img.resize((img_size, img_size), Image.BICUBIC))
+        resized.flush()
+        del resized
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return out_path
+
+
+def uint8_to_float(img: np.ndarray) -> Tensor:
+    """Convert a uint8 image to a float tensor in [0, 1], like ToTensor."""
+    return torch.from_numpy(np.asarray(img, dtype=np.float32)).div_(255)
+
+
+def get_label_arrays(labels: pd.DataFrame, str_labels: List[str]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert the filtered labels to a float32 label matrix of shape (num_samples, num_labels) and the array of the
+    indices of the samples in the unfiltered split, such that a sample can be accessed without pandas lookups.
+    """
+    return np.array(labels[str_labels], dtype=np.float32), np.array(labels.index)
+
+
 class OrderedCounter(Counter, OrderedDict):
     """
     Counter that remembers the order elements are first encountered.
@@ -211,13 +351,16 @@ class OrderedCounter(Counter, OrderedDict):
 
 
 def to_tensor(data):
-    return torch.Tensor(data)
+    return torch.tensor(data, dtype=torch.float32)
 
 
 class MimicSentences(Dataset):
     """
     Modified version of https://github.com/iffsid/mmvae/blob/public/src/datasets.py
     Word encoding for mimic report findings
+
+    The word indices of the reports are stored as one int32 matrix of shape (num_reports, max_sequence_length)
+    together with the lengths of the reports, next to the json data file. The matrix is memory-mapped.
     """
 
     def __init__(self, max_squence_len: int, data_dir: str, findings: pd.DataFrame, split: str, transform=False,
@@ -240,6 +383,9 @@ class MimicSentences(Dataset):
         os.makedirs(self.gen_dir, exist_ok=True)
         self.data_file = 'mimic.{}.s{}'.format(split, self.max_sequence_length)
         self.vocab_file = 'mimic.vocab'
+        self.idx_path = os.path.join(self.gen_dir, self.data_file + '.idx.npy')
+        self.lengths_path = os.path.join(self.gen_dir, self.data_file + '.lengths.npy')
+        self._idx = None
 
         if not os.path.exists(os.path.join(self.gen_dir, self.data_file)):
             print("Data file not found for {} split at {}. Creating new... (this may take a while)".
@@ -250,17 +396,31 @@ class MimicSentences(Dataset):
             self._load_data()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.lengths)
 
     def __getitem__(self, idx: int):
         """
         Returns tensors/list of length len_sentence
         """
-        sent = self.data[str(idx)]['idx']
+        sent = self.idx[idx]
         if self.transform is not None:
             sent = self.transform(sent)
         return sent
 
+    @property
+    def idx(self) -> np.ndarray:
+        """Word indices of all reports, with shape (num_reports, max_sequence_length)."""
+        if self._idx is None:
+            # the memory map is opened lazily in each dataloader worker.
+            self._idx = np.load(self.idx_path, mmap_mode='r')
+        return self._idx
+
+    def __getstate__(self):
+        # do not pickle the memory map with the dataset.
+        state = self.__dict__.copy()
+        state['_idx'] = None
+        return state
+
     @property
     def vocab_size(self):
         return len(self.w2i)
@@ -284,12 +444,36 @@ class MimicSentences(Dataset):
         return self.i2w
 
     def _load_data(self, vocab=True):
-        with open(os.path.join(self.gen_dir, self.data_file), 'rb') as file:
-            self.data = json.load(file)
+        if not (os.path.exists(self.idx_path) and os.path.exists(self.lengths_path)):
+            self._pack_data()
+        self.lengths = np.load(self.lengths_path)
+        self._idx = None
 
         if vocab:
             self._load_vocab()
 
+    def _pack_data(self):
+        """Convert the json data file to the index matrix and the length vector."""
+        with open(os.path.join(self.gen_dir, self.data_file), 'rb') as file:
+            data = json.load(file)
+
+        idx = np.array([data[str(i)]['idx'] for i in range(len(data))], dtype=np.int32) \
+            .reshape(len(data), self.max_sequence_length)
+        lengths = np.array([data[str(i)]['length'] for i in range(len(data))], dtype=np.int32)
+
+        # write to unique temporary files first, such that interrupted or concurrent conversions do not leave a
+        # broken file.
+        for path, array in [(self.lengths_path, lengths), (self.idx_path, idx)]:
+            tmp_path = make_temporary_path(path)
+            try:
+                # np.save appends .npy to file names without it, so the array is written through the file object.
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
     def _load_vocab(self):
         if not os.path.exists(os.path.join(self.gen_dir, self.vocab_file)):
             self._create_vocab()
@@ -330,6 +514,7 @@ class MimicSentences(Dataset):
             data = json.dumps(data, ensure_ascii=False)
             data_file.write(data.encode('utf8', 'replace'))
 
+        self._pack_data()
         self._load_data(vocab=False)
 
     def _tokenize_raw_data(self) -> List:
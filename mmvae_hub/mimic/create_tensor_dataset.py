@@ -1,36 +1,78 @@
 import os
-import shutil
+import time
 import zipfile
-from glob import glob
-from typing import Tuple
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Tuple, Optional
+
 import PIL.Image as Image
 import numpy as np
 import pandas as pd
-import torch
-from torchvision import transforms
-from tqdm import tqdm
-from mimic import log
 
-trans1 = transforms.ToTensor()
+from mmvae_hub import log
+
+# state of the studies in the progress file
+PENDING, MISSING, FOUND = -1, 0, 1
+
+
+def center_crop_and_resize(img: Image.Image, img_size: Tuple) -> Image.Image:
+    width, height = img.size  # Get dimensions
+    new_width = min(width, height)
+    new_height = min(width, height)
+    left = (width - new_width) / 2
+    top = (height - new_height) / 2
+    right = (width + new_width) / 2
+    bottom = (height + new_height) / 2
+    # Crop the center of the image
+    img_crop = img.crop((left, top, right, bottom))
+    return img_crop.resize(img_size, Image.LANCZOS)
+
+
+def load_resized_image(fn_img: str, img_size: Tuple) -> np.ndarray:
+    """Decode a grayscale image, center crop it and resize it to img_size if needed."""
+    with Image.open(fn_img) as img:
+        img = img.convert('L')
+        if img.size != tuple(img_size):
+            img = center_crop_and_resize(img, img_size)
+        return np.asarray(img)
+
+
+def load_study_images(fns: Tuple[str, str], img_size: Tuple) -> Optional[np.ndarray]:
+    """
+    Load the pa and the lateral image of a study as uint8 array of shape (2, *img_size).
+    Returns None if one of the images is not found.
+    """
+    try:
+        return np.stack([load_resized_image(fn, img_size) for fn in fns])
+    except FileNotFoundError as e:
+        log.info(e)
+        return None
 
 
 class CreateTensorDataset:
     """
-    Makes a tensor dataset of the Mimic-cxr dataset by first resizing the image to the wanted image size
-    and then saving them as torch tensors.
-    If the resized images are found as a zipped directory, they are extracted to the $TMPDIR folder and are then used to
-    create the tensor dataset.
+    Makes a tensor dataset of the Mimic-cxr dataset by resizing the images to the wanted image size and saving them
+    as uint8 arrays of shape (num_samples, 1, *img_size), in the format of MimicDataset.get_resized_images.
+    MimicDataset.load_images reads them for the paths that do not use the resized images, e.g. classifier training.
+
+    The images are decoded and resized by a pool of worker processes and written to memory-mapped files, such that
+    a split does not need to fit into memory. The progress is saved with the images, such that an interrupted run
+    continues where it stopped.
+    If resized images are found in dir_base_resize, or as a zipped directory, they are used instead of the original
+    images.
     """
 
     def __init__(self, dir_base_resize: str, dir_mimic: str, dir_out: str, img_size: Tuple,
-                 dir_base_resized_compressed: str = '', max_it: int = None):
+                 dir_base_resized_compressed: str = '', max_it: int = None, num_workers: Optional[int] = None,
+                 chunk_size: int = 1024):
         """
         dir_out: where the tensor dataset will be saved
         dir_base_resize: where the resized image are saved
         dir_base_resized_compressed (optional): where the compressed resized images are. It is recommended to compress the resized
         images after their usage and delete the non-compressed ones to save space.
         max_it: (optional) maximum iterations. Use this for testing only. if None (default): do all
+        num_workers: number of processes that load the images. If None, the number of cpus is used.
+        chunk_size: number of studies that are loaded before they are written to the output and the progress is saved.
         """
         self.dir_base_orig = os.path.join(dir_mimic, 'files')
         self.dir_base_resize = dir_base_resize
@@ -46,7 +88,9 @@ class CreateTensorDataset:
         self.df_eval = pd.read_csv(self.fn_eval)
         self.df_test = pd.read_csv(self.fn_test)
         self.max_it = max_it
-        self.img_size = img_size
+        self.img_size = tuple(img_size)
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
         self.str_labels = ['Atelectasis', 'Cardiomegaly',
                            'Consolidation', 'Edema', 'Enlarged Cardiomediastinum', 'Fracture',
                            'Lung Lesion', 'Lung Opacity', 'Pleural Effusion',
@@ -58,175 +102,126 @@ class CreateTensorDataset:
         for split, df in zip(splits, dataframes):
             self.create_dataset(df, split=split)
 
-    def create_dataset(self, df: pd.DataFrame, split: str):
-        """
-        dir_out: where the tensor dataset should be created
-        """
-        dir_src = self.dir_base_resize  # directory of the resized images
-
-        if not os.path.exists(dir_src):
-            if os.path.exists(self.dir_resized_compressed):
-                log.info(f'compressed images are found and are decompressed to {dir_src}')
-                os.mkdir(dir_src)
-                with zipfile.ZipFile(self.dir_resized_compressed, 'r') as zip_ref:
-                    zip_ref.extractall(dir_src)
-            else:
-                log.info(
-                    f'directory of resized images {dir_src} does not exist and needs to be created. '
-                    f'This may take a while.')
-                _ = self._resize_all()
-                if self.dir_base_resized_compressed and not os.path.exists(self.dir_resized_compressed):
-                    log.info('zipping resized images folder {} to {} -> {}'.format(dir_src,
-                                                                                   self.dir_resized_compressed.split(
-                                                                                       '.')[0],
-                                                                                   self.dir_resized_compressed))
-
-                    shutil.make_archive(self.dir_resized_compressed.replace('.zip', ''), 'zip', dir_src,
-                                        verbose=True)
-                    assert os.path.exists(
-                        self.dir_resized_compressed), 'path does not exist: {}. \n {}'.format(
-                        self.dir_resized_compressed, os.listdir(self.dir_base_resized_compressed))
+    def get_dir_src(self) -> str:
+        """Directory of the images: the resized images if they exist, else the original images."""
+        if not os.path.exists(self.dir_base_resize) and os.path.exists(self.dir_resized_compressed):
+            log.info(f'compressed images are found and are decompressed to {self.dir_base_resize}')
+            os.mkdir(self.dir_base_resize)
+            with zipfile.ZipFile(self.dir_resized_compressed, 'r') as zip_ref:
+                zip_ref.extractall(self.dir_base_resize)
+
+        if os.path.exists(self.dir_base_resize):
+            return self.dir_base_resize
+        log.info(f'directory of resized images {self.dir_base_resize} does not exist, the original images are '
+                 f'resized.')
+        return self.dir_base_orig
+
+    def get_out_paths(self, split: str) -> Tuple[Path, Path, Path]:
+        """Paths of the pa images, the lateral images and the progress of a split."""
+        dir_out = Path(self.dir_out)
+        return (dir_out / f'{split}_pa_uint8_{self.img_size[0]}.npy',
+                dir_out / f'{split}_lat_uint8_{self.img_size[0]}.npy',
+                dir_out / f'{split}_progress.npy')
 
+    def create_dataset(self, df: pd.DataFrame, split: str):
         df['uid'] = df['pa_dicom_id'] + '_' + df['lat_dicom_id']
         assert df['uid'].duplicated().sum() == 0, f'The uid of the dataframe must be unique, ' \
                                                   f'{df["uid"].duplicated().sum()} duplicates were found.'
-        dir_out = self.dir_out
-        num_samples = self.max_it or df.shape[0]
-        imgs_pa = torch.Tensor(num_samples, self.img_size[0], self.img_size[0])
-        imgs_lat = torch.Tensor(num_samples, self.img_size[0], self.img_size[0])
-        ind = torch.Tensor(num_samples)  # tensor that indicates the images that were found
-
-        labels = df.filter([*self.str_labels, 'uid'], axis=1)
-        findings = df.filter(['findings', 'uid'])
-        impressions = df.filter(['impression', 'uid'])
-        for index, row in tqdm(df.iterrows(), postfix=split):
-            if self.max_it and index >= self.max_it:
-                break
-            # load lat and pa image for each row
-            s_id = row['study_id']
-            p_id = row['subject_id']
-            pa_id = row['pa_dicom_id']
-            lat_id = row['lat_dicom_id']
-            p_supdir = 'p' + str(p_id)[:2]
-            p_dir = 'p' + str(p_id)
-            s_dir = 's' + str(s_id)
-            dir_img = os.path.join(dir_src, p_supdir, p_dir, s_dir)
-            fn_pa_src = os.path.join(dir_img, str(pa_id) + '.jpg')
-            fn_lat_src = os.path.join(dir_img, str(lat_id) + '.jpg')
-            ind[index] = 0  # 0 indicates that the image was not found
-
-            try:
-                img_pa = self._load_image(fn_pa_src)
-            except FileNotFoundError as e:
-                log.info(e)
-                findings = findings.drop(index, axis=0)
-                impressions = impressions.drop(index, axis=0)
-                labels = labels.drop(index, axis=0)
-                ind[index] = 0
-                continue
-            try:
-                img_lat = self._load_image(fn_lat_src)
-            except FileNotFoundError as e:
-                log.info(e)
-                findings = findings.drop(index, axis=0)
-                impressions = impressions.drop(index, axis=0)
-                labels = labels.drop(index, axis=0)
-                ind[index] = 0
-                continue
-            ind[index] = 1  # 1 indicates that the image was found
-            imgs_pa[index, :, :] = img_pa
-            imgs_lat[index, :, :] = img_lat
-        log.info(imgs_pa.shape)
-        mask = ind > 0
-        if self.max_it is None:
-            # only do this if not test run
-            imgs_pa = imgs_pa[mask, :, :]
-            imgs_lat = imgs_lat[mask, :, :]
-            log.info(imgs_pa.shape)
-
-        fn_pa_out = os.path.join(dir_out, split + '_pa.pt')
-        fn_lat_out = os.path.join(dir_out, split + '_lat.pt')
-        fn_findings_out = os.path.join(dir_out, split + '_findings.csv')
-        fn_impressions_out = os.path.join(dir_out, split + '_impressions.csv')
-        fn_labels_out = os.path.join(dir_out, split + '_labels.csv')
-        torch.save(imgs_pa, fn_pa_out)
-        torch.save(imgs_lat, fn_lat_out)
-        log.info(findings.shape)
-        findings[:self.max_it].to_csv(fn_findings_out)
-        impressions[:self.max_it].to_csv(fn_impressions_out)
+        if self.max_it:
+            df = df[:self.max_it]
+
+        fn_pa_out, fn_lat_out, fn_progress = self.get_out_paths(split)
+        if fn_pa_out.exists() and fn_lat_out.exists() and not fn_progress.exists():
+            log.info(f'{split} split already exists under {self.dir_out}.')
+            return
+
+        # load the images into unfiltered memory-mapped arrays, from which the studies that are found are copied to
+        # the outputs.
+        staging_paths = [fn_pa_out.with_suffix('.staging.npy'), fn_lat_out.with_suffix('.staging.npy')]
+        num_samples = len(df)
+        if fn_progress.exists():
+            progress = np.load(fn_progress, mmap_mode='r+')
+            imgs = [np.load(path, mmap_mode='r+') for path in staging_paths]
+            assert len(progress) == num_samples, f'{fn_progress} does not match the {split} split.'
+        else:
+            imgs = [np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(num_samples, *self.img_size))
+                    for path in staging_paths]
+            progress = np.lib.format.open_memmap(fn_progress, mode='w+', dtype=np.int8, shape=(num_samples,))
+            progress[:] = PENDING
+            progress.flush()
+
+        self._load_images(df, split, imgs, progress)
+
+        mask = np.asarray(progress) == FOUND
+        log.info(f'{split}: {mask.sum()} out of {num_samples} studies were found.')
+        for staging_img, fn_out in zip(imgs, [fn_pa_out, fn_lat_out]):
+            self._copy_found(staging_img, mask, fn_out)
+        del imgs, progress
+
+        fn_findings_out = os.path.join(self.dir_out, split + '_findings.csv')
+        fn_impressions_out = os.path.join(self.dir_out, split + '_impressions.csv')
+        fn_labels_out = os.path.join(self.dir_out, split + '_labels.csv')
+        df_found = df[mask]
+        df_found.filter(['findings', 'uid']).to_csv(fn_findings_out)
+        df_found.filter(['impression', 'uid']).to_csv(fn_impressions_out)
         # create binary labels
-        labels = self.create_binary_labels(labels)
-        labels[:self.max_it].to_csv(fn_labels_out)
-
-        assert imgs_pa.shape[0] == imgs_lat.shape[0] == len(labels[:self.max_it]) == len(findings[:self.max_it]), \
-            f'all modalities must have the same length. len(imgs_pa): {imgs_pa.shape[0]}, ' \
-            f'len(imgs_lat): {imgs_lat.shape[0]}, len(labels): {len(labels[:self.max_it])}, ' \
-            f'len(report_findings): {len(findings[:self.max_it])}'
+        self.create_binary_labels(df_found.filter([*self.str_labels, 'uid'], axis=1)).to_csv(fn_labels_out)
+
+        for path in [*staging_paths, fn_progress]:
+            path.unlink()
+
+    def _load_images(self, df: pd.DataFrame, split: str, imgs: Tuple[np.ndarray, np.ndarray], progress: np.ndarray):
+        """Load the images of all pending studies with a process pool and write them to imgs."""
+        dir_src = self.get_dir_src()
+        dir_imgs = [os.path.join(dir_src, 'p' + str(p_id)[:2], 'p' + str(p_id), 's' + str(s_id))
+                    for p_id, s_id in zip(df['subject_id'], df['study_id'])]
+        fns = [(os.path.join(dir_img, str(pa_id) + '.jpg'), os.path.join(dir_img, str(lat_id) + '.jpg'))
+               for dir_img, pa_id, lat_id in zip(dir_imgs, df['pa_dicom_id'], df['lat_dicom_id'])]
+
+        pending = np.flatnonzero(np.asarray(progress) == PENDING)
+        if len(pending) < len(progress):
+            log.info(f'{split}: resuming with {len(pending)} out of {len(progress)} studies left.')
+
+        start_time = time.time()
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            for chunk_start in range(0, len(pending), self.chunk_size):
+                chunk = pending[chunk_start:chunk_start + self.chunk_size]
+                study_imgs = executor.map(load_study_images, [fns[idx] for idx in chunk],
+                                          [self.img_size] * len(chunk), chunksize=16)
+                states = np.full(len(chunk), MISSING, dtype=np.int8)
+                for i, (idx, study_img) in enumerate(zip(chunk, study_imgs)):
+                    if study_img is not None:
+                        imgs[0][idx], imgs[1][idx] = study_img
+                        states[i] = FOUND
+
+                # the images are flushed before the progress, such that the progress never marks lost images.
+                for img in imgs:
+                    img.flush()
+                progress[chunk] = states
+                progress.flush()
+
+                num_done = chunk_start + len(chunk)
+                log.info(f'{split}: {num_done}/{len(pending)} studies, '
+                         f'{num_done / (time.time() - start_time):.1f} studies/s')
+
+    def _copy_found(self, staging_img: np.ndarray, mask: np.ndarray, fn_out: Path):
+        """Copy the images of the found studies from staging_img to fn_out, with shape (num_found, 1, *img_size)."""
+        found = np.flatnonzero(mask)
+        tmp_path = fn_out.with_suffix('.tmp.npy')
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(found), 1, *self.img_size))
+        for start in range(0, len(found), self.chunk_size):
+            out[start:start + self.chunk_size, 0] = staging_img[found[start:start + self.chunk_size]]
+        out.flush()
+        del out
+        tmp_path.rename(fn_out)
 
     def create_binary_labels(self, labels_df):
         """
         Adds the label 'Finding' to the labels dataframe. This label is one if any of the other labels is 1.
         """
-        for idx, row in labels_df.iterrows():
-            labels_df.at[idx, 'Finding'] = int(row[[*self.str_labels]].sum() > 0)
+        labels_df['Finding'] = (labels_df[[*self.str_labels]].sum(axis=1) > 0).astype(float)
         return labels_df
 
-    def _fast_scandir(self, dirname: str):
-        subfolders = [f.path for f in os.scandir(dirname) if f.is_dir()]
-        for dirname in list(subfolders):
-            subfolders.extend(self._fast_scandir(dirname))
-        return subfolders
-
-    def _center_crop_and_resize(self, img):
-        width, height = img.size  # Get dimensions
-        new_width = min(width, height)
-        new_height = min(width, height)
-        left = (width - new_width) / 2
-        top = (height - new_height) / 2
-        right = (width + new_width) / 2
-        bottom = (height + new_height) / 2
-        # Crop the center of the image
-        img_crop = img.crop((left, top, right, bottom))
-        return img_crop.resize(self.img_size, Image.ANTIALIAS)
-
-    def _compute_total_folders(self, path: str):
-        return len(list(os.walk(path)))
-
-    def _resize_all(self):
-        """
-        Walks through the directories of original mimic data and resizes the images to self.img_size
-        """
-        dir_src_base = self.dir_base_orig
-        log.info('computing total folders')
-        total_folders = self._compute_total_folders(dir_src_base) if self.max_it is None else None
-        count_imgs = 0
-        for dirName, subdirList, fileList in tqdm(os.walk(dir_src_base), total=total_folders, postfix='resize'):
-            f_imgs = glob(os.path.join(dirName, '*.jpg'))
-            if len(f_imgs) > 0:
-                d_new = os.path.join(self.dir_base_resize, '/'.join(dirName.split('/')[-3:]))
-                if not os.path.exists(d_new):
-                    os.makedirs(d_new)
-                for f in f_imgs:
-                    if self.max_it and count_imgs >= self.max_it:
-                        return True
-                    n_img = f.split('/')[-1]
-                    f_new = os.path.join(d_new, n_img)
-                    if not os.path.exists(f_new):
-                        try:
-                            img_src = Image.open(f)
-                            img_new = self._center_crop_and_resize(img_src)
-                            img_new.save(f_new, "JPEG")
-                            img_src.close()
-                            img_new.close()
-                        except OSError:
-                            log.info('file could not be opened...')
-                    count_imgs += 1
-        return True
-
-    def _load_image(self, fn_img):
-        img = Image.open(fn_img)
-        return trans1(img)
-
 
 if __name__ == '__main__':
     # img_size = (256, 256)
@@ -23,6 +23,10 @@ parser.add_argument('--weighted_sampler', type=str2bool, default=False,
 parser.add_argument('--binary_labels', type=str2bool, default=False,
                     help="If True, label 'Finding' with classes 0 and 1 will be used for the classification evaluation.")
 parser.add_argument('--num_mods', type=int, default=3, help="This flag does not do anything yet.")
+parser.add_argument('--resized_images', type=str2bool, default=True,
+                    help="If True, the images are resized once per img_size and stored as a memory-mapped uint8 array "
+                         "that is shared by all dataloader workers, instead of being loaded by every worker and "
+                         "resized at every access.")
 
 # Text Dependent
 parser.add_argument('--len_sequence', type=int, default=128, help="length of sequence")
@@ -5,16 +5,22 @@ from modun.download_utils import download_zip_from_url
 import gzip
 import os
 import os.path
+import random
 import sys
+import tempfile
 import warnings
+from typing import Tuple
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 from PIL import Image
 from modun.file_io import json2dict
+from torch.utils.data.dataloader import default_collate
 
-from mmvae_hub.utils.text import create_text_from_label_mnist
+from mmvae_hub import log
+from mmvae_hub.utils.text import create_text_from_label_mnist, get_text_codec
 
 digit_text_german = ['null', 'eins', 'zwei', 'drei', 'vier', 'fuenf', 'sechs', 'sieben', 'acht', 'neun'];
 digit_text_english = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine'];
@@ -216,6 +222,9 @@ class SVHNMNIST(VisionDataset):
             print('targets do not match...exit')
             sys.exit();
 
+        if self.flags.text_indices:
+            text_target = text_target.argmax(-1).to(torch.int8)
+
         if self.target_transform is not None:
             target = self.target_transform(target_mnist)
         else:
@@ -262,6 +271,156 @@ class SVHNMNIST(VisionDataset):
         return "Split: {}".format("Train" if self.train is True else "Test")
 
 
+def load_svhn(dir_svhn: str, data_file: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Load the images and labels of a SVHN split as uint8 tensor of shape (N, 3, 32, 32) and long tensor of shape (N,).
+    The .mat file is converted once and the tensors are cached next to it.
+    """
+    cache_path = Path(dir_svhn) / f'{Path(data_file).stem}.pt'
+    if cache_path.exists():
+        return torch.load(cache_path)
+
+    import scipy.io as sio
+
+    log.info(f'Converting {Path(dir_svhn) / data_file} to {cache_path}.')
+    loaded_mat = sio.loadmat(os.path.join(dir_svhn, data_file))
+    images = torch.from_numpy(np.ascontiguousarray(np.transpose(loaded_mat['X'], (3, 2, 0, 1))))
+    labels = torch.from_numpy(loaded_mat['y'].astype(np.int64).squeeze())
+    # the svhn dataset assigns the class label "10" to the digit 0
+    labels[labels == 10] = 0
+
+    _save_cache((images, labels), cache_path)
+    return images, labels
+
+
+def load_pairing(cache_path: Path, labels_mnist: torch.Tensor, labels_svhn: torch.Tensor,
+                 data_multiplications: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Pair the MNIST and SVHN samples by label with rand_match_on_idx. The pairing is computed once for every
+    split and number of data multiplications and cached to cache_path.
+    """
+    if cache_path.exists():
+        return torch.load(cache_path)
+
+    mnist_l, mnist_li = labels_mnist.sort()
+    svhn_l, svhn_li = labels_svhn.sort()
+    pairing = rand_match_on_idx(mnist_l, mnist_li, svhn_l, svhn_li, max_d=10000, dm=data_multiplications)
+
+    _save_cache(pairing, cache_path)
+    return pairing
+
+
+def _save_cache(obj, cache_path: Path):
+    # write to a unique temporary file first, such that interrupted or concurrent runs do not leave a broken cache.
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent, prefix=cache_path.name, suffix='.tmp',
+                                         delete=False) as f:
+            tmp_path = f.name
+            torch.save(obj, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.warning(f'Could not save the cache to {cache_path}: {e}')
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_text_table(len_sequence: int, alphabet: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Character indices of all texts that create_text_from_label_mnist can produce: for every digit label, the name of
+    the digit at every possible start position in a sequence of spaces.
+
+    Returns the int8 table of shape (10, max_num_starts, len_sequence) and the number of start positions per label.
+    """
+    num_starts = torch.tensor([len_sequence - len(text) for text in digit_text_english])
+    assert num_starts.min() > 0, f'len_sequence={len_sequence} is too short for the digit names.'
+
+    # the start positions that are not possible for a label are left as spaces.
+    texts = [(' ' * start + text).ljust(len_sequence) for text in digit_text_english
+             for start in range(int(num_starts.max()))]
+    table = get_text_codec(alphabet).encode(texts, len_sequence).to(torch.int8)
+    return table.view(10, int(num_starts.max()), len_sequence), num_starts
+
+
+class TensorSVHNMNIST(VisionDataset):
+    """
+    MNIST-SVHN-Text dataset that keeps the images as uint8 tensors and the texts as int8 character indices.
+
+    A sample is a set of tensor slices, the conversion of the images to floats in [0, 1] and the one-hot encoding of
+    the texts is done for the whole batch in collate_fn. This gives the same batches as SVHNMNIST, without the
+    conversion of every sample to a PIL image.
+    The SVHN tensors and the pairing of the samples are cached to disk.
+    """
+
+    def __init__(self, flags, alphabet, train=True, target_transform=None):
+        super().__init__(flags.dir_data)
+        self.dataset = 'MNIST_SVHN'
+        self.len_sequence = flags.len_sequence
+        self.text_indices = flags.text_indices
+        self.target_transform = target_transform
+        self.train = train
+        self.alphabet = alphabet
+
+        self.dir_svhn = os.path.join(self.root, 'SVHN')
+        processed_folder = Path(self.root) / 'MNIST' / 'processed'
+        split = 'train' if train else 'test'
+        data_file_mnist = SVHNMNIST.training_file_mnist if train else SVHNMNIST.test_file_mnist
+        data_file_svhn = SVHNMNIST.training_file_svhn if train else SVHNMNIST.test_file_svhn
+
+        if not (processed_folder / data_file_mnist).exists():
+            download_zip_from_url(
+                url='https://www.dropbox.com/sh/lx8669lyok9ois6/AADMhr3EluBXJyZnV1_lYntTa/data_mnistsvhntext.zip?dl=1',
+                dest_folder=processed_folder.parent.parent)
+            assert (processed_folder / data_file_mnist).exists(), 'Dataset MNIST not found.'
+
+        self.data_svhn, self.labels_svhn = load_svhn(self.dir_svhn, data_file_svhn)
+        data_mnist, self.labels_mnist = torch.load(processed_folder / data_file_mnist)
+        # add the channel dimension
+        self.data_mnist = data_mnist.unsqueeze(1)
+
+        self.mnist_idx, self.svhn_idx = load_pairing(
+            Path(self.dir_svhn) / f'{split}-ms-idx-dm{flags.data_multiplications}.pt', self.labels_mnist,
+            self.labels_svhn, flags.data_multiplications)
+        assert torch.equal(self.labels_mnist[self.mnist_idx], self.labels_svhn[self.svhn_idx]), \
+            'The labels of the paired samples do not match.'
+
+        self.text_table, self.num_starts = get_text_table(self.len_sequence, self.alphabet)
+
+    def __getitem__(self, index):
+        """
+        Returns a tuple (batch, target) where batch is a dict with the uint8 images of MNIST and SVHN and the int8
+        character indices of the text.
+        """
+        idx_mnist = self.mnist_idx[index]
+        target = int(self.labels_mnist[idx_mnist])
+        # the digit name is placed at a random position, as in create_text_from_label_mnist.
+        text = self.text_table[target, random.randint(0, int(self.num_starts[target]) - 1)]
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        batch = {'mnist': self.data_mnist[idx_mnist], 'svhn': self.data_svhn[self.svhn_idx[index]], 'text': text}
+        return batch, target
+
+    def __len__(self):
+        return len(self.mnist_idx)
+
+    def batch_transform(self, batch: dict) -> dict:
+        """
+        Convert the images to floats in [0, 1] and, unless the texts are used as character indices, one-hot encode
+        the texts. Works for a batch or a single sample.
+        """
+        text = batch['text'] if self.text_indices else F.one_hot(batch['text'].long(), len(self.alphabet)).float()
+        return {'mnist': batch['mnist'].float().div_(255), 'svhn': batch['svhn'].float().div_(255), 'text': text}
+
+    def collate_fn(self, samples):
+        batch, target = default_collate(samples)
+        return self.batch_transform(batch), target
+
+    def extra_repr(self):
+        return "Split: {}".format("Train" if self.train is True else "Test")
+
+
 if __name__ == '__main__':
     config = json2dict(Path(get_config_path(dataset='mnistsvhntext')))
     download_zip_from_url(
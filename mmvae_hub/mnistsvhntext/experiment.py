@@ -10,7 +10,7 @@ from torchvision import transforms
 
 from mmvae_hub.base.BaseExperiment import BaseExperiment
 from mmvae_hub.mnistsvhntext.MNISTmod import MNIST
-from mmvae_hub.mnistsvhntext.SVHNMNISTDataset import SVHNMNIST
+from mmvae_hub.mnistsvhntext.SVHNMNISTDataset import SVHNMNIST, TensorSVHNMNIST
 from mmvae_hub.mnistsvhntext.SVHNmod import SVHN
 # from utils.BaseExperiment import BaseExperiment
 from mmvae_hub.mnistsvhntext.metrics import mnistsvhntextMetrics
@@ -67,6 +67,10 @@ class MNISTSVHNText(BaseExperiment):
         return transform_svhn
 
     def set_dataset(self):
+        if self.flags.tensor_data:
+            return TensorSVHNMNIST(self.flags, self.alphabet, train=True), \
+                   TensorSVHNMNIST(self.flags, self.alphabet, train=False)
+
         transform_mnist = self.get_transform_mnist()
         transform_svhn = self.get_transform_svhn()
         transforms = [transform_mnist, transform_svhn]
@@ -103,6 +107,8 @@ class MNISTSVHNText(BaseExperiment):
             while True:
                 sample, target = self.dataset_test.__getitem__(random.randint(0, n_test))
                 if target == i:
+                    if self.flags.tensor_data:
+                        sample = self.dataset_test.batch_transform(sample)
                     for k, key in enumerate(sample):
                         sample[key] = sample[key].to(self.flags.device)
                     samples.append(sample)
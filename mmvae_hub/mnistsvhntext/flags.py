@@ -1,6 +1,6 @@
 from pathlib import Path
 
-from mmvae_hub.utils.setup.flags_utils import BaseFlagsSetup
+from mmvae_hub.utils.setup.flags_utils import BaseFlagsSetup, str2bool
 
 from mmvae_hub.base.BaseFlags import parser as parser
 
@@ -16,6 +16,10 @@ parser.add_argument('--len_sequence', type=int, default=8, help="length of seque
 parser.add_argument('--num_classes', type=int, default=10, help="number of classes on which the data set trained")
 parser.add_argument('--dim', type=int, default=64, help="number of classes on which the data set trained")
 parser.add_argument('--data_multiplications', type=int, default=20, help="number of pairs per sample")
+parser.add_argument('--tensor_data', type=str2bool, default=True,
+                    help="If True, the images are kept as uint8 tensors and the texts as character indices, which are "
+                         "converted for the whole batch when collated. Otherwise every sample is converted to PIL "
+                         "images and one-hot encoded texts.")
 parser.add_argument('--num_hidden_layers', type=int, default=1, help="number of channels in images")
 parser.add_argument('--likelihood_m1', type=str, default='laplace', help="output distribution")
 parser.add_argument('--likelihood_m2', type=str, default='laplace', help="output distribution")
@@ -1,5 +1,7 @@
 import torch.nn as nn
 
+from mmvae_hub.networks.text.embedding import embed_text
+
 
 # Residual block
 class ResidualBlockEncoder(nn.Module):
@@ -96,8 +98,7 @@ class ClfText(nn.Module):
 
 
     def forward(self, x):
-        x = x.transpose(-2,-1)
-        h = self.conv1(x);
+        h = embed_text(self.conv1, x);
         h = self.resblock_1(h);
         h = self.resblock_4(h);
         h = self.dropout(h);
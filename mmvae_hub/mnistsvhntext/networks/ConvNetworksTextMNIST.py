@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 
+from mmvae_hub.networks.text.embedding import embed_text
+
 
 class FeatureEncText(nn.Module):
     def __init__(self, dim, num_features):
@@ -12,8 +14,7 @@ class FeatureEncText(nn.Module):
         self.relu = nn.ReLU()
 
     def forward(self, x):
-        x = x.transpose(-2, -1);
-        out = self.conv1(x);
+        out = embed_text(self.conv1, x);
         out = self.relu(out);
         out = self.conv2(out);
         out = self.relu(out);
@@ -14,6 +14,7 @@ from torchvision import transforms
 from mmvae_hub.mnistsvhntext.networks.ConvNetworkTextClf import ClfText
 from mmvae_hub.mnistsvhntext.networks.ConvNetworksTextMNIST import EncoderText, DecoderText
 from mmvae_hub.modalities import BaseModality
+from mmvae_hub.networks.utils.utils import IndexCategorical
 from mmvae_hub.utils.plotting.save_samples import write_samples_text_to_file
 from mmvae_hub.utils.text import tensor_to_text
 
@@ -23,7 +24,7 @@ class Text(BaseModality):
         super().__init__(flags, name='text')
         self.alphabet = alphabet
         self.rec_weight = 1.
-        self.px_z = OneHotCategorical
+        self.px_z = IndexCategorical if flags.text_indices else OneHotCategorical
         self.font = self.get_font()
 
         self.len_sequence = flags.len_sequence
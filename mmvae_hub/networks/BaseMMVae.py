@@ -1,7 +1,7 @@
 import os
 from abc import ABC
 from pathlib import Path
-from typing import Tuple, Union
+from typing import Tuple, Union, Iterable
 
 import numpy as np
 import torch.nn as nn
@@ -14,6 +14,7 @@ from mmvae_hub.networks.utils.mixture_component_selection import mixture_compone
 from mmvae_hub.utils import utils
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
 from mmvae_hub.utils.fusion_functions import *
+from mmvae_hub.utils.subset_registry import SubsetRegistry
 
 
 class BaseMMVAE(ABC, nn.Module):
@@ -26,6 +27,9 @@ class BaseMMVAE(ABC, nn.Module):
         self.metrics = None
         self.mm_div: Optional[BaseMMDiv] = None
 
+        self.subset_registry: SubsetRegistry = getattr(exp, 'subset_registry', None) or \
+                                               SubsetRegistry(modalities, device=flags.device)
+
     # ==================================================================================================================
     # Basic functions
     # ==================================================================================================================
@@ -101,9 +105,11 @@ class BaseMMVAE(ABC, nn.Module):
     # ==================================================================================================================
     # Generation
     # ==================================================================================================================
-    def generate(self, num_samples=None) -> Mapping[str, Tensor]:
+    def generate(self, num_samples=None, out_mods: Optional[Iterable[str]] = None) -> Mapping[str, Tensor]:
         """
         Generate from latents that were sampled from a normal distribution.
+
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
         if num_samples is None:
             num_samples = self.flags.batch_size
@@ -111,13 +117,15 @@ class BaseMMVAE(ABC, nn.Module):
         z_class = self.get_rand_samples_from_joint(num_samples)
 
         random_latents = ReparamLatent(content=z_class, style=None)
-        return self.generate_from_latents(random_latents)
+        return self.generate_from_latents(random_latents, out_mods=out_mods)
 
-    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None):
+    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None,
+                               out_mods: Optional[Iterable[str]] = None):
         """
         Generate samples conditioned with input samples for a given subset.
 
         subset_key str: The key indicating which subset is used for the generation.
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
 
         # infer latents from batch
@@ -127,19 +135,24 @@ class BaseMMVAE(ABC, nn.Module):
         c_rep = joint_latent.get_subset_embedding(subset_key)
 
         cond_mod_in = ReparamLatent(content=c_rep, style=style)
-        return self.generate_from_latents(cond_mod_in)
+        return self.generate_from_latents(cond_mod_in, out_mods=out_mods)
 
-    def generate_from_latents(self, latents: ReparamLatent) -> Mapping[str, Tensor]:
-        cond_gen = {}
-        for mod_str in self.modalities:
-            suff_stats = self.generate_sufficient_statistics_from_latents(latents)
-            cond_gen_m = suff_stats[mod_str].mean
-            cond_gen[mod_str] = cond_gen_m
-        return cond_gen
+    def generate_from_latents(self, latents: ReparamLatent,
+                              out_mods: Optional[Iterable[str]] = None) -> Mapping[str, Tensor]:
+        """
+        Generate the mean of px_z for every modality in out_mods. Every decoder is called once.
+
+        out_mods: The modalities that are generated. If None, all modalities are generated.
+        """
+        suff_stats = self.generate_sufficient_statistics_from_latents(latents, out_mods=out_mods)
+        return {mod_str: suff_stat.mean for mod_str, suff_stat in suff_stats.items()}
 
-    def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent) -> Mapping[str, Distribution]:
+    def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent,
+                                                    out_mods: Optional[Iterable[str]] = None) \
+            -> Mapping[str, Distribution]:
         cond_gen = {}
-        for mod_str, mod in self.modalities.items():
+        for mod_str in (self.modalities if out_mods is None else out_mods):
+            mod = self.modalities[mod_str]
             content = latents.content
             cond_gen_m = mod.px_z(*mod.decoder(content))
             cond_gen[mod_str] = cond_gen_m
@@ -175,20 +188,29 @@ class BaseMMVAE(ABC, nn.Module):
             styles[mod_str] = dist_m
         return styles
 
-    def cond_generation(self, joint_latent: JointLatents, num_samples=None) -> Mapping[str, Mapping[str, Tensor]]:
+    def cond_generation(self, joint_latent: JointLatents, num_samples=None,
+                        out_mods: Optional[Iterable[str]] = None) -> Mapping[str, Mapping[str, Tensor]]:
+        """
+        Generate samples conditioned on the embedding of every subset and on the joint embedding.
+        The embeddings are stacked such that every decoder is called only once.
+
+        out_mods: The modalities that are generated. If None, all modalities are generated.
+        """
         if num_samples is None:
             num_samples = self.flags.batch_size
 
         style_latents = self.get_random_styles(num_samples)
-        cond_gen_samples = {}
-        for key in joint_latent.subsets:
-            content_rep = joint_latent.get_subset_embedding(key)
-            latents = ReparamLatent(content=content_rep, style=style_latents)
-            cond_gen_samples[key] = self.generate_from_latents(latents)
+        content_reps = {key: joint_latent.get_subset_embedding(key) for key in joint_latent.subsets}
+        content_reps['joint'] = joint_latent.get_joint_embeddings()
 
-        joint_embedding = joint_latent.get_joint_embeddings()
-        joint_latents = ReparamLatent(content=joint_embedding, style=style_latents)
-        cond_gen_samples['joint'] = self.generate_from_latents(joint_latents)
+        latents = ReparamLatent(content=torch.cat(list(content_reps.values())), style=style_latents)
+        stacked_gen = self.generate_from_latents(latents, out_mods=out_mods)
+
+        split_sizes = [content_rep.shape[0] for content_rep in content_reps.values()]
+        cond_gen_samples = {key: {} for key in content_reps}
+        for mod_str, mod_gen in stacked_gen.items():
+            for key, key_gen in zip(content_reps, mod_gen.split(split_sizes)):
+                cond_gen_samples[key][mod_str] = key_gen
 
         return cond_gen_samples
 
@@ -225,23 +247,14 @@ class BaseMMVAE(ABC, nn.Module):
         Create a subspace for all the combinations of the encoded modalities by combining them.
         A joint latent space is then created by fusing all subspaces.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
-        mus = torch.Tensor().to(self.flags.device)
-        logvars = torch.Tensor().to(self.flags.device)
-        distr_subsets = {}
+        distr_subsets = self.fuse_subsets(enc_mods, batch_mods)
 
         # subsets that will be fused into the joint distribution
-        fusion_subsets_keys = []
-
-        # concatenate mus and logvars for every modality in each subset
-        for s_key in batch_subsets:
-            distr_subset = self.fuse_subset(enc_mods, s_key)
-            distr_subsets[s_key] = distr_subset
+        fusion_subsets_keys = [s_key for s_key in distr_subsets
+                               if self.fusion_condition(self.subsets[s_key], batch_mods)]
 
-            if self.fusion_condition(self.subsets[s_key], batch_mods):
-                mus = torch.cat((mus, distr_subset.mu.unsqueeze(0)), dim=0)
-                logvars = torch.cat((logvars, distr_subset.logvar.unsqueeze(0)), dim=0)
-                fusion_subsets_keys.append(s_key)
+        mus = torch.stack([distr_subsets[s_key].mu for s_key in fusion_subsets_keys])
+        logvars = torch.stack([distr_subsets[s_key].logvar for s_key in fusion_subsets_keys])
 
         weights = (1 / float(mus.shape[0])) * torch.ones(mus.shape[0]).to(self.flags.device)
         joint_distr = self.moe_fusion(mus, logvars, weights)
@@ -249,6 +262,26 @@ class BaseMMVAE(ABC, nn.Module):
 
         return JointLatents(fusion_subsets_keys, joint_distr=joint_distr, subsets=distr_subsets)
 
+    def fuse_subsets(self, enc_mods: Mapping[str, BaseEncMod], batch_mods: typing.Iterable[str]) \
+            -> Mapping[str, Distr]:
+        """Fuse the encoded modalities of every subset that can be built from batch_mods."""
+        return {s_key: self.fuse_subset(enc_mods, s_key) for s_key in
+                self.subset_registry.batch_subset_keys(batch_mods)}
+
+    def get_batch_subsets(self, batch_mods: typing.Iterable[str]) -> Tuple[list, list, Tensor]:
+        """
+        Return the keys of the subsets that can be built from batch_mods, the modalities of the batch and the
+        membership mask of those subsets with shape (num_subsets, num_batch_mods).
+        """
+        return self.subset_registry.batch_subsets(batch_mods)
+
+    @staticmethod
+    def stack_enc_mods(enc_mods: Mapping[str, BaseEncMod], mod_strs: typing.Iterable[str]) -> Tuple[Tensor, Tensor]:
+        """Stack the mus and logvars of the encoded modalities to tensors of shape (num_mods, bs, class_dim)."""
+        mus = torch.stack([enc_mods[mod_str].latents_class.mu for mod_str in mod_strs])
+        logvars = torch.stack([enc_mods[mod_str].latents_class.logvar for mod_str in mod_strs])
+        return mus, logvars
+
     def fuse_subset(self, enc_mods, s_key: str) -> Distr:
         """Fuse encoded modalities in subset."""
         mods = self.subsets[s_key]
@@ -279,7 +312,7 @@ class BaseMMVAE(ABC, nn.Module):
 
     def batch_to_device(self, batch):
         """Send the batch to device as Variable."""
-        return {k: v.to(self.flags.device) for k, v in batch.items()}
+        return {k: v.to(self.flags.device, non_blocking=True) for k, v in batch.items()}
 
     def save_networks(self, epoch: int):
         dir_network_epoch = os.path.join(self.flags.dir_checkpoints, str(epoch).zfill(4))
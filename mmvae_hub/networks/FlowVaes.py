@@ -11,8 +11,9 @@ from mmvae_hub.networks.PoEMMVAE import POEMMVae
 from mmvae_hub.networks.flows.AffineFlows import AffineFlow
 from mmvae_hub.networks.flows.PlanarFlow import PlanarFlow
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
-from mmvae_hub.utils.fusion_functions import subsets_from_batchmods, mixture_component_selection_embedding
-from mmvae_hub.utils.utils import split_int_to_bins
+from mmvae_hub.networks.utils.mixture_component_selection import select_components, component_indices_from_bins, \
+    mixture_bins
+from mmvae_hub.utils.fusion_functions import mixture_component_selection_embedding
 from mmvae_hub.evaluation.utils import dataset_to_metric
 
 class FlowVAE:
@@ -85,7 +86,7 @@ class FlowOfSubsetsVAE(FlowVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         distr_subsets = {}
 
         # concatenate mus and logvars for every modality in each subset
@@ -97,7 +98,8 @@ class FlowOfSubsetsVAE(FlowVAE):
             distr_subsets[s_key] = SubsetFoS(q0=subset_distr, z0=z0, zk=zk, log_det_j=log_det_j)
 
             if len(self.subsets[s_key]) == len(batch_mods):
-                joint_embedding = JointEmbeddingFoS(embedding=zk, mod_strs=s_key.split('_'), log_det_j=log_det_j)
+                joint_embedding = JointEmbeddingFoS(embedding=zk, mod_strs=self.subset_registry.get_mod_strs(s_key),
+                                                    log_det_j=log_det_j)
 
         return JointLatentsFoS(joint_embedding=joint_embedding, subsets=distr_subsets)
 
@@ -132,14 +134,11 @@ class MoFoPoE(FlowOfSubsetsVAE, MoPoEMMVae):
         Create a subspace for all the combinations of the encoded modalities by combining them.
         A joint latent space is then created by fusing all subspaces.
         """
-        # get all subsets that can be created from the batch_mods
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        # create a PoE distr for all subsets that can be created from the batch_mods
+        poe_subsets = self.fuse_subsets(enc_mods, batch_mods)
         distr_subsets = {}
 
-        for s_key in batch_subsets:
-            # create subset distr with PoE
-            distr_subset = self.fuse_subset(enc_mods, s_key)
-
+        for s_key, distr_subset in poe_subsets.items():
             # sample and pass through flows
             z0 = distr_subset.reparameterize()
             zk, log_det_j = self.flow.forward(z0)
@@ -149,7 +148,7 @@ class MoFoPoE(FlowOfSubsetsVAE, MoPoEMMVae):
         # select expert for z_joint
         subsets = {k: v.zk for k, v in distr_subsets.items()}
         z_joint = mixture_component_selection_embedding(subset_embeds=subsets, s_key='all', flags=self.flags)
-        joint_embedding = JointEmbeddingFoS(embedding=z_joint, mod_strs=[k for k in batch_subsets], log_det_j=None)
+        joint_embedding = JointEmbeddingFoS(embedding=z_joint, mod_strs=[k for k in poe_subsets], log_det_j=None)
 
         # weights = (1 / float(mus.shape[0])) * torch.ones(mus.shape[0]).to(self.flags.device)
         # joint_distr = self.moe_fusion(mus, logvars, weights)
@@ -219,7 +218,7 @@ class FoMFoP(FlowOfJointVAE, MoPoEMMVae):
         Create a subspace for all the combinations of the encoded modalities by combining them.
         A joint latent space is then created by fusing all subspaces.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         subsets = {}
 
         # concatenate mus and logvars for every modality in each subset
@@ -231,8 +230,8 @@ class FoMFoP(FlowOfJointVAE, MoPoEMMVae):
 
             subsets[s_key] = SubsetFoS(q0=distr_subset, z0=z0, zk=zk, log_det_j=log_det_j)
 
-        joint_embedding = mixture_component_selection_embedding(enc_mods=subsets, s_key='all',
-                                                                flags=self.flags)
+        joint_embedding = mixture_component_selection_embedding(
+            subset_embeds={s_key: subset.zk for s_key, subset in subsets.items()}, s_key='all', flags=self.flags)
         z0, zk, log_det_j = self.flow2.forward(joint_embedding)
 
         return JointLatentsFoS(joint_embedding=zk, subsets=subsets)
@@ -302,34 +301,21 @@ class FoMVAE(FlowOfSubsetsVAE, MOEMMVae):
         num_samples = enc_mods[list(enc_mods)[0]].latents_class.mu.shape[0]
         mods = self.subsets[s_key]
 
-        # fuse the subset
-        joint_mus = torch.Tensor().to(self.flags.device)
-        joint_logvars = torch.Tensor().to(self.flags.device)
-        joint_h = torch.Tensor().to(self.flags.device)
-
-        if self.flags.weighted_mixture:
-            # define confidence of expert by the inverse of the logvar.
-            # Sample experts with probability proportional to confidence.
-            confidences = [1 / enc_mods[mod.name].latents_class.logvar.mean().abs() for mod in mods]
-            bins = [int(num_samples * (conf / sum(confidences))) for conf in confidences]
-            if sum(bins) != num_samples:
-                bins[confidences.index(max(confidences))] += num_samples - sum(bins)
-        else:
-            # fill zk_subset with an equal amount of each expert
-            bins = split_int_to_bins(number=num_samples, nbr_bins=len(mods))
+        experts = [enc_mods[mod.name] for mod in mods]
+        expert_mus = torch.stack([expert.latents_class.mu for expert in experts])
+        expert_logvars = torch.stack([expert.latents_class.logvar for expert in experts])
+
+        # define confidence of expert by the inverse of the logvar.
+        # Sample experts with probability proportional to confidence.
+        confidences = 1 / expert_logvars.mean(dim=(1, 2)).abs() if self.flags.weighted_mixture else None
+        # if not weighted, fill zk_subset with an equal amount of each expert
+        bins = mixture_bins(num_samples, len(mods), confidences).to(expert_mus.device)
 
         # get latents and flow params for each expert
-        for chunk_size, mod in zip(bins, mods):
-            expert = enc_mods[mod.name]
-            joint_mus = torch.cat(
-                (joint_mus, expert.latents_class.mu[joint_mus.shape[0]:joint_mus.shape[0] + chunk_size]),
-                dim=0)
-            joint_logvars = torch.cat(
-                (joint_logvars,
-                 expert.latents_class.logvar[
-                 joint_logvars.shape[0]:joint_logvars.shape[0] + chunk_size]),
-                dim=0)
-            joint_h = torch.cat((joint_h, expert.h[joint_h.shape[0]:joint_h.shape[0] + chunk_size]))
+        component_idx = component_indices_from_bins(bins, num_samples)
+        joint_mus = select_components(expert_mus, component_idx)
+        joint_logvars = select_components(expert_logvars, component_idx)
+        joint_h = select_components(torch.stack([expert.h for expert in experts]), component_idx)
 
         joint_flow_params = self.flow.get_flow_params(joint_h)
 
@@ -411,16 +397,19 @@ class PlanarMixtureMMVae(FlowOfEncModsVAE, MOEMMVae):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         distr_subsets = {}
 
         # concatenate mus and logvars for every modality in each subset
         for s_key in batch_subsets:
-            z_subset = mixture_component_selection_embedding(enc_mods=enc_mods, s_key=s_key, flags=self.flags)
+            z_subset = mixture_component_selection_embedding(
+                subset_embeds={mod_str: enc_mod.zk for mod_str, enc_mod in enc_mods.items()}, s_key=s_key,
+                flags=self.flags)
             distr_subsets[s_key] = z_subset
 
             if len(self.subsets[s_key]) == len(batch_mods):
-                joint_embedding = JointEmbeddingFoEM(embedding=z_subset, mod_strs=s_key.split('_'))
+                joint_embedding = JointEmbeddingFoEM(embedding=z_subset,
+                                                     mod_strs=self.subset_registry.get_mod_strs(s_key))
 
         return JointLatentsFoEM(joint_embedding=joint_embedding, subsets=distr_subsets)
 
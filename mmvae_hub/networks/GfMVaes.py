@@ -16,7 +16,7 @@ from mmvae_hub.networks.utils.utils import get_distr
 from mmvae_hub.utils.Dataclasses.gfmDataclasses import SubsetMoFoGfM, JointLatentsMoGfM, \
     JointLatentsGfMoP, JointLatentsMoFoGfM
 from mmvae_hub.utils.Dataclasses.iwdataclasses import *
-from mmvae_hub.utils.fusion_functions import subsets_from_batchmods, mixture_component_selection_embedding
+from mmvae_hub.utils.fusion_functions import mixture_component_selection_embedding
 from torch.distributions.normal import Normal
 
 
@@ -32,7 +32,7 @@ class GfMVAE(BaseMMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         subset_embeddings = {}
 
         # pass all experts through the flow
@@ -52,7 +52,7 @@ class GfMVAE(BaseMMVAE):
             subset_embeddings[s_key] = z_subset
 
             if len(self.subsets[s_key]) == len(batch_mods):
-                joint_embedding = JointEmbeddingFoEM(embedding=z_subset, mod_strs=s_key.split('_'))
+                joint_embedding = JointEmbeddingFoEM(embedding=z_subset, mod_strs=self.subset_registry.get_mod_strs(s_key))
 
         return JointLatentsGfM(joint_embedding=joint_embedding, subsets=subset_embeddings)
 
@@ -78,7 +78,7 @@ class iwMoGfMVAE_old(iwMMVAE, BaseMMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         subset_samples = {}
 
@@ -152,10 +152,12 @@ class iwMoGfMVAE_old(iwMMVAE, BaseMMVAE):
         joint_div = joint_div.mean()
         return total_loss, joint_div, log_probs, klds
 
-    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None):
+    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None,
+                               out_mods: Optional[Iterable[str]] = None):
         """
         Generate samples conditioned with input samples for a given subset.
         subset_key str: The key indicating which subset is used for the generation.
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
 
         # infer latents from batch
@@ -163,7 +165,7 @@ class iwMoGfMVAE_old(iwMMVAE, BaseMMVAE):
 
         subset_embedding = joint_latents.subsets[subset_key].mean(dim=0)
         cond_mod_in = ReparamLatent(content=subset_embedding, style=style)
-        return self.generate_from_latents(cond_mod_in)
+        return self.generate_from_latents(cond_mod_in, out_mods=out_mods)
 
 
 class BaseiwMoGfMVAE(iwMMVAE, BaseMMVAE):
@@ -179,18 +181,15 @@ class BaseiwMoGfMVAE(iwMMVAE, BaseMMVAE):
                             torch.ones((self.flags.batch_size, self.flags.class_dim), device=self.flags.device))
         self.qz_x = get_distr(flags.qz_x)  # posterior
 
-    def decode(self, enc_mods: Mapping[str, BaseEncMod], joint_latents: iwJointLatents) -> dict:
-        """Decoder outputs each reconstructed modality as a dict."""
-        rec_mods = {}
-        for subset_str, subset in joint_latents.subsets.items():
-            subset_samples = subset[0].reshape((self.K * self.flags.batch_size, self.flags.class_dim))
-            rec_mods[subset_str] = {
-                out_mod_str: dec_mod.calc_likelihood(class_embeddings=subset_samples,
-                                                     unflatten=(self.K, self.flags.batch_size)
-                                                     )
-                for out_mod_str, dec_mod in self.modalities.items()
-            }
-        return rec_mods
+    def decode(self, enc_mods: Mapping[str, BaseEncMod], joint_latents: iwJointLatents) -> Optional[dict]:
+        """
+        Decoder outputs each reconstructed modality as a dict.
+        If the samples are decoded in chunks, they are only decoded in calculate_loss and None is returned.
+        """
+        if self.decode_in_chunks:
+            return None
+        return self.decode_subset_samples({subset_str: subset[0] for subset_str, subset in
+                                           joint_latents.subsets.items()})
 
     def encode(self, input_batch: Mapping[str, Tensor]) -> Mapping[str, BaseEncMod]:
         enc_mods = {}
@@ -205,11 +204,13 @@ class BaseiwMoGfMVAE(iwMMVAE, BaseMMVAE):
 
         return enc_mods
 
-    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None):
+    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None,
+                               out_mods: Optional[Iterable[str]] = None):
         """
         Generate samples conditioned with input samples for a given subset.
 
         subset_key str: The key indicating which subset is used for the generation.
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
 
         # infer latents from batch
@@ -217,11 +218,14 @@ class BaseiwMoGfMVAE(iwMMVAE, BaseMMVAE):
 
         subset_embedding = joint_latents.subsets[subset_key][0].mean(dim=0)
         cond_mod_in = ReparamLatent(content=subset_embedding, style=style)
-        return self.generate_from_latents(cond_mod_in)
+        return self.generate_from_latents(cond_mod_in, out_mods=out_mods)
 
-    def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent) -> Mapping[str, Distribution]:
+    def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent,
+                                                    out_mods: Optional[Iterable[str]] = None) \
+            -> Mapping[str, Distribution]:
         cond_gen = {}
-        for mod_str, mod in self.modalities.items():
+        for mod_str in (self.modalities if out_mods is None else out_mods):
+            mod = self.modalities[mod_str]
             content = latents.content
             cond_gen_m = mod.px_z(*mod.decoder(content))
             cond_gen[mod_str] = cond_gen_m
@@ -230,6 +234,7 @@ class BaseiwMoGfMVAE(iwMMVAE, BaseMMVAE):
 
 class iwMoGfMVAE(BaseiwMoGfMVAE):
     """Importance Weighted Mixture of Generalized f-Means VAE"""
+    supports_chunked_decoding = True
 
     def __init__(self, exp, flags, modalities, subsets):
         super().__init__(exp, flags, modalities, subsets)
@@ -239,7 +244,7 @@ class iwMoGfMVAE(BaseiwMoGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.loc.shape[0]
@@ -295,6 +300,8 @@ class iwMoGfMVAE(BaseiwMoGfMVAE):
     def calculate_loss(self, forward_results, batch_d: dict) -> tuple[float, float, dict, Mapping[str, float]]:
         subsets = forward_results.joint_latents.subsets
         enc_mods = forward_results.enc_mods
+        lpx_zs = self.subset_log_likelihoods(forward_results.rec_mods,
+                                             {sub_str: samples[0] for sub_str, samples in subsets.items()}, batch_d)
         losses = []
         klds = {}
         log_probs = {}
@@ -311,11 +318,8 @@ class iwMoGfMVAE(BaseiwMoGfMVAE):
 
             d_kl = lqz_x - lpz
 
-            lpx_z = [px_z.log_prob(batch_d[out_mod_str]).view(*px_z.batch_shape[:2], -1).sum(-1)
-                     for out_mod_str, px_z in forward_results.rec_mods[sub_str].items()]
-
-            # sum over #mods in subset
-            lpx_z = torch.stack(lpx_z).sum(0)
+            # summed over #mods in subset
+            lpx_z = lpx_zs[sub_str]
 
             # loss = -(lpx_z - (lqz_x - lpz))
             if self.flags.beta == 0:
@@ -351,7 +355,7 @@ class iwMoGfMVAE2_(BaseiwMoGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.loc.shape[0]
@@ -454,7 +458,7 @@ class iwMoGfMVAE4(BaseiwMoGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.loc.shape[0]
@@ -559,7 +563,7 @@ class iwMoGfMVAE_amortized(BaseiwMoGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.loc.shape[0]
@@ -701,7 +705,7 @@ class iwMoGfMVAE_multiloss(BaseiwMoGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.loc.shape[0]
@@ -827,7 +831,7 @@ class iwMoGfMVAE_multiloss_(BaseiwMoGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.loc.shape[0]
@@ -966,7 +970,7 @@ class iwMoGfMVAE3(iwMMVAE, BaseMMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
 
         # batch_size is not always equal to flags.batch_size
         batch_size = enc_mods[[mod_str for mod_str in enc_mods][0]].latents_class.mu.shape[0]
@@ -1056,11 +1060,13 @@ class iwMoGfMVAE3(iwMMVAE, BaseMMVAE):
         joint_div = joint_div.mean()
         return total_loss, joint_div, log_probs, klds
 
-    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None):
+    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None,
+                               out_mods: Optional[Iterable[str]] = None):
         """
         Generate samples conditioned with input samples for a given subset.
 
         subset_key str: The key indicating which subset is used for the generation.
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
 
         # infer latents from batch
@@ -1068,11 +1074,14 @@ class iwMoGfMVAE3(iwMMVAE, BaseMMVAE):
 
         subset_embedding = joint_latents.subsets[subset_key][0].mean(dim=0)
         cond_mod_in = ReparamLatent(content=subset_embedding, style=style)
-        return self.generate_from_latents(cond_mod_in)
+        return self.generate_from_latents(cond_mod_in, out_mods=out_mods)
 
-    def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent) -> Mapping[str, Distribution]:
+    def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent,
+                                                    out_mods: Optional[Iterable[str]] = None) \
+            -> Mapping[str, Distribution]:
         cond_gen = {}
-        for mod_str, mod in self.modalities.items():
+        for mod_str in (self.modalities if out_mods is None else out_mods):
+            mod = self.modalities[mod_str]
             style_m = latents.style[mod_str]
             content = latents.content
             cond_gen_m = mod.likelihood(*mod.decoder(style_m, content))
@@ -1103,7 +1112,7 @@ class MoFoGfMVAE(BaseMMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         subset_embeddings = {}
 
         # pass all experts through the flow
@@ -1155,12 +1164,7 @@ class GfMoPVAE(MoPoEMMVae):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
-        distr_subsets = {}
-
-        for s_key in batch_subsets:
-            distr_subset = self.fuse_subset(enc_mods, s_key)
-            distr_subsets[s_key] = distr_subset
+        distr_subsets = self.fuse_subsets(enc_mods, batch_mods)
 
         z_joint = self.gfm(distr_subsets)
 
@@ -1174,7 +1178,9 @@ class GfMoPVAE(MoPoEMMVae):
         enc_subset_zks = {s_key: self.encode_expert(distr_subset) for s_key, distr_subset in distr_subsets.items()}
 
         # get the mixture of each encoded subset
-        z_mixture = mixture_component_selection_embedding(enc_mods=enc_subset_zks, s_key='all', flags=self.flags)
+        z_mixture = mixture_component_selection_embedding(
+            subset_embeds={s_key: enc_subset.zk for s_key, enc_subset in enc_subset_zks.items()}, s_key='all',
+            flags=self.flags)
         # question: should I normalize by the number of modalities here?
 
         # pass the mixture backwards through the flow.
@@ -1205,7 +1211,7 @@ class PGfMVAE(BaseMMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         distr_subsets = {}
 
         # pass all experts through the flow
@@ -1222,7 +1228,7 @@ class PGfMVAE(BaseMMVAE):
 
             if len(self.subsets[s_key]) == len(batch_mods):
                 joint_distr = q_subset
-                fusion_subsets_keys = s_key.split('_')
+                fusion_subsets_keys = self.subset_registry.get_mod_strs(s_key)
                 joint_distr.mod_strs = fusion_subsets_keys
 
         return JointLatents(fusion_subsets_keys, joint_distr=joint_distr, subsets=distr_subsets)
@@ -1265,7 +1271,7 @@ class PGfMoPVAE(BaseMMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         distr_subsets = {}
         fusion_subsets_keys = []
 
@@ -1340,10 +1346,7 @@ class iwmopgfm(iwMMVAE, PGfMVAE):
         }
 
         # find the subset will all modalities to get the joint distr
-        max_subset_size = max(len(subset_str.split('_')) for subset_str in joint_latents.fusion_subsets_keys)
-
-        joint_distr = subsets[[subset_str for subset_str in joint_latents.fusion_subsets_keys if
-                               len(subset_str.split('_')) == max_subset_size][0]]
+        joint_distr = subsets[max(joint_latents.fusion_subsets_keys, key=self.subset_registry.get_size)]
 
         joint_latents = iwJointLatents(fusion_subsets_keys=joint_latents.fusion_subsets_keys, subsets=subsets, zss=zss,
                                        joint_distr=joint_distr)
@@ -1355,7 +1358,7 @@ class iwmopgfm(iwMMVAE, PGfMVAE):
         """
         Create a subspace for all the combinations of the encoded modalities by combining them.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
+        batch_subsets = self.subset_registry.batch_subset_keys(batch_mods)
         distr_subsets = {}
 
         # pass all experts through the flow
@@ -1373,7 +1376,7 @@ class iwmopgfm(iwMMVAE, PGfMVAE):
 
             if len(self.subsets[s_key]) == len(batch_mods):
                 joint_distr = q_subset
-                fusion_subsets_keys = s_key.split('_')
+                fusion_subsets_keys = self.subset_registry.get_mod_strs(s_key)
                 joint_distr.mod_strs = fusion_subsets_keys
 
         return JointLatents(fusion_subsets_keys, joint_distr=joint_distr, subsets=distr_subsets)
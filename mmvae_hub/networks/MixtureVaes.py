@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
+import typing
 
 from mmvae_hub.evaluation.divergence_measures.mm_div import MixtureMMDiv, JointElbowMMDiv, JSDMMDiv
 from mmvae_hub.networks.BaseMMVae import BaseMMVAE
 from mmvae_hub.networks.PoEMMVAE import POEMMVae
-from mmvae_hub.networks.utils.mixture_component_selection import mixture_component_selection
+from mmvae_hub.networks.utils.mixture_component_selection import mixture_component_selection, \
+    subset_component_indices
 from mmvae_hub.utils import utils
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
 
@@ -19,6 +21,18 @@ class MOEMMVae(BaseMMVAE):
         weights = utils.reweight_weights(weights)
         return mixture_component_selection(flags, mus, logvars, weights)
 
+    def fuse_subsets(self, enc_mods: Mapping[str, BaseEncMod], batch_mods: typing.Iterable[str]) \
+            -> Mapping[str, Distr]:
+        """Select the experts of all subsets with a single gather."""
+        s_keys, batch_mod_strs, subset_mask = self.get_batch_subsets(batch_mods)
+        mus, logvars = self.stack_enc_mods(enc_mods, batch_mod_strs)
+
+        expert_idx = subset_component_indices(subset_mask, num_samples=mus.shape[1])
+        sample_idx = torch.arange(mus.shape[1], device=mus.device)
+        mus_subsets, logvars_subsets = mus[expert_idx, sample_idx], logvars[expert_idx, sample_idx]
+
+        return {s_key: Distr(mu=mus_subsets[idx], logvar=logvars_subsets[idx]) for idx, s_key in enumerate(s_keys)}
+
     @staticmethod
     def fusion_condition(subset, batch_mods) -> bool:
         return len(subset) == 1
@@ -37,6 +51,16 @@ class MoPoEMMVae(MOEMMVae):
         mu_poe, logvar_poe = POEMMVae.poe(mus, logvars)
         return Distr(mu_poe, logvar_poe)
 
+    def fuse_subsets(self, enc_mods: Mapping[str, BaseEncMod], batch_mods: typing.Iterable[str]) \
+            -> Mapping[str, Distr]:
+        """Fuse all subsets with product of experts in one batched reduction."""
+        s_keys, batch_mod_strs, subset_mask = self.get_batch_subsets(batch_mods)
+        mus, logvars = self.stack_enc_mods(enc_mods, batch_mod_strs)
+
+        mus_subsets, logvars_subsets = POEMMVae.poe_subsets(mus, logvars, subset_mask)
+
+        return {s_key: Distr(mu=mus_subsets[idx], logvar=logvars_subsets[idx]) for idx, s_key in enumerate(s_keys)}
+
     @staticmethod
     def fusion_condition(subset, batch_mods) -> bool:
         return True
@@ -6,7 +6,7 @@ import typing
 from mmvae_hub.evaluation.divergence_measures.mm_div import POEMMDiv
 from mmvae_hub.networks.BaseMMVae import BaseMMVAE
 from mmvae_hub.utils.Dataclasses.Dataclasses import Distr, JointLatents, BaseEncMod
-from mmvae_hub.utils.fusion_functions import subsets_from_batchmods
+from mmvae_hub.utils.precision import full_precision
 
 
 class POEMMVae(BaseMMVAE):
@@ -19,14 +19,10 @@ class POEMMVae(BaseMMVAE):
         Create a subspace for all the combinations of the encoded modalities by combining them.
         A joint latent space is then created by fusing all subspaces.
         """
-        batch_subsets = subsets_from_batchmods(batch_mods)
-        distr_subsets = {}
-
-        for s_key in batch_subsets:
-            # fuse all experts of subset
-            distr_subset = self.fuse_subset(enc_mods, s_key)
-            distr_subsets[s_key] = distr_subset
+        # fuse all experts of every subset
+        distr_subsets = self.fuse_subsets(enc_mods, batch_mods)
 
+        for s_key, distr_subset in distr_subsets.items():
             if len(self.subsets[s_key]) == len(batch_mods):
                 joint_distr = distr_subset
                 joint_distr.mod_strs = batch_mods
@@ -44,11 +40,29 @@ class POEMMVae(BaseMMVAE):
         mu_poe, logvar_poe = POEMMVae.poe(mus, logvars)
         return Distr(mu_poe, logvar_poe)
 
+    def fuse_subsets(self, enc_mods: Mapping[str, BaseEncMod], batch_mods: typing.Iterable[str]) \
+            -> Mapping[str, Distr]:
+        """
+        Fuse all subsets with product of experts in one batched reduction. The prior expert is part of every subset.
+        """
+        s_keys, batch_mod_strs, subset_mask = self.get_batch_subsets(batch_mods)
+        mus, logvars = self.stack_enc_mods(enc_mods, batch_mod_strs)
+
+        # add the prior expert
+        mus = torch.cat((mus, torch.zeros_like(mus[:1])), dim=0)
+        logvars = torch.cat((logvars, torch.zeros_like(logvars[:1])), dim=0)
+        subset_mask = torch.cat((subset_mask, torch.ones_like(subset_mask[:, :1])), dim=-1)
+
+        mus_subsets, logvars_subsets = POEMMVae.poe_subsets(mus, logvars, subset_mask)
+
+        return {s_key: Distr(mu=mus_subsets[idx], logvar=logvars_subsets[idx]) for idx, s_key in enumerate(s_keys)}
+
     @staticmethod
     def fusion_condition(subset, input_batch=None):
         return len(subset) == len(input_batch)
 
     @staticmethod
+    @full_precision
     def poe(mu, logvar, eps=1e-8):
         """
         The product of Gaussian experts is itself Gaussian with mean µ = (∑_i µ_i T_i)(∑_i T_i)^-1 and
@@ -61,4 +75,23 @@ class POEMMVae(BaseMMVAE):
         pd_var = 1. / V
         pd_mu = torch.sum(mu * T, dim=0) / V
         pd_logvar = torch.log(pd_var)
-        return pd_mu, pd_logvar
\ No newline at end of file
+        return pd_mu, pd_logvar
+
+    @staticmethod
+    @full_precision
+    def poe_subsets(mu, logvar, subset_mask, eps=1e-8):
+        """
+        Batched version of poe that computes the product of experts of all subsets at once.
+
+        mu, logvar Tensor: parameters of the experts with shape (num_experts, bs, class_dim)
+        subset_mask Tensor: boolean membership mask of shape (num_subsets, num_experts)
+        Returns the mus and logvars of the subsets with shape (num_subsets, bs, class_dim).
+        """
+        var = torch.exp(logvar) + eps
+        T = 1. / var
+        mask = subset_mask.to(T.dtype)
+        V = torch.einsum('se,ebd->sbd', mask, T)
+        pd_var = 1. / V
+        pd_mu = torch.einsum('se,ebd->sbd', mask, mu * T) / V
+        pd_logvar = torch.log(pd_var)
+        return pd_mu, pd_logvar
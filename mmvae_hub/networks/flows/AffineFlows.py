@@ -6,6 +6,16 @@ import torch
 from torch import nn
 
 from mmvae_hub.utils.Dataclasses.Dataclasses import PlanarFlowParams
+from mmvae_hub.utils.precision import full_precision
+
+
+class AffineCouplingBlock(Fm.AllInOneBlock):
+    """
+    AllInOneBlock whose subnetwork runs under autocast, while the exponential of the coupling coefficients, the
+    global scaling and their log determinants are computed in float32.
+    """
+    _affine = full_precision(Fm.AllInOneBlock._affine)
+    _permute = full_precision(Fm.AllInOneBlock._permute)
 
 
 class AffineFlow(nn.Module):
@@ -21,9 +31,10 @@ class AffineFlow(nn.Module):
             # see here for more details: https://vll-hd.github.io/FrEIA/_build/html/FrEIA.modules.html#coupling-blocks
             self.flow = Ff.SequenceINN(class_dim)
             for _ in range(num_flows):
-                self.flow.append(Fm.AllInOneBlock, subnet_constructor=self.subnet_fc, permute_soft=True)
+                self.flow.append(AffineCouplingBlock, subnet_constructor=self.subnet_fc, permute_soft=True)
 
     def forward(self, z0, flow_params=None):
+        # the log determinant of the jacobian is accumulated over the flows in float32, see AffineCouplingBlock.
         if self.num_flows == 0:
             return z0, torch.zeros_like(z0)
         zk, log_det_jacobian = self.flow(z0)
@@ -1,30 +1,54 @@
+import functools
 import math
+from typing import List
 
 import torch.distributions as distr
 import torch.nn.functional as F
+from torch.distributions import Distribution
+from torch.utils.checkpoint import checkpoint
+
+from mmvae_hub import log
 from mmvae_hub.networks.FlowVaes import MoFoPoE
 # from mmvae_hub.networks.GfMVaes import MopGfM
 #
 from mmvae_hub.networks.MixtureVaes import MOEMMVae, MoPoEMMVae
 from mmvae_hub.networks.PoEMMVAE import POEMMVae
-from mmvae_hub.networks.utils.utils import get_distr
+from mmvae_hub.networks.utils.utils import get_distr, unbind_distr
 from mmvae_hub.utils.Dataclasses.iwdataclasses import *
 from mmvae_hub.utils.metrics.likelihood import log_mean_exp
+from mmvae_hub.utils.precision import full_precision
 
 
+@full_precision
 def log_mean_exp(value, dim=0, keepdim=False):
     return torch.logsumexp(value, dim, keepdim=keepdim) - math.log(value.size(dim))
 
 
 class iwMMVAE():
+    # if the calculate_loss of the model computes the log-likelihoods with subset_log_likelihoods, such that
+    # the importance samples can be decoded in chunks.
+    supports_chunked_decoding = False
+
     def __init__(self, flags):
         self.K = flags.K
-
-    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None):
+        if flags.iw_chunk_size and not self.supports_chunked_decoding:
+            raise ValueError(f'{type(self).__name__} does not support decoding the importance samples in chunks, '
+                             f'iw_chunk_size needs to be 0.')
+        if 0 < flags.iw_chunk_size < flags.K and not flags.decoder_checkpointing:
+            log.warning('iw_chunk_size without decoder_checkpointing only saves memory when no gradients are '
+                        'computed: during training, the activations of all chunks are kept for the backward pass.')
+
+    @property
+    def decode_in_chunks(self) -> bool:
+        return 0 < self.flags.iw_chunk_size < self.K
+
+    def conditioned_generation(self, input_samples: dict, subset_key: str, style=None,
+                               out_mods: Optional[Iterable[str]] = None):
         """
         Generate samples conditioned with input samples for a given subset.
 
         subset_key str: The key indicating which subset is used for the generation.
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
 
         # infer latents from batch
@@ -32,23 +56,92 @@ class iwMMVAE():
 
         subset_embedding = joint_latents.subsets[subset_key].qz_x_tilde.mean
         cond_mod_in = ReparamLatent(content=subset_embedding, style=style)
-        return self.generate_from_latents(cond_mod_in)
+        return self.generate_from_latents(cond_mod_in, out_mods=out_mods)
 
-    def decode(self, enc_mods: Mapping[str, BaseEncMod], joint_latents: iwJointLatents) -> dict:
-        """Decoder outputs each reconstructed modality as a dict."""
-        rec_mods = {}
-        for subset_str, subset in joint_latents.subsets.items():
-            subset_samples = subset.zs.reshape((self.K * self.flags.batch_size, self.flags.class_dim))
-            rec_mods[subset_str] = {
-                out_mod_str: dec_mod.calc_likelihood(class_embeddings=subset_samples,
-                                                     unflatten=(self.K, self.flags.batch_size)
-                                                     )
-                for out_mod_str, dec_mod in self.modalities.items()
+    def decode(self, enc_mods: Mapping[str, BaseEncMod], joint_latents: iwJointLatents) -> Optional[dict]:
+        """
+        Decoder outputs each reconstructed modality as a dict.
+        If the samples are decoded in chunks, they are only decoded in calculate_loss and None is returned.
+        """
+        if self.decode_in_chunks:
+            return None
+        return self.decode_subset_samples({subset_str: subset.zs for subset_str, subset in
+                                           joint_latents.subsets.items()})
+
+    def decode_subset_samples(self, subset_samples: Mapping[str, Tensor]) -> dict:
+        """
+        Decode the importance samples of shape (K, bs, class_dim) of every subset.
+        Returns a dict {subset_str: {out_mod_str: px_z}} where each px_z has batch shape (K, bs, ...).
+
+        If flags.stacked_decoding is set, the samples of all subsets are stacked such that every decoder is only
+        called once. The resulting distributions are split back into one distribution per subset.
+        """
+        if not self.flags.stacked_decoding:
+            return {
+                subset_str: {
+                    out_mod_str: dec_mod.calc_likelihood(
+                        class_embeddings=samples.reshape((-1, self.flags.class_dim)), unflatten=samples.shape[:2])
+                    for out_mod_str, dec_mod in self.modalities.items()
+                }
+                for subset_str, samples in subset_samples.items()
             }
+
+        subset_strs = list(subset_samples)
+        stacked_samples = torch.stack([subset_samples[subset_str] for subset_str in subset_strs])
+        unflatten = stacked_samples.shape[:3]
+        stacked_samples = stacked_samples.reshape((-1, self.flags.class_dim))
+
+        rec_mods = {subset_str: {} for subset_str in subset_strs}
+        for out_mod_str, dec_mod in self.modalities.items():
+            px_z = dec_mod.calc_likelihood(class_embeddings=stacked_samples, unflatten=unflatten)
+            for subset_str, subset_px_z in zip(subset_strs, unbind_distr(px_z)):
+                rec_mods[subset_str][out_mod_str] = subset_px_z
         return rec_mods
 
+    @staticmethod
+    def rec_log_likelihood(rec_mods: Mapping[str, Distribution], batch_d: dict) -> Tensor:
+        """log p(x|z) of the reconstructions of shape (K, bs), summed over the output modalities."""
+        lpx_z = [px_z.log_prob(batch_d[out_mod_str]).view(*px_z.batch_shape[:2], -1).sum(-1)
+                 for out_mod_str, px_z in rec_mods.items()]
+        return torch.stack(lpx_z).sum(0)
+
+    def subset_log_likelihoods(self, rec_mods: Optional[dict], subset_samples: Mapping[str, Tensor],
+                               batch_d: dict) -> Mapping[str, Tensor]:
+        """
+        Compute log p(x|z) of the importance samples of every subset, with shape (K, bs).
+
+        If the samples were decoded in the forward pass, the log-likelihoods are computed from rec_mods. Otherwise,
+        the K dimension is processed in chunks of flags.iw_chunk_size, such that only the decoder outputs of one
+        chunk are in memory at a time. Since only the log-likelihood of each sample is kept, the log-mean-exp over
+        the K samples of the loss stays exact. With flags.decoder_checkpointing, the decoder activations of the
+        chunks are not kept for the backward pass but recomputed.
+        """
+        if rec_mods is not None:
+            return {subset_str: self.rec_log_likelihood(rec_mods[subset_str], batch_d) for subset_str in subset_samples}
+
+        subset_strs = list(subset_samples)
+        chunk_lpx_z = functools.partial(self._chunk_log_likelihoods, subset_strs=subset_strs, batch_d=batch_d)
+        use_checkpointing = self.flags.decoder_checkpointing and self.training and torch.is_grad_enabled()
+
+        lpx_zs = []
+        for chunk in torch.stack([subset_samples[subset_str] for subset_str in subset_strs]).split(
+                self.flags.iw_chunk_size, dim=1):
+            # the non-reentrant checkpoint also propagates the gradients of the decoder parameters if the samples do
+            # not require gradients.
+            lpx_zs.append(checkpoint(chunk_lpx_z, chunk, use_reentrant=False) if use_checkpointing
+                          else chunk_lpx_z(chunk))
+
+        return dict(zip(subset_strs, torch.cat(lpx_zs, dim=1).unbind(0)))
+
+    def _chunk_log_likelihoods(self, chunk: Tensor, subset_strs: List[str], batch_d: dict) -> Tensor:
+        """Decode a chunk of samples of shape (num_subsets, chunk_size, bs, class_dim) and return log p(x|z)."""
+        rec_mods = self.decode_subset_samples(dict(zip(subset_strs, chunk.unbind(0))))
+        return torch.stack([self.rec_log_likelihood(rec_mods[subset_str], batch_d) for subset_str in subset_strs])
+
 
 class iwPoE(iwMMVAE, POEMMVae):
+    supports_chunked_decoding = True
+
     def __init__(self, exp, flags, modalities, subsets):
         POEMMVae.__init__(self, exp, flags, modalities, subsets)
         iwMMVAE.__init__(self, flags)
@@ -73,10 +166,7 @@ class iwPoE(iwMMVAE, POEMMVae):
             subsets[subset_str] = iwSubset(qz_x_tilde=qz_x_tilde, zs=qz_x_tilde.rsample(torch.Size([self.K])))
 
         # find the subset will all modalities to get the joint distr
-        max_subset_size = max(len(subset_str.split('_')) for subset_str in joint_latents.fusion_subsets_keys)
-
-        joint_distr = subsets[[subset_str for subset_str in joint_latents.fusion_subsets_keys if
-                               len(subset_str.split('_')) == max_subset_size][0]]
+        joint_distr = subsets[max(joint_latents.fusion_subsets_keys, key=self.subset_registry.get_size)]
 
         joint_latents = iwJointLatents(fusion_subsets_keys=joint_latents.fusion_subsets_keys, subsets=subsets, zss=zss,
                                        joint_distr=joint_distr)
@@ -100,6 +190,9 @@ class iwPoE(iwMMVAE, POEMMVae):
     def calculate_loss(self, forward_results: iwForwardResults, batch_d: dict) -> tuple[
         float, float, dict, Mapping[str, float]]:
         subsets = forward_results.joint_latents.subsets
+        lpx_zs = self.subset_log_likelihoods(forward_results.rec_mods,
+                                             {mod_str: subsets[mod_str].zs for mod_str in forward_results.enc_mods},
+                                             batch_d)
         losses = []
         klds = {}
         log_probs = {}
@@ -113,11 +206,8 @@ class iwPoE(iwMMVAE, POEMMVae):
                 torch.stack(
                     [subsets[mod].qz_x_tilde.log_prob(subset.zs).sum(-1) for mod in forward_results.enc_mods]))
 
-            lpx_z = [px_z.log_prob(batch_d[out_mod_str]).view(*px_z.batch_shape[:2], -1).sum(-1)
-                     for out_mod_str, px_z in forward_results.rec_mods[mod_str].items()]
-
-            # sum over modalities
-            lpx_z = torch.stack(lpx_z).sum(0)
+            # summed over modalities
+            lpx_z = lpx_zs[mod_str]
 
             kl_div = lpz - lqz_x
 
@@ -136,6 +226,8 @@ class iwPoE(iwMMVAE, POEMMVae):
 
 
 class iwMoE(iwMMVAE, MOEMMVae):
+    supports_chunked_decoding = True
+
     def __init__(self, exp, flags, modalities, subsets):
         MOEMMVae.__init__(self, exp, flags, modalities, subsets)
         iwMMVAE.__init__(self, flags)
@@ -160,10 +252,7 @@ class iwMoE(iwMMVAE, MOEMMVae):
             subsets[subset_str] = iwSubset(qz_x_tilde=qz_x_tilde, zs=qz_x_tilde.rsample(torch.Size([self.K])))
 
         # find the subset will all modalities to get the joint distr
-        max_subset_size = max(len(subset_str.split('_')) for subset_str in joint_latents.fusion_subsets_keys)
-
-        joint_distr = subsets[[subset_str for subset_str in joint_latents.fusion_subsets_keys if
-                               len(subset_str.split('_')) == max_subset_size][0]]
+        joint_distr = subsets[max(joint_latents.fusion_subsets_keys, key=self.subset_registry.get_size)]
 
         joint_latents = iwJointLatents(fusion_subsets_keys=joint_latents.fusion_subsets_keys, subsets=subsets, zss=zss,
                                        joint_distr=joint_distr)
@@ -187,6 +276,9 @@ class iwMoE(iwMMVAE, MOEMMVae):
     def calculate_loss(self, forward_results: iwForwardResults, batch_d: dict) -> tuple[
         float, float, dict, Mapping[str, float]]:
         subsets = forward_results.joint_latents.subsets
+        lpx_zs = self.subset_log_likelihoods(forward_results.rec_mods,
+                                             {mod_str: subsets[mod_str].zs for mod_str in forward_results.enc_mods},
+                                             batch_d)
         losses = []
         klds = {}
         log_probs = {}
@@ -200,11 +292,8 @@ class iwMoE(iwMMVAE, MOEMMVae):
                 torch.stack(
                     [subsets[mod].qz_x_tilde.log_prob(subset.zs).sum(-1) for mod in forward_results.enc_mods]))
 
-            lpx_z = [px_z.log_prob(batch_d[out_mod_str]).view(*px_z.batch_shape[:2], -1).sum(-1)
-                     for out_mod_str, px_z in forward_results.rec_mods[mod_str].items()]
-
-            # sum over modalities
-            lpx_z = torch.stack(lpx_z).sum(0)
+            # summed over modalities
+            lpx_z = lpx_zs[mod_str]
 
             kl_div = lpz - lqz_x
 
@@ -223,6 +312,8 @@ class iwMoE(iwMMVAE, MOEMMVae):
 
 
 class iwMoPoE(iwMMVAE, MoPoEMMVae):
+    supports_chunked_decoding = True
+
     def __init__(self, exp, flags, modalities, subsets):
         MoPoEMMVae.__init__(self, exp, flags, modalities, subsets)
         iwMMVAE.__init__(self, flags)
@@ -248,10 +339,7 @@ class iwMoPoE(iwMMVAE, MoPoEMMVae):
             subsets[subset_str] = iwSubset(qz_x_tilde=qz_x_tilde, zs=qz_x_tilde.rsample(torch.Size([self.K])))
 
         # find the subset will all modalities to get the joint distr
-        max_subset_size = max(len(subset_str.split('_')) for subset_str in joint_latents.fusion_subsets_keys)
-
-        joint_distr = subsets[[subset_str for subset_str in joint_latents.fusion_subsets_keys if
-                               len(subset_str.split('_')) == max_subset_size][0]]
+        joint_distr = subsets[max(joint_latents.fusion_subsets_keys, key=self.subset_registry.get_size)]
 
         joint_latents = iwJointLatents(fusion_subsets_keys=joint_latents.fusion_subsets_keys, subsets=subsets, zss=zss,
                                        joint_distr=joint_distr)
@@ -275,6 +363,8 @@ class iwMoPoE(iwMMVAE, MoPoEMMVae):
     def calculate_loss(self, forward_results: iwForwardResults, batch_d: dict) -> tuple[
         float, float, dict, Mapping[str, float]]:
         subsets = forward_results.joint_latents.subsets
+        lpx_zs = self.subset_log_likelihoods(forward_results.rec_mods,
+                                             {mod_str: subset.zs for mod_str, subset in subsets.items()}, batch_d)
         losses = []
         klds = {}
         log_probs = {}
@@ -288,10 +378,7 @@ class iwMoPoE(iwMMVAE, MoPoEMMVae):
 
             lqz_x = subset.qz_x_tilde.log_prob(subset.zs).sum(-1)
 
-            lpx_z = [px_z.log_prob(batch_d[out_mod_str]).view(*px_z.batch_shape[:2], -1).sum(-1)
-                     for out_mod_str, px_z in forward_results.rec_mods[mod_str].items()]
-
-            lpx_z = torch.stack(lpx_z).sum(0)
+            lpx_z = lpx_zs[mod_str]
             kl_div = lpz - lqz_x
 
             loss = lpx_z + kl_div
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def embed_text(conv: nn.Conv1d, x: Tensor) -> Tensor:
+    """
+    Apply the first convolution of a character level text network to x, where x is either one-hot encoded with shape
+    (*, len_seq, num_features) or given as character indices with shape (*, len_seq).
+
+    A convolution over one-hot vectors is a sum of embedding lookups: for character indices, every kernel tap of the
+    weight is used as an embedding table and the embeddings of the positions under the kernel are summed.
+    The result is the same as for the one-hot input, with shape (*, out_channels, len_out), such that the same
+    weights can be used for both representations.
+    """
+    if x.is_floating_point():
+        return conv(x.transpose(-2, -1))
+
+    assert conv.dilation == (1,) and conv.groups == 1 and conv.padding_mode == 'zeros', \
+        'Only plain convolutions can be applied to character indices.'
+    (kernel_size,), (stride,), (padding,) = conv.kernel_size, conv.stride, conv.padding
+    out_channels, num_features, _ = conv.weight.shape
+
+    # embedding of every character for every kernel tap, with shape (*, len_seq, kernel_size, out_channels)
+    emb = F.embedding(x.long(), conv.weight.permute(1, 2, 0).reshape(num_features, kernel_size * out_channels))
+    emb = emb.unflatten(-1, (kernel_size, out_channels))
+    emb = F.pad(emb, (0, 0, 0, 0, padding, padding))
+
+    len_out = (emb.shape[-3] - kernel_size) // stride + 1
+    out = sum(emb[..., k:k + stride * (len_out - 1) + 1:stride, k, :] for k in range(kernel_size))
+    if conv.bias is not None:
+        out = out + conv.bias
+    return out.transpose(-2, -1)
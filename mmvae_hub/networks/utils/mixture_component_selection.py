@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
+from mmvae_hub.utils.utils import split_int_to_bins
 
 
 def mixture_component_selection(flags, mus, logvars, w_modalities=None) -> Distr:
@@ -14,27 +15,82 @@ def mixture_component_selection(flags, mus, logvars, w_modalities=None) -> Distr
     mus Tensor: mus of the experts. Has shape (num_experts, bs, class_dim)
     logvars Tensor: logvars of the experts. Has shape (num_experts, bs, class_dim)
     """
-    num_components = mus.shape[0]
     # num_samples is the batch_size
     num_samples = mus.shape[1]
     # if not defined, take pre-defined weights
     if w_modalities is None:
         w_modalities = torch.Tensor(flags.alpha_modalities).to(flags.device)
 
-    idx_start = []
-    idx_end = []
-    for k in range(num_components):
-        i_start = 0 if k == 0 else int(idx_end[k - 1])
-        if k == w_modalities.shape[0] - 1:
-            i_end = num_samples
-        else:
-            i_end = i_start + int(torch.floor(num_samples * w_modalities[k]))
-        idx_start.append(i_start)
-        idx_end.append(i_end)
+    component_idx = component_indices_from_bins(torch.floor(num_samples * w_modalities).long(), num_samples)
 
-    idx_end[-1] = num_samples
+    return Distr(mu=select_components(mus, component_idx), logvar=select_components(logvars, component_idx))
 
-    mu_sel = torch.cat([mus[k, idx_start[k]:idx_end[k], :] for k in range(w_modalities.shape[0])])
-    logvar_sel = torch.cat([logvars[k, idx_start[k]:idx_end[k], :] for k in range(w_modalities.shape[0])])
 
-    return Distr(mu=mu_sel, logvar=logvar_sel)
+def select_components(experts: Tensor, component_idx: Tensor) -> Tensor:
+    """
+    Select for every sample the embedding of the chosen expert with a single gather.
+
+    experts Tensor: embeddings of the experts with shape (num_experts, bs, ...)
+    component_idx Tensor: index of the chosen expert for every sample, with shape (..., bs)
+    Returns the selected embeddings with shape (..., bs, ...)
+    """
+    return experts[component_idx, torch.arange(experts.shape[1], device=experts.device)]
+
+
+def component_indices_from_bins(bin_sizes: Tensor, num_samples: int) -> Tensor:
+    """
+    Deterministic routing: the experts take consecutive parts of the batch with the given sizes.
+    The last expert takes the remainder of the batch.
+
+    bin_sizes Tensor: integer tensor of shape (..., num_experts)
+    Returns the index of the chosen expert for every sample, with shape (..., num_samples).
+    """
+    bin_ends = bin_sizes.cumsum(-1).clamp(max=num_samples)
+    bin_ends[..., -1] = num_samples
+    sample_idx = torch.arange(num_samples, device=bin_sizes.device).expand(*bin_ends.shape[:-1], num_samples)
+    return torch.searchsorted(bin_ends, sample_idx.contiguous(), right=True)
+
+
+def sample_component_indices(weights: Tensor, num_samples: int) -> Tensor:
+    """
+    Stochastic routing: every sample chooses an expert independently, with probability proportional to weights.
+
+    weights Tensor: non-negative weights of the experts with shape (num_experts,)
+    Returns the index of the chosen expert for every sample, with shape (num_samples,).
+    """
+    return torch.multinomial(weights, num_samples, replacement=True)
+
+
+def mixture_bins(num_samples: int, nbr_components: int, confidences: Optional[Tensor] = None) -> Tensor:
+    """
+    Number of samples that is taken from each expert.
+    If confidences are given, the experts get a part of the batch that is proportional to their confidence and the
+    rounding remainder goes to the most confident expert. Otherwise the batch is split into equal parts.
+    """
+    if confidences is None:
+        return torch.as_tensor(split_int_to_bins(number=num_samples, nbr_bins=nbr_components), dtype=torch.long)
+
+    bins = (num_samples * (confidences / confidences.sum())).long()
+    bins[confidences.argmax()] += num_samples - bins.sum()
+    return bins
+
+
+def subset_component_indices(subset_mask: Tensor, num_samples: int) -> Tensor:
+    """
+    For every subset, assign each sample of the batch to one of the experts in the subset. As in
+    mixture_component_selection with equal weights, every expert takes an equal part of the batch and the last expert
+    takes the remainder.
+
+    subset_mask Tensor: boolean membership mask of shape (num_subsets, num_experts)
+    Returns the indices of the selected experts, with shape (num_subsets, num_samples).
+    """
+    nbr_members = subset_mask.sum(-1, keepdim=True)
+    # bins of the members, ordered by their rank in the subset
+    member_rank = torch.arange(subset_mask.shape[-1], device=subset_mask.device).expand_as(subset_mask)
+    bin_sizes = torch.where(member_rank < nbr_members, num_samples // nbr_members, 0)
+    bin_sizes = torch.where(member_rank == nbr_members - 1, num_samples - (nbr_members - 1) * bin_sizes, bin_sizes)
+    member_rank = component_indices_from_bins(bin_sizes, num_samples)
+
+    # the expert indices of the members come first, in ascending order
+    member_idx = torch.argsort((~subset_mask).to(torch.int8), dim=-1, stable=True)
+    return member_idx.gather(-1, member_rank)
@@ -1,4 +1,6 @@
-from torch.distributions import Normal, Laplace
+import typing
+
+from torch.distributions import Normal, Laplace, Distribution, OneHotCategorical, Categorical, Bernoulli
 
 
 def get_distr(distr_str: str):
@@ -8,3 +10,26 @@ def get_distr(distr_str: str):
         return Laplace
     else:
         raise ValueError(f'not implemented for distr_str {distr_str}')
+
+
+class IndexCategorical(Categorical):
+    """
+    Categorical distribution over the character indices of a text, with batch shape (*, len_seq).
+    Like OneHotCategorical, the probabilities of the characters are used as its mean, such that generated texts have
+    the same format for both text representations.
+    """
+
+    @property
+    def mean(self):
+        return self.probs
+
+
+def unbind_distr(distr: Distribution) -> typing.List[Distribution]:
+    """
+    Split a distribution along its first batch dimension into a list of distributions of the same type.
+    Only the output distributions of the decoders (location-scale and categorical-like) are supported.
+    """
+    if isinstance(distr, (OneHotCategorical, Categorical, Bernoulli)):
+        return [type(distr)(logits=logits, validate_args=False) for logits in distr.logits.unbind(0)]
+    return [type(distr)(loc=loc, scale=scale, validate_args=False)
+            for loc, scale in zip(distr.loc.unbind(0), distr.scale.unbind(0))]
@@ -1,7 +1,11 @@
 import glob
 import os
 import random
+import tempfile
+import zipfile
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Optional, Iterable
 
 import numpy as np
 import torch
@@ -41,23 +45,14 @@ class PolymnistDataset(Dataset):
         self.transform = transform
         self.target_transform = target_transform
 
-        # save all paths to individual files
-        self.file_paths = {dp: [] for dp in self.unimodal_datapaths}
-        for dp in self.unimodal_datapaths:
-            assert Path(dp).exists(), f'data path {dp} does not exist.'
-            files = glob.glob(os.path.join(dp, "*.png"))
-            assert files, f'No png file found under {dp}'
-            self.file_paths[dp] = files
-        # assert that each modality has the same number of images
-        num_files = len(self.file_paths[dp])
-        for files in self.file_paths.values():
-            assert len(files) == num_files
-        self.num_files = num_files
+        # file names of the samples, which are the same for all modalities, and their labels
+        self.file_names, self.labels = load_png_index(dir_data)
+        self.num_files = len(self.file_names)
 
     @staticmethod
     def create_polymnist_dataset(savepath: Path, backgroundimagepath: Path, num_modalities, train):
         """Create the Multimodal MNIST Dataset under 'savepath' given a directory of background images.
-        
+
             Args:
                 savepath : path to directory that the dataset will be written to. Will be created if it does not
                     exist.
@@ -65,44 +60,9 @@ class PolymnistDataset(Dataset):
                     used per modality.
                 num_modalities (int): number of modalities to create.
                 train (bool): create the dataset based on MNIST training (True) or test data (False).
-        
-        """
-
-        # load MNIST data
-        mnist = datasets.MNIST("/tmp", train=train, download=True, transform=None)
-
-        # load background images
-        background_filepaths = sorted(
-            glob.glob(os.path.join(backgroundimagepath, "*.jpg")))  # TODO: handle more filetypes
-        print("\nbackground_filepaths:\n", background_filepaths, "\n")
-        if num_modalities > len(background_filepaths):
-            raise ValueError("Number of background images must be larger or equal to number of modalities")
-        background_images = [Image.open(fp) for fp in background_filepaths]
 
-        # create the folder structure: savepath/m{1..num_modalities}
-        for m in range(num_modalities):
-            unimodal_path = os.path.join(savepath, "m%d" % m)
-            if not os.path.exists(unimodal_path):
-                os.makedirs(unimodal_path)
-                print("Created directory", unimodal_path)
-
-        # create random pairing of images with the same digit label, add background image, and save to disk
-        cnt = 0
-        for digit in range(10):
-            ixs = (mnist.targets == digit).nonzero()
-            for m in range(num_modalities):
-                ixs_perm = ixs[torch.randperm(len(ixs))]  # one permutation per modality and digit label
-                for i, ix in enumerate(ixs_perm):
-                    # add background image
-                    new_img = PolymnistDataset._add_background_image(background_images[m], mnist.data[ix])
-                    # save as png
-                    filepath = os.path.join(savepath, "m%d/%d.%d.png" % (m, i, digit))
-                    save_image(new_img, filepath)
-                    # log the progress
-                    cnt += 1
-                    if cnt % 10000 == 0:
-                        print("Saved %d/%d images to %s" % (cnt, len(mnist) * num_modalities, savepath))
-        assert cnt == len(mnist) * num_modalities
+        """
+        create_packed_polymnist_dataset(savepath, backgroundimagepath, num_modalities, train, save_png=True)
 
     @staticmethod
     def _add_background_image(background_image_pil, mnist_image_tensor, change_colors=False):
@@ -137,23 +97,316 @@ class PolymnistDataset(Dataset):
         Returns a tuple (images, labels) where each element is a list of
         length `self.num_modalities`.
         """
-        files = [self.file_paths[dp][index] for dp in self.unimodal_datapaths]
-        images = [Image.open(files[m]) for m in range(self.num_modalities)]
-        labels = [int(files[m].split(".")[-2]) for m in range(self.num_modalities)]
+        file_name = self.file_names[index]
+        images = [Image.open(os.path.join(dp, file_name)) for dp in self.unimodal_datapaths]
+        # NOTE: for Polymnist, labels are shared across modalities
+        label = int(self.labels[index])
 
         # transforms
         if self.transform:
             images = [self.transform(img) for img in images]
         if self.target_transform:
-            labels = [self.transform(label) for label in labels]
+            label = self.target_transform(label)
 
         images_dict = {"m%d" % m: images[m] for m in range(self.num_modalities)}
-        return images_dict, labels[0]  # NOTE: for Polymnist, labels are shared across modalities, so can take one value
+        return images_dict, label
 
     def __len__(self):
         return self.num_files
 
 
+def add_background_images(background_image: np.ndarray, mnist_images: np.ndarray, rng: np.random.Generator) \
+        -> np.ndarray:
+    """
+    Vectorized version of PolymnistDataset._add_background_image for a batch of MNIST images.
+
+    background_image: uint8 array of shape (height, width, 3)
+    mnist_images: uint8 array of shape (n, 28, 28)
+    Returns a uint8 array of shape (n, 28, 28, 3) with random crops of the background image, where the colors are
+    inverted at the location of the digit.
+    """
+    num_images = mnist_images.shape[0]
+    # binarize mnist images
+    img_binarized = mnist_images > 128
+
+    # random crops of the background image
+    x_c = rng.integers(0, background_image.shape[1] - 28, size=num_images)
+    y_c = rng.integers(0, background_image.shape[0] - 28, size=num_images)
+    offsets = np.arange(28)
+    crops = background_image[(y_c[:, None] + offsets)[:, :, None], (x_c[:, None] + offsets)[:, None, :]]
+
+    # invert the colors at the location of the number
+    return np.where(img_binarized[..., None], 255 - crops, crops)
+
+
+def _create_polymnist_chunk(dir_data: Path, images_path: Path, background_filepath: str, mnist_images: np.ndarray,
+                            m: int, digit: int, start: int, seed: int, save_png: bool) -> None:
+    """
+    Create the images of modality m for all MNIST images of one digit and write them to the packed images in
+    images_path at [m, start:start + len(mnist_images)].
+    The random generator is seeded with (seed, m, digit), such that the result does not depend on the number of
+    workers.
+    """
+    rng = np.random.default_rng([seed, m, digit])
+    # one permutation per modality and digit label
+    mnist_images = mnist_images[rng.permutation(len(mnist_images))]
+
+    with Image.open(background_filepath) as background_image:
+        new_imgs = add_background_images(np.asarray(background_image.convert('RGB')), mnist_images, rng)
+
+    images = np.load(images_path, mmap_mode='r+')
+    images[m, start:start + len(new_imgs)] = new_imgs
+    images.flush()
+
+    if save_png:
+        for i, new_img in enumerate(new_imgs):
+            Image.fromarray(new_img).save(dir_data / f'm{m}' / f'{i}.{digit}.png')
+
+
+def create_packed_polymnist_dataset(dir_data: Path, backgroundimagepath: Path, num_modalities: int = 5,
+                                    train: bool = True, num_workers: Optional[int] = None, seed: int = 42,
+                                    save_png: bool = False) -> None:
+    """
+    Create a split of the Multimodal MNIST Dataset directly in the packed format (see pack_polymnist_dataset).
+
+    The images of every modality and digit are created in parallel by a pool of num_workers processes, and written
+    to the packed images by the workers. If save_png is True, the png directory layout is written as well.
+    """
+    mnist = datasets.MNIST("/tmp", train=train, download=True, transform=None)
+    mnist_images, mnist_targets = mnist.data.numpy(), mnist.targets.numpy()
+
+    background_filepaths = sorted(glob.glob(os.path.join(backgroundimagepath, "*.jpg")))
+    if num_modalities > len(background_filepaths):
+        raise ValueError("Number of background images must be larger or equal to number of modalities")
+
+    dir_data.mkdir(parents=True, exist_ok=True)
+    if save_png:
+        for m in range(num_modalities):
+            (dir_data / f'm{m}').mkdir(exist_ok=True)
+
+    # the samples are sorted by digit
+    digit_ixs = [np.flatnonzero(mnist_targets == digit) for digit in range(10)]
+    starts = np.cumsum([0] + [len(ixs) for ixs in digit_ixs])
+    labels = np.concatenate([np.full(len(ixs), digit, dtype=np.int64) for digit, ixs in enumerate(digit_ixs)])
+
+    images_path, labels_path = get_packed_paths(dir_data)
+    # the workers write to a unique temporary file, such that interrupted or concurrent runs do not leave a broken
+    # packed file.
+    tmp_images_path = _make_temporary_path(images_path)
+    try:
+        np.lib.format.open_memmap(tmp_images_path, mode='w+', dtype=np.uint8,
+                                  shape=(num_modalities, len(labels), 28, 28, 3)).flush()
+
+        log.info(f'Creating {len(labels)} samples of {num_modalities} modalities under {dir_data}.')
+        with ProcessPoolExecutor(max_workers=num_workers or None) as executor:
+            futures = [executor.submit(_create_polymnist_chunk, dir_data, tmp_images_path, background_filepaths[m],
+                                       mnist_images[digit_ixs[digit]], m, digit, int(starts[digit]), seed, save_png)
+                       for m in range(num_modalities) for digit in range(10)]
+            for future in futures:
+                future.result()
+
+        _save_atomic(labels_path, labels)
+        os.replace(tmp_images_path, images_path)
+    except BaseException:
+        tmp_images_path.unlink(missing_ok=True)
+        raise
+
+
+def _get_dir_stats(mod_dirs: Iterable[Path]) -> np.ndarray:
+    """Modification time and size of the modality directories, which change if files are added or removed."""
+    return np.array([[mod_dir.stat().st_mtime_ns, mod_dir.stat().st_size] for mod_dir in mod_dirs], dtype=np.int64)
+
+
+def get_mod_dirs(dir_data: Path) -> list:
+    """The modality directories m0, m1, ... of a split, sorted by their number, such that m10 comes after m9."""
+    return sorted((mod_dir for mod_dir in map(Path, glob.glob(str(dir_data / 'm*')))
+                   if mod_dir.is_dir() and mod_dir.name[1:].isdigit()), key=lambda mod_dir: int(mod_dir.name[1:]))
+
+
+def _make_temporary_path(path: Path) -> Path:
+    """
+    Create a unique temporary file in the directory of path, to which path is written before it is moved into place
+    with os.replace, such that interrupted or concurrent runs never leave or read a partially written file.
+    """
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix='.tmp', delete=False) as f:
+        return Path(f.name)
+
+
+def _save_atomic(path: Path, arr: np.ndarray) -> None:
+    """Save arr to a temporary file in the directory of path and rename it, such that path is never partly written."""
+    tmp_path = _make_temporary_path(path)
+    try:
+        # np.save appends .npy to file names without it, so the array is written through the file object.
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def load_png_index(dir_data: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the index of the png files of a PolyMNIST split: the sorted file names, which are the same in all modality
+    directories, such that the samples are aligned by file name, and the labels of the samples.
+
+    The index is built once and saved to dir_data / 'png_index.npz'. It is rebuilt if the modification time or size
+    of one of the modality directories changed.
+    """
+    index_path = dir_data / 'png_index.npz'
+    mod_dirs = get_mod_dirs(dir_data)
+    assert mod_dirs, f'No modality directory found under {dir_data}.'
+    mod_names = np.array([mod_dir.name for mod_dir in mod_dirs])
+    dir_stats = _get_dir_stats(mod_dirs)
+
+    if index_path.exists():
+        try:
+            with np.load(index_path) as index:
+                if np.array_equal(index['mod_names'], mod_names) and np.array_equal(index['dir_stats'], dir_stats):
+                    return index['file_names'], index['labels']
+        except (zipfile.BadZipFile, OSError, KeyError, ValueError) as e:
+            log.warning(f'Could not load the png index {index_path}, it is rebuilt: {e}')
+
+    log.info(f'Building the png index of {dir_data}.')
+    file_names = sorted(file_name for file_name in os.listdir(mod_dirs[0]) if file_name.endswith('.png'))
+    assert file_names, f'No png file found under {mod_dirs[0]}'
+    # assert that each modality has the same images
+    for mod_dir in mod_dirs[1:]:
+        assert sorted(file_name for file_name in os.listdir(mod_dir) if file_name.endswith('.png')) == file_names, \
+            f'The png files under {mod_dir} do not match the ones under {mod_dirs[0]}.'
+
+    file_names = np.array(file_names)
+    labels = np.array([int(file_name.split(".")[-2]) for file_name in file_names], dtype=np.int64)
+    try:
+        # write to a temporary file and rename it, such that an interrupted run or a concurrent one never leaves a
+        # partially written index.
+        with tempfile.NamedTemporaryFile(dir=dir_data, prefix=index_path.name, suffix='.tmp', delete=False) as f:
+            np.savez(f, file_names=file_names, labels=labels, mod_names=mod_names, dir_stats=dir_stats)
+        os.replace(f.name, index_path)
+    except OSError as e:
+        log.warning(f'Could not save the png index to {index_path}: {e}')
+
+    return file_names, labels
+
+
+def get_packed_paths(dir_data: Path) -> Tuple[Path, Path]:
+    """Paths to the packed images and labels of a PolyMNIST split."""
+    return dir_data / 'packed_images.npy', dir_data / 'packed_labels.npy'
+
+
+def pack_polymnist_dataset(dir_data: Path, num_modalities: int = 5) -> None:
+    """
+    Pack a split of the PolyMNIST dataset from the png directory layout into a memory-mappable format:
+    one uint8 array of shape (num_modalities, num_samples, 28, 28, 3), such that the images of each modality are
+    contiguous, and an array with the labels.
+
+    The samples of the modalities are paired by their file name.
+    """
+    images_path, labels_path = get_packed_paths(dir_data)
+    unimodal_datapaths = get_mod_dirs(dir_data)[:num_modalities]
+    assert len(unimodal_datapaths) == num_modalities, f'Found {len(unimodal_datapaths)} modalities under {dir_data}.'
+
+    file_names, labels = load_png_index(dir_data)
+    log.info(f'Packing {len(file_names)} samples of {num_modalities} modalities under {dir_data}.')
+
+    # write to a unique temporary file first, such that interrupted or concurrent conversions do not leave a broken
+    # packed file.
+    tmp_images_path = _make_temporary_path(images_path)
+    try:
+        images = np.lib.format.open_memmap(tmp_images_path, mode='w+', dtype=np.uint8,
+                                           shape=(num_modalities, len(file_names), 28, 28, 3))
+        for m, dp in enumerate(unimodal_datapaths):
+            for idx, file_name in enumerate(file_names):
+                with Image.open(os.path.join(dp, file_name)) as img:
+                    images[m, idx] = np.asarray(img.convert('RGB'))
+        images.flush()
+        del images
+
+        _save_atomic(labels_path, labels)
+        os.replace(tmp_images_path, images_path)
+    except BaseException:
+        tmp_images_path.unlink(missing_ok=True)
+        raise
+
+
+class PackedPolymnistDataset(Dataset):
+    """
+    Multimodal MNIST Dataset, served from the packed format written by pack_polymnist_dataset.
+
+    The packed images are memory-mapped, such that a sample is a slice of the packed array instead of num_modalities
+    png files that need to be opened and decoded.
+    """
+
+    def __init__(self, dir_data: Path, transform=None, target_transform=None, num_modalities: int = 5):
+        super().__init__()
+        self.images_path, labels_path = get_packed_paths(dir_data)
+        self.labels = np.load(labels_path)
+        self.num_modalities = num_modalities
+        self.transform = transform
+        self.target_transform = target_transform
+
+        # the memory map is opened lazily in each dataloader worker.
+        self._images = None
+        num_packed_mods, num_samples = self.images.shape[:2]
+        assert num_modalities <= num_packed_mods, \
+            f'{self.images_path} contains {num_packed_mods} modalities, {num_modalities} are needed.'
+        assert num_samples == len(self.labels)
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            # copy-on-write, such that the slices can be passed to torch without a copy.
+            self._images = np.load(self.images_path, mmap_mode='c')
+        return self._images
+
+    def __getstate__(self):
+        # do not pickle the memory map with the dataset.
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __getitem__(self, index):
+        """
+        Returns a tuple (images, label) where images is a dict with the image of each modality.
+        """
+        images = [self.images[m, index] for m in range(self.num_modalities)]
+        label = int(self.labels[index])
+
+        # transforms
+        if self.transform:
+            images = [self.transform(img) for img in images]
+        if self.target_transform:
+            label = self.target_transform(label)
+
+        images_dict = {"m%d" % m: images[m] for m in range(self.num_modalities)}
+        return images_dict, label
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def get_polymnist_dataset(dir_data: Path, transform=None, num_modalities: int = 5, packed: bool = True,
+                          num_workers: Optional[int] = None) -> Dataset:
+    """
+    Get a split of the PolyMNIST dataset. If packed is True, the split is packed on first use and served from the
+    packed format. Otherwise the png files are read.
+    If the split does not exist, it is created with num_workers processes.
+    """
+    if packed:
+        images_path, labels_path = get_packed_paths(dir_data)
+        if not (images_path.exists() and labels_path.exists()):
+            if dir_data.exists():
+                pack_polymnist_dataset(dir_data, num_modalities)
+            else:
+                log.info(f'data dir {dir_data} does not exist. Creating PolyMNIST dataset.')
+                create_packed_polymnist_dataset(dir_data, Path(__file__).parent / 'polymnist_background_images',
+                                                num_modalities, train=dir_data.name == 'train',
+                                                num_workers=num_workers)
+        return PackedPolymnistDataset(dir_data, transform=transform, num_modalities=num_modalities)
+
+    return PolymnistDataset(dir_data, transform=transform, num_modalities=num_modalities)
+
+
 class ToyPolymnistDataset(Dataset):
     """Toy Polymnist dataset for testing purposes."""
 
@@ -10,7 +10,7 @@ from torchvision import transforms
 
 from mmvae_hub.base.BaseExperiment import BaseExperiment
 from mmvae_hub.modalities import BaseModality
-from mmvae_hub.polymnist.PolymnistDataset import PolymnistDataset, ToyPolymnistDataset
+from mmvae_hub.polymnist.PolymnistDataset import ToyPolymnistDataset, get_polymnist_dataset
 from mmvae_hub.polymnist.PolymnistMod import PolymnistMod
 from mmvae_hub.polymnist.metrics import PolymnistMetrics
 from mmvae_hub.utils.utils import dict_to_device
@@ -52,10 +52,12 @@ class PolymnistExperiment(BaseExperiment):
             train = ToyPolymnistDataset(num_modalities=self.num_modalities, seed=self.flags.seed)
             test = ToyPolymnistDataset(num_modalities=self.num_modalities, seed=self.flags.seed)
         else:
-            train = PolymnistDataset(Path(self.flags.dir_data) / 'train', transform=transform,
-                                     num_modalities=self.num_modalities)
-            test = PolymnistDataset(Path(self.flags.dir_data) / 'train', transform=transform,
-                                    num_modalities=self.num_modalities)
+            train = get_polymnist_dataset(Path(self.flags.dir_data) / 'train', transform=transform,
+                                          num_modalities=self.num_modalities, packed=self.flags.packed_data,
+                                          num_workers=self.flags.dataloader_workers)
+            test = get_polymnist_dataset(Path(self.flags.dir_data) / 'train', transform=transform,
+                                         num_modalities=self.num_modalities, packed=self.flags.packed_data,
+                                         num_workers=self.flags.dataloader_workers)
         return train, test
 
     def set_rec_weights(self):
@@ -1,7 +1,7 @@
 from pathlib import Path
 
 from mmvae_hub.base.BaseFlags import parser as parser
-from mmvae_hub.utils.setup.flags_utils import BaseFlagsSetup
+from mmvae_hub.utils.setup.flags_utils import BaseFlagsSetup, str2bool
 
 parser.add_argument('--name', type=str, default='polymnist', help="name of the dataset")
 parser.add_argument('--exp_str_prefix', type=str, default='polymnist', help="prefix of the experiment directory.")
@@ -14,6 +14,9 @@ parser.add_argument('--style_dim', type=int, default=0,
 # parser.add_argument('--style_m2_dim', type=int, default=0, help="dimension of varying factor latent space")
 # parser.add_argument('--style_m3_dim', type=int, default=0, help="dimension of varying factor latent space")
 
+parser.add_argument('--packed_data', type=str2bool, default=True,
+                    help="If True, each split is packed into one memory-mapped array on first use and the samples "
+                         "are read from it. Otherwise the png files of the samples are opened for every sample.")
 parser.add_argument('--num_classes', type=int, default=10, help="number of classes on which the data set trained")
 
 parser.add_argument('--img_size_m1', type=int, default=28, help="img dimension (width/height)")
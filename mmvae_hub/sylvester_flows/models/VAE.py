@@ -213,9 +213,11 @@ class VAE(nn.Module):
 
         return loss, kl, {'m0': rec}, {'m0': kl}
 
-    def generate(self, num_samples=None) -> Mapping[str, Tensor]:
+    def generate(self, num_samples=None, out_mods: Optional[Iterable[str]] = None) -> Mapping[str, Tensor]:
         """
         Generate from latents that were sampled from a normal distribution.
+
+        out_mods: The modalities that are generated. If None, all modalities are generated.
         """
         if num_samples is None:
             num_samples = self.flags.batch_size
@@ -224,7 +226,7 @@ class VAE(nn.Module):
         z_styles = {'m0': None}
 
         random_latents = ReparamLatent(content=z_class, style=z_styles)
-        return self.generate_from_latents(random_latents)
+        return self.generate_from_latents(random_latents, out_mods=out_mods)
 
     def get_rand_samples_from_joint(self, num_samples: int):
         """
@@ -236,9 +238,10 @@ class VAE(nn.Module):
                              self.flags.class_dim).to(self.flags.device)
         return Distr(mu, logvar).reparameterize()
 
-    def generate_from_latents(self, latents: ReparamLatent) -> Mapping[str, Tensor]:
+    def generate_from_latents(self, latents: ReparamLatent,
+                              out_mods: Optional[Iterable[str]] = None) -> Mapping[str, Tensor]:
         cond_gen = {}
-        for mod_str in ['m0']:
+        for mod_str in (['m0'] if out_mods is None else out_mods):
             suff_stats = self.generate_sufficient_statistics_from_latents(latents)
             tmp = suff_stats[mod_str].view(-1, 256, 3, 28, 28).max(dim=1)[1]
             cond_gen[mod_str] = tmp.float() / (256 - 1.)
@@ -247,13 +250,13 @@ class VAE(nn.Module):
     def generate_sufficient_statistics_from_latents(self, latents: ReparamLatent):
         cond_gen = {}
         for mod_str in ['m0']:
-            style_m = latents.style[mod_str]
             content = latents.content
             cond_gen_m = self.decode(content)
             cond_gen[mod_str] = cond_gen_m
         return cond_gen
 
-    def cond_generation(self, joint_latent: JointLatents, num_samples=None) -> Mapping[str, Mapping[str, Tensor]]:
+    def cond_generation(self, joint_latent: JointLatents, num_samples=None,
+                        out_mods: Optional[Iterable[str]] = None) -> Mapping[str, Mapping[str, Tensor]]:
         if num_samples is None:
             num_samples = self.flags.batch_size
 
@@ -262,11 +265,11 @@ class VAE(nn.Module):
         for key in joint_latent.subsets:
             content_rep = joint_latent.get_subset_embedding(key)
             latents = ReparamLatent(content=content_rep, style=style_latents)
-            cond_gen_samples[key] = self.generate_from_latents(latents)
+            cond_gen_samples[key] = self.generate_from_latents(latents, out_mods=out_mods)
 
         joint_embedding = joint_latent.get_joint_embeddings()
         joint_latents = ReparamLatent(content=joint_embedding, style=style_latents)
-        cond_gen_samples['joint'] = self.generate_from_latents(joint_latents)
+        cond_gen_samples['joint'] = self.generate_from_latents(joint_latents, out_mods=out_mods)
 
         return cond_gen_samples
 
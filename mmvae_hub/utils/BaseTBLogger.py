@@ -78,5 +78,8 @@ class BaseTBLogger:
         self.add_basic_logs(self.training_prefix, joint_divergence, total_loss, log_probs,
                             klds)
 
+    def write_step_time(self, step_time: float):
+        self.writer.add_scalars('%s/step_time' % self.training_prefix, {'step_time': step_time}, self.step)
+
     def write_testing_logs(self, joint_divergence, total_loss, log_probs, klds):
         self.add_basic_logs(self.testing_prefix, joint_divergence, total_loss, log_probs, klds)
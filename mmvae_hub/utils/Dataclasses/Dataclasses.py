@@ -377,6 +377,14 @@ class BaseBatchResults:
     # joint_latents: Mapping[str, Tensor]
 
 
+@dataclass
+class BaseTrainResults(BaseBatchResults):
+    # (name, number of failed gradient checks) of each offending parameter
+    grad_anomalies: Optional[list] = None
+    # mean duration of a training step in seconds
+    step_time: Optional[float] = None
+
+
 @dataclass
 class BaseTestResults(BaseBatchResults):
     joint_div: float
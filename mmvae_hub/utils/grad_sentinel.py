@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import typing
+from collections import Counter
+
+import torch
+from torch import Tensor
+
+GRAD_CHECK_MODES = ('off', 'sampled', 'full')
+
+
+class GradAnomalySentinel:
+    """
+    Detects parameters with non-finite gradients after the backward pass.
+
+    mode 'off': gradients are never checked.
+    mode 'sampled': every check_freq steps, the norms of all gradients are computed with one fused reduction and
+        synchronized with the host once.
+    mode 'full': gradients are checked at every step and parameters that did not receive a gradient in any check of
+        the epoch are recorded too.
+
+    The names of the offending parameters are counted over the epoch instead of being printed.
+    """
+
+    def __init__(self, named_params: typing.Iterable[typing.Tuple[str, Tensor]], mode: str = 'sampled',
+                 check_freq: int = 100):
+        assert mode in GRAD_CHECK_MODES, f'grad check mode {mode} is not supported, choose from {GRAD_CHECK_MODES}.'
+        self.mode = mode
+        self.check_freq = max(check_freq, 1)
+
+        # parameters can be shared between the networks, check each of them only once.
+        self.named_params = {}
+        for name, param in named_params:
+            if param.requires_grad and id(param) not in self.named_params:
+                self.named_params[id(param)] = (name, param)
+        self.named_params = list(self.named_params.values())
+
+        self.anomalies = Counter()
+        # ids of the parameters that received a gradient and number of checks since the last reset, for mode 'full'.
+        self.with_grad = set()
+        self.num_checks = 0
+
+    def is_check_step(self, step: int) -> bool:
+        if self.mode == 'off':
+            return False
+        return self.mode == 'full' or step % self.check_freq == 0
+
+    def check(self, step: int) -> typing.List[str]:
+        """
+        Check the gradients if step is a check step and return the names of the parameters with a non-finite
+        gradient.
+        """
+        if not self.is_check_step(step):
+            return []
+
+        names, grads = [], []
+        offending = []
+        for name, param in self.named_params:
+            if param.grad is not None:
+                names.append(name)
+                grads.append(param.grad)
+                if self.mode == 'full':
+                    self.with_grad.add(id(param))
+        self.num_checks += 1
+
+        if grads:
+            norms = torch.stack(torch._foreach_norm(grads))
+            non_finite = ~torch.isfinite(norms)
+            # only a single synchronization with the device if no anomaly was found.
+            if non_finite.any():
+                offending.extend(names[idx] for idx in non_finite.nonzero().flatten().tolist())
+
+        self.anomalies.update(offending)
+        return offending
+
+    def get_anomalies(self) -> typing.List[typing.Tuple[str, int]]:
+        """
+        Return the number of checks that failed for each offending parameter, most frequent first, and reset the
+        counts. In mode 'full', the parameters that did not receive a gradient in any check are listed as
+        '<name>: None' with the number of checks.
+        """
+        anomalies = self.anomalies.most_common()
+        if self.mode == 'full' and self.num_checks:
+            anomalies.extend((f'{name}: None', self.num_checks) for name, param in self.named_params
+                             if id(param) not in self.with_grad)
+        self.anomalies.clear()
+        self.with_grad.clear()
+        self.num_checks = 0
+        return anomalies
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import typing
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+class LoaderManager:
+    """
+    Owns the data loaders of an experiment, such that the training, testing and evaluation loops reuse the same
+    long-lived loaders instead of forking new worker processes and pickling the datasets every time.
+
+    A loader is created for every combination of split ('train' or 'test') and shuffle, with persistent workers.
+    It is rebuilt if the dataset of the split or the batch size changes.
+    """
+
+    def __init__(self, exp):
+        self.exp = exp
+        self.flags = exp.flags
+        self._loaders: typing.Dict[typing.Tuple[str, bool], DataLoader] = {}
+
+    def get_loader(self, split: str, shuffle: bool = True) -> DataLoader:
+        """Return the persistent loader of the train or test split."""
+        dataset = getattr(self.exp, f'dataset_{split}')
+        loader = self._loaders.get((split, shuffle))
+        if loader is None or loader.dataset is not dataset or loader.batch_size != self.flags.batch_size:
+            if loader is not None:
+                self.shutdown_workers(loader)
+            loader = self._loaders[(split, shuffle)] = self.make_loader(dataset, shuffle=shuffle)
+        return loader
+
+    @property
+    def pin_memory(self) -> bool:
+        return self.flags.pin_memory and torch.device(self.flags.device).type == 'cuda'
+
+    def make_loader(self, dataset: Dataset, shuffle: bool = True, persistent: bool = True) -> DataLoader:
+        """
+        Create a loader with the loader settings of the experiment.
+        Datasets that define a collate_fn, e.g. to transform whole batches, are collated with it.
+        """
+        num_workers = self.flags.dataloader_workers
+        worker_kwargs = {'persistent_workers': persistent, 'prefetch_factor': self.flags.prefetch_factor} \
+            if num_workers > 0 else {}
+        return DataLoader(dataset, batch_size=self.flags.batch_size, shuffle=shuffle, num_workers=num_workers,
+                          drop_last=True, pin_memory=self.pin_memory,
+                          collate_fn=getattr(dataset, 'collate_fn', None), **worker_kwargs)
+
+    @staticmethod
+    def shutdown_workers(loader: DataLoader):
+        """Shut down the persistent worker processes of loader, if it has started them."""
+        iterator = getattr(loader, '_iterator', None)
+        if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+            iterator._shutdown_workers()
+        loader._iterator = None
+
+    def close(self):
+        """Shut down the workers of all loaders."""
+        for loader in self._loaders.values():
+            self.shutdown_workers(loader)
+        self._loaders.clear()
@@ -45,6 +45,40 @@ class AverageMeter(object):
         return self.avg
 
 
+class TensorAverageMeter:
+    """
+    Same as AverageMeter, but the sum and count are accumulated as tensors on the device of the values, such that
+    updating the meter does not synchronize with the host. The average is only transferred to the host in get_average.
+    """
+
+    def __init__(self, name: str, precision=None):
+        self.name = name
+        self.precision = precision
+        self.reset()
+
+    def reset(self):
+        self.sum: typing.Optional[Tensor] = None
+        self.count: typing.Optional[Tensor] = None
+
+    def update(self, val: Tensor, n=1):
+        val = torch.as_tensor(val).detach().to(torch.float64)
+        if self.sum is None:
+            self.sum = torch.zeros_like(val)
+            self.count = torch.zeros_like(val)
+        # like AverageMeter, values that are zero are not counted.
+        is_set = val.ne(0)
+        self.sum += torch.where(is_set, val * n, torch.zeros_like(val))
+        self.count += is_set * n
+
+    def get_average(self):
+        if self.sum is None:
+            return 0
+        avg = (self.sum / self.count.clamp(min=1)).item()
+        if self.precision:
+            return np.round(avg, self.precision)
+        return avg
+
+
 class AverageMeterNestedDict:
     """
     Computes and stores the average and current value
@@ -90,6 +124,33 @@ class AverageMeterDict:
         return {key: np.mean(self.vals[key]) for key in self.vals}
 
 
+class TensorAverageMeterDict:
+    """
+    Same as AverageMeterDict, but the values of every key are summed on their device. Like in AverageMeterDict, the
+    average of a key is taken over the updates that contain it. The averages are only transferred to the host in
+    get_average.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sum: typing.Dict[str, Tensor] = {}
+        self.count: typing.Dict[str, int] = {}
+
+    def update(self, val: typing.Mapping[str, Tensor]) -> None:
+        for key, value in val.items():
+            value = torch.as_tensor(value).detach().to(torch.float64)
+            self.sum[key] = self.sum[key] + value if key in self.sum else value
+            self.count[key] = self.count.get(key, 0) + 1
+
+    def get_average(self) -> typing.Mapping[str, float]:
+        if not self.sum:
+            return {}
+        # stack the averages so that they are transferred to the host at once.
+        device = next(iter(self.sum.values())).device
+        avgs = torch.stack([self.sum[key].to(device) / self.count[key] for key in self.sum])
+        return dict(zip(self.sum, avgs.tolist()))
+
+
 class AverageMeterLatents(AverageMeterDict):
     def __init__(self, name: str, factorized_representation: bool):
         super().__init__(name=name)
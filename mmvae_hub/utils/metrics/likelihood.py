@@ -6,6 +6,7 @@ from torch.distributions.distribution import Distribution
 
 from mmvae_hub.utils import utils
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
+from mmvae_hub.utils.precision import full_precision
 
 LOG2PI = float(np.log(2.0 * math.pi))
 
@@ -51,6 +52,7 @@ def get_latent_samples(flags, latents, n_imp_samples, mod_names=None):
     return {'content': c, 'style': styles}
 
 
+@full_precision
 def log_mean_exp(x, dim=1):
     """
     log(1/k * sum(exp(x))): this normalizes x.
@@ -117,8 +119,11 @@ def log_marginal_estimate(flags, n_samples, likelihood, image, style, content, d
         log_p_z_2d_style = unit_gaussian_log_pdf(z_style)
 
     d_shape = image.shape
-    # for text mod: d_shape = [5, 1024]
-    if len(d_shape) == 3:
+    # for text mod: d_shape = [5, 1024], or [batch_size, len_sequence] for character indices
+    if len(d_shape) == 2:
+        image = image.unsqueeze(0).repeat(n_samples, 1, 1)
+        image = image.view(batch_size * n_samples, d_shape[-1])
+    elif len(d_shape) == 3:
         image = image.unsqueeze(0).repeat(n_samples, 1, 1, 1)
         image = image.view(batch_size * n_samples, d_shape[-2], d_shape[-1])
     elif len(d_shape) == 4:
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import functools
+
+import torch
+from torch import Tensor
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_autocast(flags) -> torch.autocast:
+    """
+    Autocast context for the forward pass and the loss computation, depending on flags.precision.
+    With fp32, the context is disabled.
+    """
+    device_type = torch.device(flags.device).type
+    if flags.precision == 'fp16' and device_type != 'cuda':
+        raise ValueError('fp16 autocast is only supported on cuda, use bf16 on cpu.')
+    return torch.autocast(device_type=device_type, dtype=PRECISIONS[flags.precision],
+                          enabled=flags.precision != 'fp32')
+
+
+def _to_fp32(x):
+    return x.float() if isinstance(x, Tensor) and x.is_floating_point() else x
+
+
+def full_precision(fn):
+    """
+    Run fn outside of autocast, with its floating point tensor arguments cast to float32.
+    Use this for numerically sensitive computations.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [x for x in (*args, *kwargs.values()) if isinstance(x, Tensor)]
+        device_type = tensors[0].device.type if tensors else 'cpu'
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*(_to_fp32(x) for x in args), **{k: _to_fp32(v) for k, v in kwargs.items()})
+
+    return wrapper
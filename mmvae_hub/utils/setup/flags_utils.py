@@ -41,7 +41,7 @@ class BaseFlagsSetup:
             for k, v in additional_args.items():
                 setattr(flags, k, v)
 
-        if flags.calc_prd:
+        if flags.calc_prd and not flags.fid_in_memory:
             # calc_prd needs saved figures
             flags.save_figure = True
 
@@ -94,6 +94,7 @@ class BaseFlagsSetup:
         flags.dir_experiment = Path(flags.dir_experiment).expanduser()
         flags.inception_state_dict = Path(flags.inception_state_dict).expanduser()
         flags.dir_fid = Path(flags.dir_fid).expanduser() if flags.dir_fid else flags.dir_experiment / 'fid'
+        flags.dir_inception_cache = Path(flags.dir_inception_cache).expanduser() if flags.dir_inception_cache else None
         flags.dir_clf = Path(flags.dir_clf).expanduser() if flags.use_clf else None
 
         assert flags.dir_data.exists() or flags.dataset == 'toy', f'data path: "{flags.dir_data}" not found in {list(flags.dir_data.parent.iterdir())}.'
@@ -166,7 +167,14 @@ class BaseFlagsSetup:
     def get_defaults(flags, is_dict: bool):
         """Add default values if they are not set in the flags for backwards compat."""
         defaults = [('weighted_mixture', False), ('amortized_flow', False), ('coupling_dim', 512), ('beta_warmup', 0),
-                    ('vocab_size', 2900), ('nbr_coupling_block_layers', 0)]
+                    ('vocab_size', 2900), ('nbr_coupling_block_layers', 0), ('stacked_decoding', False),
+                    ('grad_check', 'sampled'), ('grad_check_freq', 100), ('train_log_freq', 0),
+                    ('prefetch_factor', 2), ('pin_memory', True),
+                    ('precision', 'fp32'), ('iw_chunk_size', 0), ('decoder_checkpointing', False),
+                    ('packed_data', True), ('tensor_data', True), ('text_indices', False), ('resized_images', True),
+                    ('cached_data', True), ('fid_in_memory', True), ('dir_inception_cache', None),
+                    ('inception_workers', 4), ('prd_workers', None),
+                    ('prd_num_samples', 0)]
 
         if is_dict:
             for k, v in defaults:
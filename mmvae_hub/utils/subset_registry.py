@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import typing
+from typing import Iterable, List, Tuple
+
+import torch
+from torch import Tensor
+
+
+class SubsetRegistry:
+    """
+    Registry of all non-empty subsets of the modalities, built once per experiment.
+
+    Every subset is identified by an integer bitmask id, where bit i is set if the i-th modality is part of the subset.
+    The string keys like 'm0_m1' are kept as a view on the ids, for logging and for the keys of the results.
+
+    >>> registry = SubsetRegistry(['m0', 'm1', 'm2'])
+    >>> registry.keys
+    ['m0', 'm1', 'm2', 'm0_m1', 'm0_m2', 'm1_m2', 'm0_m1_m2']
+    >>> registry.get_id('m0_m2'), registry.size[5], registry.key[registry.parents[1][0]]
+    (5, 2, 'm0_m1')
+    """
+
+    def __init__(self, mod_strs: Iterable[str], device='cpu'):
+        self.mod_strs = list(mod_strs)
+        self.mod_bits = {mod_str: 1 << idx for idx, mod_str in enumerate(self.mod_strs)}
+        num_ids = 1 << len(self.mod_strs)
+
+        # all subset ids in the order of the powerset: by size, then by the order of the modalities.
+        self.ids = sorted(range(1, num_ids), key=lambda s_id: (bin(s_id).count('1'), self._mod_idx(s_id)))
+        # row of every subset id in the membership mask
+        self.row = {s_id: row for row, s_id in enumerate(self.ids)}
+
+        # lookup tables indexed by the subset id
+        self.members: List[Tuple[str]] = [tuple(sorted(self.mod_strs[idx] for idx in self._mod_idx(s_id)))
+                                          for s_id in range(num_ids)]
+        self.key: List[str] = ['_'.join(members) for members in self.members]
+        self.size: List[int] = [len(members) for members in self.members]
+        self.parents: List[List[int]] = [[s_id | bit for bit in self.mod_bits.values() if not s_id & bit]
+                                         for s_id in range(num_ids)]
+        self.member_idx: List[Tensor] = [torch.tensor(self._mod_idx(s_id), dtype=torch.long, device=device)
+                                         for s_id in range(num_ids)]
+
+        self.key2id = {self.key[s_id]: s_id for s_id in self.ids}
+        self.keys = [self.key[s_id] for s_id in self.ids]
+
+        # membership mask of shape (num_subsets, num_modalities)
+        self.mask = torch.tensor([[bool(s_id & bit) for bit in self.mod_bits.values()] for s_id in self.ids],
+                                 dtype=torch.bool, device=device)
+
+        self._batch_subsets = {}
+
+    def _mod_idx(self, s_id: int) -> List[int]:
+        """Indices of the modalities that are part of the subset."""
+        return [idx for idx in range(len(self.mod_strs)) if s_id >> idx & 1]
+
+    def get_id(self, subset: typing.Union[str, Iterable[str]]) -> int:
+        """Get the id of a subset from its string key or from the names of its modalities."""
+        if isinstance(subset, str):
+            return self.key2id[subset]
+        return sum(self.mod_bits[mod_str] for mod_str in set(subset))
+
+    def get_mod_strs(self, s_key: str) -> List[str]:
+        """Names of the modalities in the subset."""
+        return list(self.members[self.key2id[s_key]])
+
+    def get_size(self, s_key: str) -> int:
+        """Number of modalities in the subset."""
+        return self.size[self.key2id[s_key]]
+
+    def batch_subsets(self, batch_mods: Iterable[str]) -> Tuple[List[str], List[str], Tensor]:
+        """
+        Return the keys of all subsets that can be built from batch_mods, the modalities of the batch in the order of
+        the registry and the membership mask of those subsets with shape (num_subsets, num_batch_mods).
+        The result is cached for every combination of batch_mods.
+        """
+        batch_id = self.get_id(batch_mods)
+        if batch_id not in self._batch_subsets:
+            s_ids = [s_id for s_id in self.ids if s_id & batch_id == s_id]
+            mod_idx = self.member_idx[batch_id]
+            mask = self.mask[[self.row[s_id] for s_id in s_ids]][:, mod_idx]
+            self._batch_subsets[batch_id] = ([self.key[s_id] for s_id in s_ids],
+                                             [self.mod_strs[idx] for idx in self._mod_idx(batch_id)], mask)
+        return self._batch_subsets[batch_id]
+
+    def batch_subset_keys(self, batch_mods: Iterable[str]) -> List[str]:
+        """Keys of all subsets that can be built from batch_mods."""
+        return self.batch_subsets(batch_mods)[0]
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
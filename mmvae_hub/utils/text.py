@@ -1,12 +1,81 @@
+import functools
 import random
+from typing import Iterable, List, Sequence, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 digit_text_german = ['null', 'eins', 'zwei', 'drei', 'vier', 'fuenf', 'sechs', 'sieben', 'acht', 'neun']
 digit_text_english = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine']
 
 
+class TextCodec:
+    """
+    Character level codec of an alphabet, that encodes batches of texts to index or one-hot tensors and decodes them.
+
+    As in the per character encoding, '$' marks the end of a text that is shorter than len_seq, the text is padded
+    with '&' to len_seq, and characters that are not found in the alphabet are replaced with '@'.
+    Use get_text_codec to get the codec of an alphabet, which is built only once.
+    """
+
+    def __init__(self, alphabet: str):
+        self.alphabet = alphabet
+        self.num_chars = len(alphabet)
+        # alphabet.find returns -1 if '@' is not part of the alphabet, which selects the last character.
+        self.unknown_idx = alphabet.find('@') % self.num_chars
+
+        # the first occurrence of a character in the alphabet defines its index, as with alphabet.find.
+        self.char2idx = {}
+        for idx, char in enumerate(alphabet):
+            self.char2idx.setdefault(char, idx)
+        # lookup table of the latin-1 characters, other characters are looked up in char2idx.
+        self.lut = np.full(256, self.unknown_idx, dtype=np.int64)
+        for char, idx in self.char2idx.items():
+            if ord(char) < 256:
+                self.lut[ord(char)] = idx
+        self.idx2char = np.array(list(alphabet))
+
+    @staticmethod
+    def pad(seq: Union[str, Sequence[str]], len_seq: int) -> str:
+        """Truncate the text to len_seq or append '$' and pad it with '&' to len_seq."""
+        seq = ''.join(seq)
+        if len(seq) > len_seq:
+            return seq[:len_seq]
+        elif len(seq) < len_seq:
+            return (seq + '$').ljust(len_seq, '&')
+        return seq
+
+    def encode(self, seqs: Iterable[Union[str, Sequence[str]]], len_seq: int) -> torch.Tensor:
+        """Encode a batch of texts to a long tensor of character indices with shape (bs, len_seq)."""
+        text = ''.join(self.pad(seq, len_seq) for seq in seqs)
+        try:
+            indices = self.lut[np.frombuffer(text.encode('latin-1'), dtype=np.uint8)]
+        except UnicodeEncodeError:
+            indices = np.array([self.char2idx.get(char, self.unknown_idx) for char in text], dtype=np.int64)
+        return torch.from_numpy(indices).view(-1, len_seq)
+
+    def one_hot(self, seqs: Iterable[Union[str, Sequence[str]]], len_seq: int) -> torch.Tensor:
+        """Encode a batch of texts to a one-hot float tensor with shape (bs, len_seq, num_chars)."""
+        return F.one_hot(self.encode(seqs, len_seq), self.num_chars).float()
+
+    def indices_to_chars(self, indices: torch.Tensor) -> List[List[str]]:
+        """Decode a batch of character indices with shape (bs, len_seq) to lists of characters."""
+        return self.idx2char[indices.cpu().numpy()].tolist()
+
+    def decode(self, gen_t: torch.Tensor) -> List[str]:
+        """
+        Decode a batch of one-hot encodings, probabilities or logits with shape (bs, len_seq, num_chars) to strings,
+        by taking the most likely character at every position.
+        """
+        return [''.join(chars) for chars in self.indices_to_chars(gen_t.argmax(-1))]
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_codec(alphabet: str) -> TextCodec:
+    return TextCodec(alphabet)
+
+
 def char2Index(alphabet, character):
     return alphabet.find(character)
 
@@ -18,21 +87,7 @@ def one_hot_encode(len_seq: int, alphabet: str, seq: str) -> torch.tensor:
     len_seq is the maximum sequence length
 
     """
-    X = torch.zeros(len_seq, len(alphabet))
-    if len(seq) > len_seq:
-        seq = seq[:len_seq]
-    elif len(seq) < len_seq:
-        seq += '$'
-        seq = seq.ljust(len_seq, '&')
-
-    for index_char, char in enumerate(seq):
-        # char2Index return -1 if the char is not found in the alphabet.
-        if char2Index(alphabet, char) != -1:
-            X[index_char, char2Index(alphabet, char)] = 1.0
-        else:
-            X[index_char, alphabet.find('@')] = 1.0
-
-    return X
+    return get_text_codec(alphabet).one_hot([seq], len_seq)[0]
 
 
 def create_text_from_label_mnist(len_seq, label, alphabet):
@@ -45,14 +100,10 @@ def create_text_from_label_mnist(len_seq, label, alphabet):
 
 
 def seq2text(alphabet, seq):
-    return [alphabet[seq[j]] for j in range(len(seq))]
+    seq = seq.cpu().numpy() if isinstance(seq, torch.Tensor) else np.asarray(seq)
+    return get_text_codec(alphabet).idx2char[seq].tolist()
 
 
 def tensor_to_text(alphabet, gen_t):
-    gen_t = gen_t.cpu().data.numpy()
-    gen_t = np.argmax(gen_t, axis=-1)
-    decoded_samples = []
-    for i in range(len(gen_t)):
-        decoded = seq2text(alphabet, gen_t[i])
-        decoded_samples.append(decoded)
-    return decoded_samples;
+    """Decode a batch of one-hot encodings, probabilities or character indices to lists of characters."""
+    return get_text_codec(alphabet).indices_to_chars(gen_t.argmax(-1) if gen_t.is_floating_point() else gen_t)
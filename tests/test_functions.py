@@ -1,11 +1,27 @@
+import argparse
 import tempfile
+from pathlib import Path
 
+import numpy as np
 import pytest
+from torch.distributions import OneHotCategorical
 
+from mmvae_hub.evaluation.fid.fid_score import calculate_frechet_distance
+from mmvae_hub.evaluation.fid.frechet_distance import calculate_frechet_distances
+from mmvae_hub.evaluation.fid.inception_features import FeatureStats
 from mmvae_hub.networks.FlowVaes import PlanarMixtureMMVae
 from mmvae_hub.networks.MixtureVaes import MOEMMVae
-from mmvae_hub.networks.utils.mixture_component_selection import mixture_component_selection
+from mmvae_hub.networks.text.embedding import embed_text
+from mmvae_hub.networks.utils.mixture_component_selection import mixture_component_selection, \
+    component_indices_from_bins, sample_component_indices, subset_component_indices
+from mmvae_hub.networks.utils.utils import IndexCategorical
 from mmvae_hub.utils.Dataclasses.Dataclasses import *
+from mmvae_hub.utils.fusion_functions import mixture_component_selection_embedding
+from mmvae_hub.utils.grad_sentinel import GradAnomalySentinel
+from mmvae_hub.utils.metrics.average_meters import AverageMeter, AverageMeterDict, TensorAverageMeter, \
+    TensorAverageMeterDict
+from mmvae_hub.utils.metrics.likelihood import log_marginal_estimate
+from mmvae_hub.utils.text import get_text_codec, one_hot_encode
 from tests.utils import set_me_up
 from matplotlib import pyplot as plt
 
@@ -131,6 +147,171 @@ def test_fuse_modalities_4():
                                  [2., 2., 2.]]))
 
 
+# @pytest.mark.tox
+def test_component_indices_from_bins():
+    """
+    The experts should take consecutive parts of the batch with the sizes of their bins, empty bins should be
+    skipped and the last expert should take the remainder of the batch.
+    """
+    assert component_indices_from_bins(torch.tensor([2, 3, 5]), 10).tolist() == [0, 0, 1, 1, 1, 2, 2, 2, 2, 2]
+    assert component_indices_from_bins(torch.tensor([1, 1, 1]), 5).tolist() == [0, 1, 2, 2, 2]
+    assert component_indices_from_bins(torch.tensor([[0, 2, 2], [4, 1, 0]]), 4).tolist() == [[1, 1, 2, 2],
+                                                                                             [0, 0, 0, 0]]
+
+
+# @pytest.mark.tox
+def test_sample_component_indices():
+    """The experts should be chosen independently for every sample with probability proportional to their weight."""
+    assert sample_component_indices(torch.tensor([0., 1., 0.]), 20).tolist() == [1] * 20
+
+    torch.manual_seed(0)
+    component_idx = sample_component_indices(torch.tensor([1., 3.]), 10000)
+    assert component_idx.shape == (10000,)
+    assert set(component_idx.unique().tolist()) == {0, 1}
+    assert abs(component_idx.float().mean().item() - 0.75) < 0.02
+
+
+# @pytest.mark.tox
+def test_subset_component_indices():
+    """Every subset should split the batch into equal parts of its members, the last member takes the remainder."""
+    subset_mask = torch.tensor([[True, False, True], [False, True, False], [True, True, True]])
+    assert subset_component_indices(subset_mask, 5).tolist() == [[0, 0, 2, 2, 2], [1, 1, 1, 1, 1], [0, 1, 2, 2, 2]]
+
+
+# @pytest.mark.tox
+def test_mixture_component_selection_embedding():
+    """Only the experts of s_key should be selected, or all experts if s_key is 'all'."""
+    subset_embeds = {f'm{idx}': torch.full((50, 3), float(idx)) for idx in range(3)}
+    assert set(mixture_component_selection_embedding(subset_embeds, 'm1_m2', None).unique().tolist()) <= {1., 2.}
+    assert set(mixture_component_selection_embedding(subset_embeds, 'all', None).unique().tolist()) <= {0., 1., 2.}
+
+# @pytest.mark.tox
+@pytest.mark.parametrize("method", ['iwmoe', 'iwmogfm'])
+def test_stacked_decoding(method: str):
+    """
+    Decoding the samples of all subsets in one stacked pass should give the same likelihoods as decoding every
+    subset separately.
+    """
+    class_dim = 3
+    batch_size = 2
+    num_mods = 3
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        mst = set_me_up(tmpdirname, method=method,
+                        attributes={'num_mods': num_mods, 'class_dim': class_dim, 'device': 'cpu',
+                                    'batch_size': batch_size, 'K': 2}, dataset=DATASET)
+
+        model = mst.mm_vae
+        subset_samples = {s_key: torch.randn((model.K, batch_size, class_dim)) for s_key in ['m0', 'm0_m1', 'm2']}
+        batch_sample = torch.rand((model.K, batch_size, *mst.modalities['m0'].data_size))
+
+        model.flags.stacked_decoding = False
+        rec_mods = model.decode_subset_samples(subset_samples)
+        model.flags.stacked_decoding = True
+        rec_mods_stacked = model.decode_subset_samples(subset_samples)
+
+        for s_key in subset_samples:
+            for mod_str in mst.modalities:
+                assert torch.allclose(rec_mods[s_key][mod_str].log_prob(batch_sample),
+                                      rec_mods_stacked[s_key][mod_str].log_prob(batch_sample), atol=1e-5)
+
+
+# @pytest.mark.tox
+@pytest.mark.parametrize("method", ['iwmoe', 'iwmogfm'])
+@pytest.mark.parametrize("decoder_checkpointing", [False, True])
+def test_chunked_decoding(method: str, decoder_checkpointing: bool):
+    """
+    Decoding the importance samples in chunks of the K dimension should give the same log-likelihoods and gradients
+    as decoding all samples at once, also if the decoder activations of the chunks are checkpointed.
+    """
+    class_dim = 3
+    batch_size = 2
+    num_mods = 3
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        mst = set_me_up(tmpdirname, method=method,
+                        attributes={'num_mods': num_mods, 'class_dim': class_dim, 'device': 'cpu',
+                                    'batch_size': batch_size, 'K': 5}, dataset=DATASET)
+
+        model = mst.mm_vae
+        # the decoders are only checkpointed in training mode. The polymnist decoders have no batch dependent layers.
+        model.train(decoder_checkpointing)
+        model.flags.decoder_checkpointing = decoder_checkpointing
+        dec_params = [param for mod in mst.modalities.values() for param in mod.decoder.parameters()]
+        subset_samples = {s_key: torch.randn((model.K, batch_size, class_dim)) for s_key in ['m0', 'm0_m1', 'm2']}
+        batch_d = {mod_str: torch.rand((batch_size, *mod.data_size)) for mod_str, mod in mst.modalities.items()}
+
+        lpx_zs = model.subset_log_likelihoods(model.decode_subset_samples(subset_samples), subset_samples, batch_d)
+        grads = torch.autograd.grad(sum(lpx_z.sum() for lpx_z in lpx_zs.values()), dec_params)
+        model.flags.iw_chunk_size = 2
+        lpx_zs_chunked = model.subset_log_likelihoods(None, subset_samples, batch_d)
+        grads_chunked = torch.autograd.grad(sum(lpx_z.sum() for lpx_z in lpx_zs_chunked.values()), dec_params)
+
+        for s_key in subset_samples:
+            assert lpx_zs_chunked[s_key].shape == (model.K, batch_size)
+            assert torch.allclose(lpx_zs[s_key], lpx_zs_chunked[s_key], atol=1e-4)
+        for grad, grad_chunked in zip(grads, grads_chunked):
+            assert torch.allclose(grad, grad_chunked, atol=1e-4)
+
+
+# @pytest.mark.tox
+def test_cond_generation():
+    """
+    The stacked conditional generation should give the same samples as generating from every subset separately.
+    """
+    class_dim = 3
+    batch_size = 2
+    num_mods = 3
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        mst = set_me_up(tmpdirname, method='mopoe',
+                        attributes={'num_mods': num_mods, 'class_dim': class_dim, 'device': 'cpu',
+                                    'batch_size': batch_size}, dataset=DATASET)
+        mst.set_eval_mode()
+        model = mst.mm_vae
+
+        batch_d = {mod_str: torch.rand((batch_size, *mod.data_size)) for mod_str, mod in mst.modalities.items()}
+        with torch.no_grad():
+            _, joint_latent = model.inference(batch_d)
+            torch.manual_seed(0)
+            cond_gen = model.cond_generation(joint_latent, out_mods=['m0'])
+
+            # draw the random variables in the same order as cond_generation
+            torch.manual_seed(0)
+            model.get_random_styles(batch_size)
+            for s_key in joint_latent.subsets:
+                latents = ReparamLatent(content=joint_latent.get_subset_embedding(s_key), style=None)
+                gen = model.generate_from_latents(latents, out_mods=['m0'])
+                assert list(cond_gen[s_key]) == ['m0']
+                assert torch.allclose(cond_gen[s_key]['m0'], gen['m0'], atol=1e-6)
+
+
+# @pytest.mark.tox
+@pytest.mark.parametrize("method", ['moe', 'mopoe', 'poe'])
+def test_fuse_subsets(method: str):
+    """
+    The batched fusion of all subsets should give the same subset distributions as fusing every subset separately.
+    """
+    class_dim = 3
+    batch_size = 5
+    num_mods = 3
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        mst = set_me_up(tmpdirname, method=method,
+                        attributes={'num_mods': num_mods, 'class_dim': class_dim, 'device': 'cpu',
+                                    'batch_size': batch_size}, dataset=DATASET)
+        model = mst.mm_vae
+        batch_mods = ['m0', 'm2']
+
+        enc_mods = {mod_str: BaseEncMod(latents_class=Distr(mu=torch.randn((batch_size, class_dim)),
+                                                            logvar=torch.randn((batch_size, class_dim))))
+                    for mod_str in batch_mods}
+
+        distr_subsets = model.fuse_subsets(enc_mods, batch_mods)
+        assert set(distr_subsets) == {'m0', 'm2', 'm0_m2'}
+
+        for s_key, distr_subset in distr_subsets.items():
+            expected = model.fuse_subset(enc_mods, s_key)
+            assert torch.allclose(distr_subset.mu, expected.mu, atol=1e-6)
+            assert torch.allclose(distr_subset.logvar, expected.logvar, atol=1e-6)
+
+
 def text_beta_warmup():
     """Verify the beta warmup function."""
     min_beta = 0
@@ -152,5 +333,154 @@ def text_beta_warmup():
     plt.show()
 
 
+# @pytest.mark.tox
+@pytest.mark.parametrize("mode", ['sampled', 'full'])
+def test_grad_sentinel(mode: str):
+    """
+    The gradient sentinel should record the parameters with a non-finite gradient, and in full mode also the
+    parameters that never received a gradient.
+    """
+    net = torch.nn.Sequential(torch.nn.Linear(3, 2), torch.nn.Linear(2, 2))
+    sentinel = GradAnomalySentinel(net.named_parameters(), mode=mode, check_freq=2)
+
+    net[0](torch.randn(4, 3)).sum().backward()
+    net[0].weight.grad[0, 0] = float('nan')
+
+    assert sentinel.check(1) == ([] if mode == 'sampled' else ['0.weight'])
+    assert sentinel.check(2) == ['0.weight']
+    if mode == 'sampled':
+        assert sentinel.get_anomalies() == [('0.weight', 1)]
+    else:
+        assert sentinel.get_anomalies() == [('0.weight', 2), ('1.weight: None', 2), ('1.bias: None', 2)]
+    assert not sentinel.get_anomalies()
+
+
+# @pytest.mark.tox
+def test_text_codec():
+    """
+    The batch encoding of the text codec should mark the end of the text with '$', pad with '&' and replace unknown
+    characters with '@', and decoding should give back the padded texts.
+    """
+    alphabet = 'abcd $&@'
+    codec = get_text_codec(alphabet)
+
+    one_hot = codec.one_hot(['abc', 'dxb', 'abcdabcd'], len_seq=6)
+    assert one_hot.shape == (3, 6, len(alphabet))
+    assert torch.equal(one_hot[0], one_hot_encode(6, alphabet, 'abc'))
+    assert codec.decode(one_hot) == ['abc$&&', 'd@b$&&', 'abcdab']
+
+
+# @pytest.mark.tox
+@pytest.mark.parametrize("kernel_size,stride,padding", [(1, 1, 0), (4, 2, 1), (3, 2, 1)])
+def test_embed_text(kernel_size: int, stride: int, padding: int):
+    """
+    The first convolution of a text network should give the same result for character indices as for their one-hot
+    encoding, and the categorical likelihood over the indices should match the one-hot categorical likelihood.
+    """
+    conv = torch.nn.Conv1d(7, 5, kernel_size=kernel_size, stride=stride, padding=padding)
+    indices = torch.randint(0, 7, (2, 3, 16), dtype=torch.int8)
+    one_hot = torch.nn.functional.one_hot(indices.long(), 7).float()
+
+    assert torch.allclose(embed_text(conv, indices)[1], embed_text(conv, one_hot[1]), atol=1e-6)
+
+    probs = torch.softmax(torch.randn(3, 16, 7), -1)
+    assert torch.allclose(IndexCategorical(probs).log_prob(indices[0]), OneHotCategorical(probs).log_prob(one_hot[0]))
+
+
+# @pytest.mark.tox
+def test_log_marginal_estimate_text_indices():
+    """The log-likelihood estimate of character indices should match the one of their one-hot encoding."""
+    batch_size, n_samples, len_seq, num_chars, class_dim = 4, 10, 8, 7, 3
+    flags = argparse.Namespace(batch_size=batch_size)
+    probs = torch.softmax(torch.randn(batch_size * n_samples, len_seq, num_chars), -1)
+    indices = torch.randint(0, num_chars, (batch_size, len_seq), dtype=torch.int8)
+    one_hot = torch.nn.functional.one_hot(indices.long(), num_chars).float()
+    num_total = batch_size * n_samples
+    content = {'z': torch.randn(num_total, class_dim), 'mu': torch.zeros(num_total, class_dim),
+               'logvar': torch.zeros(num_total, class_dim)}
+
+    ll_indices = log_marginal_estimate(flags, n_samples, IndexCategorical(probs), indices, None, content)
+    ll_one_hot = log_marginal_estimate(flags, n_samples, OneHotCategorical(probs), one_hot, None, content)
+    assert torch.allclose(ll_indices, ll_one_hot)
+
+
+# @pytest.mark.tox
+def test_feature_stats():
+    """
+    The running statistics of features that are added batch by batch should match the statistics of all features,
+    also after saving and loading them.
+    """
+    features = torch.rand(100, 16, dtype=torch.float64)
+    for keep_features, keep_moments in [(True, False), (False, True), (True, True)]:
+        feature_stats = FeatureStats(dims=16, keep_features=keep_features, keep_moments=keep_moments)
+        for batch in features.split(30):
+            feature_stats.update(batch)
+
+        assert np.allclose(feature_stats.mean, features.mean(0).numpy())
+        assert np.allclose(feature_stats.cov, np.cov(features.numpy(), rowvar=False))
+        if keep_features:
+            assert np.array_equal(feature_stats.features, features.numpy())
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = Path(tmpdirname) / 'stats.npz'
+            feature_stats.save(path)
+            loaded = FeatureStats.load(path)
+        assert (loaded.keep_features, loaded.keep_moments) == (keep_features, keep_moments)
+        assert np.array_equal(loaded.cov, feature_stats.cov)
+        if keep_features:
+            assert np.array_equal(loaded.features, features.numpy())
+
+
+# @pytest.mark.tox
+def test_frechet_distances():
+    """The Frechet distance from the eigenvalue decomposition should match the one computed with scipy's sqrtm."""
+    feats_real = np.random.rand(500, 32)
+    stats = {}
+    for key in ['a', 'b']:
+        feats_gen = np.random.rand(300, 32) ** 2
+        stats[key] = (feats_gen.mean(0), np.cov(feats_gen, rowvar=False))
+    mu_real, sigma_real = feats_real.mean(0), np.cov(feats_real, rowvar=False)
+
+    distances = calculate_frechet_distances(mu_real, sigma_real, stats, num_threads=2)
+    for key, (mu, sigma) in stats.items():
+        assert np.isclose(distances[key], calculate_frechet_distance(mu_real, sigma_real, mu, sigma), rtol=1e-6)
+
+
+# @pytest.mark.tox
+def test_tensor_average_meter():
+    """The TensorAverageMeter should give the same average as the AverageMeter, which does not count zero values."""
+    values = [1.5, 0., 2.5, -3., 0.]
+    meter, tensor_meter = AverageMeter('loss'), TensorAverageMeter('loss')
+    assert tensor_meter.get_average() == 0
+    for value in values:
+        meter.update(value)
+        tensor_meter.update(torch.tensor(value))
+    assert np.isclose(tensor_meter.get_average(), meter.get_average())
+
+
+# @pytest.mark.tox
+def test_tensor_average_meter_dict():
+    """
+    The TensorAverageMeterDict should give the same averages as the AverageMeterDict, and average every key over the
+    updates that contain it, also if the keys change between updates.
+    """
+    values = [{'a': 1., 'b': 2.}, {'a': 3., 'b': -4.}]
+    meter, tensor_meter = AverageMeterDict('klds'), TensorAverageMeterDict('klds')
+    assert tensor_meter.get_average() == {}
+    for val in values:
+        meter.update(val)
+        tensor_meter.update({key: torch.tensor(value) for key, value in val.items()})
+    average = tensor_meter.get_average()
+    assert average.keys() == meter.get_average().keys()
+    assert all(np.isclose(average[key], value) for key, value in meter.get_average().items())
+
+    # a missing key is averaged over the updates that contain it, an extra key is added.
+    tensor_meter.update({'a': torch.tensor(5.)})
+    tensor_meter.update({'a': torch.tensor(7.), 'c': torch.tensor(6.)})
+    average = tensor_meter.get_average()
+    assert average.keys() == {'a', 'b', 'c'}
+    assert np.allclose([average['a'], average['b'], average['c']], [4., -1., 6.])
+
+
 if __name__ == '__main__':
     text_beta_warmup()